@@ -6,63 +6,61 @@ Created on Thu Oct 29 14:59:19 2020
 @author: pfjarschel
 """
 
-import sys, time, os.path, datetime
-import pickle
+import sys, time, os.path, datetime, argparse
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from threading import Timer, Thread, Lock
-from PyQt5 import uic
 from PyQt5.QtCore import Qt, QCoreApplication, QTimer, QDir
-from PyQt5.QtWidgets import QApplication, QFileDialog, QWidget, QSpinBox, QDoubleSpinBox, QCheckBox
+from PyQt5.QtWidgets import QApplication, QFileDialog, QWidget, QSpinBox, QDoubleSpinBox, QCheckBox, QLabel
 from PyQt5.QtGui import QIcon
 
-import thorlabsPM300
-import agilent816xb
+import liveplot
+import decimate
+import features
+import sweepstore
+import processing
+import checkpoint
+import measfile
+import sweepengine
+import adaptive
+import recipes
+import runqueue
+import archive
+import discovery
+import uicache
 
-FormUI, WindowUI = uic.loadUiType("MainWindow.ui")
+FormUI, WindowUI = uicache.loadUiType(os.path.join(os.path.dirname(os.path.abspath(__file__)), "MainWindow.ui"))
 
 
 class MainWindow(FormUI, WindowUI):
 
     simulate = False
+    sim_options = {}
 
     def __init__(self):
         super(MainWindow, self).__init__()
         
         self.pm = None
         self.laser = None
-        self.measurements = []
-        self.timestamps = []
-        self.xaxis = []
-        self.prev_measurements = []
-        self.prev_timestamps = []
-        self.prev_xaxis = []
+        self.engine = None
+        self.connector = None
+        self.adaptive = None
+        self.adaptive_run = False
+        self.queue = runqueue.RunQueue()
+        self.runner = None
+        self.queue_run = False
+        self.prev_sweeps = sweepstore.SweepStore()
+        self.archive = None
+        self.archive_load = 20
         self.measTimer = None
-        self.busymeas = False
-        self.meas_i = 0
-        self.launchtime = []
-        self.launchwl = []
-        self.stoptime = []
-        self.stopwl = []
-        self.sweepspan = 0
-        self.sweepesttime = 0
+        self.connectTimer = None
+        self.profiletime = 0.0
         self.timeout = 10.00
-        self.settingsfile = "settings.p"
-        self.tempfile = "temp_results.txt"
+        self.address = None
+        self.recipes = recipes.RecipeStore()
+        self.tempfile = "temp_results.ckpt"
         self.fullpath = str(__file__)
         self.lastdir = QDir.homePath()
 
-        # Testing stuff
-        self.sweep_start_delay = 2000
-        self.test_noise = 1e-1
-        self.avg_power_mw = 1.0
-        self.real_wav = 0
-        self.gauss_A_0 = 1.0
-        self.gauss_X0_0 = 0.5
-        self.gauss_W_0 = 0.1
-
         self.setupUi(self)
         self.setupOtherUi()
         self.SetupActions()
@@ -71,9 +69,13 @@ class MainWindow(FormUI, WindowUI):
 
         resizeEvent = self.OnWindowResize
 
-        # self.delayedInit = Timer(0.1, self.InitializeDevices)
+        # The plot and the instruments are set up once the window is on screen
+        QTimer.singleShot(0, self.delayedInit)
+
+    def delayedInit(self):
+        # The bus scan runs while matplotlib loads
         self.InitializeDevices()
-        # self.delayedInit.start()
+        self.setupPlot()
 
     def OnWindowResize(self, event):
         pass
@@ -81,7 +83,23 @@ class MainWindow(FormUI, WindowUI):
     def setupOtherUi(self):
         self.statusbar.showMessage(f"Initializing...")
 
-        self.figure = plt.figure()
+        self.profileLabel = QLabel("")
+        self.statusbar.addPermanentWidget(self.profileLabel)
+
+        self.loadSettings()
+        try:
+            self.queue.load()
+        except:
+            self.statusbar.showMessage(f"Could not read the job queue in {self.queue.path}")
+        self.updateQueueButton()
+
+    def setupPlot(self):
+        # matplotlib takes about half a second to import, so it is only loaded here
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+        from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
+
+        self.figure = Figure()
         self.graph = FigureCanvas(self.figure)
         self.graphToolbar = NavigationToolbar(self.graph, self)
         self.graphHolder.addWidget(self.graphToolbar)
@@ -92,8 +110,8 @@ class MainWindow(FormUI, WindowUI):
         self.graph_ax.set_title("Transmission")
         self.graph_ax.grid(True)
         self.graph.draw()
-
-        self.loadSettings()
+        self.liveplot = liveplot.LivePlot(self.graph, self.graph_ax)
+        self.lod = None
 
     def SetupActions(self):
         # Buttons and etc
@@ -102,19 +120,56 @@ class MainWindow(FormUI, WindowUI):
         self.saveBut.clicked.connect(self.saveClick)
         self.clearprevBut.clicked.connect(self.clearPreviousData)
         self.loadprevBut.clicked.connect(self.loadPreviousData)
+        self.archiveBut.clicked.connect(self.loadArchived)
+        self.recipeCombo.activated[str].connect(self.applyRecipe)
+        self.queueAddBut.clicked.connect(self.queueAdd)
+        self.queueRunBut.clicked.connect(self.queueRun)
+        self.saveRecipeBut.clicked.connect(self.saveRecipe)
+        self.delRecipeBut.clicked.connect(self.deleteRecipe)
 
         # Timers
         self.measTimer = QTimer()
         self.measTimer.timeout.connect(self.measLoop)
-        self.measTimer.setInterval(1)
+        self.measTimer.setInterval(20)
+        self.connectTimer = QTimer()
+        self.connectTimer.timeout.connect(self.connectLoop)
+        self.connectTimer.setInterval(100)
 
     def InitializeDevices(self):
-        self.statusbar.showMessage(f"Initializing...")
-        self.laser = agilent816xb.Agilent816xb()
-        self.pm = thorlabsPM300.ThorLabsPM300()
-        if not self.simulate:
-            self.pm.init()
-            self.laser.connectlaser(True, 17)
+        # Connects on a background thread; connectLoop shows the progress and takes over
+        # once both instruments have answered or given up
+        self.startBut.setEnabled(False)
+        self.saveBut.setEnabled(False)
+        self.queueRunBut.setEnabled(False)
+        self.address = self.addrSpin.value()
+        self.connector = discovery.Connector(self.address, self.simulate, self.sim_options, self.recipes.devices)
+        self.connector.start()
+        self.connectTimer.start()
+
+    def connectLoop(self):
+        for msg in self.connector.poll():
+            self.statusbar.showMessage(msg)
+        if self.connector.state != self.connector.DONE:
+            return
+        self.connectTimer.stop()
+        self.laser, self.pm = self.connector.laser, self.connector.pm
+
+        lastslash = self.fullpath.rfind("/")
+        self.engine = sweepengine.SweepEngine(self.laser, self.pm, self.fullpath[:lastslash + 1] + self.tempfile)
+        self.engine.onSweepStart = self.sweepStarted
+        self.engine.onSweepEnd = self.sweepEnded
+        self.engine.onDone = self.measDone
+        self.engine.onStatus = self.statusbar.showMessage
+        self.adaptive = adaptive.AdaptiveSweep(self.engine)
+        self.adaptive.onDone = self.measDone
+        self.adaptive.onStatus = self.statusbar.showMessage
+        self.runner = runqueue.QueueRunner(self.engine, self.queue)
+        self.runner.onJobStart = self.jobStarted
+        self.runner.onDone = self.measDone
+        self.runner.onStatus = self.statusbar.showMessage
+        self.startBut.setEnabled(True)
+        self.saveBut.setEnabled(True)
+        self.queueRunBut.setEnabled(True)
 
         statstr = ""
         if self.laser.laserOK:
@@ -126,333 +181,384 @@ class MainWindow(FormUI, WindowUI):
         else:
             statstr = statstr + " Power Meter Error."
         
-        self.statusbar.showMessage(statstr)
+        self.statusbar.showMessage(statstr + f" ({self.connector.elapsed:.1f} s)")
+        self.recoverCheckpoint()
+
+    def sweepParams(self):
+        return sweepengine.SweepParams(start=self.startSpin.value(), stop=self.stopSpin.value(),
+                                       speed=self.speedSpin.value(), slot=self.slotSpin.value(),
+                                       sweeps=self.sweepsSpin.value(), hwlog=self.hwlogCheck.isChecked(),
+                                       logstep=self.stepSpin.value()/1000.0,
+                                       turnoff=self.turnoffCheck.isChecked(), timeout=self.timeout)
 
     def startMeas(self):
-        self.statusbar.showMessage(f"Starting measurement...")
-        self.laser.setState(self.slotSpin.value(), True)
-        
         if self.keepplotCheck.isChecked():
-            for i in range(0, len(self.measurements)):
-                self.prev_measurements.append(self.measurements[i])
-                self.prev_timestamps.append(self.timestamps[i])
-                self.prev_xaxis.append(self.xaxis[i])
-        self.measurements = []
-        self.timestamps = []
-        self.xaxis = []
-        self.meas_i = 0
-        self.launchtime = []
-        self.launchwl = []
-        self.stoptime = []
-        self.stopwl = []
-
-        self.figure.clear()
-        self.graph_ax = self.figure.add_subplot()
-        self.graph_ax.set_xlabel("Time stamp (s)")
-        self.graph_ax.set_ylabel("Power (dBm)")
-        self.graph.draw()
-        
-        self.prepareSweep()
-
-
-    def stopMeas(self):
-        self.measTimer.stop()
-        self.laser.setSweepState(self.slotSpin.value(), "Stop")
-        if self.turnoffCheck.isChecked():
-            self.laser.disableAll()
-        self.statusbar.showMessage(f"Measurement stopped")
+            self.engine.sweeps.moveTo(self.prev_sweeps)
 
-    def stopClick(self):
-        self.endSweep(time.time())
-        self.stopMeas()
-        self.processFinal()
-
-    def prepareSweep(self):
-        self.measurements.append([])
-        self.timestamps.append([])
-        self.laser.setWL(self.slotSpin.value(), self.startSpin.value())
-        self.laser.setSweep(self.slotSpin.value(), "CONT", self.startSpin.value(),
-                            self.stopSpin.value(), 1, 1, 0, self.speedSpin.value())
-        self.laser.setSweepState(self.slotSpin.value(), "Start")
+        self.liveplot.reset("Time stamp (s)", "Power (dBm)", "Transmission")
         
-        if self.simulate:
-            r1 = (1 + 2*np.random.uniform(-self.test_noise, self.test_noise))
-            r2 = (1 + 3*np.random.uniform(-self.test_noise, self.test_noise))
-            r3 = (1 + 2*np.random.uniform(-self.test_noise, self.test_noise))
-            self.gauss_A = self.gauss_A_0*r1
-            self.gauss_X0 = self.gauss_X0_0*r2
-            self.gauss_W = self.gauss_W_0*r3
-
-        self.launchwl.append(self.startSpin.value())
-        startime = time.time()
-        prep_elapsed = time.time() - startime
-        while self.launchwl[-1] <= self.startSpin.value() and prep_elapsed < self.timeout:
-            if not self.simulate:
-                self.launchwl[-1] = self.laser.getWL(self.slotSpin.value())
-            else:
-                if (time.time() - startime)*1000.0 >= self.sweep_start_delay:
-                    self.launchwl[-1] = self.startSpin.value() + np.random.uniform(0.000, 0.1)
-            prep_elapsed = time.time() - startime
-        
-        self.launchtime.append(time.time())
-        self.sweepspan = np.abs(self.stopSpin.value() - self.launchwl[-1])
-        if self.launchwl[-1] < 100:
-            self.sweepesttime = (self.stopSpin.value() - self.startSpin.value())/self.speedSpin.value()
+        self.queue_run = False
+        self.adaptive_run = self.adaptiveCheck.isChecked()
+        if self.adaptive_run:
+            # The set speed is used for the coarse sweep and the set number of sweeps as the
+            # most repeats per region
+            speed = self.speedSpin.value()
+            self.adaptive.adaptive = adaptive.AdaptiveParams(coarse_speed=speed,
+                                                             fine_speed=max(speed/10.0, self.speedSpin.minimum()),
+                                                             max_sweeps=self.sweepsSpin.value())
+            self.adaptive.start(self.sweepParams())
         else:
-            self.sweepesttime = self.sweepspan/self.speedSpin.value()
-
-        if not self.simulate:
-            pwr = self.pm.readPwr()
-        else:
-            pwr = self.test_response(self.launchwl[-1])
-        self.measurements[-1].append(pwr)
-        self.timestamps[-1].append(0)
-
+            self.engine.start(self.sweepParams())
         self.measTimer.start()
 
-        self.statusbar.showMessage(f"Measuring ({self.meas_i + 1}/{self.sweepsSpin.value()})...")
+    def stopClick(self):
+        if self.engine is None:
+            return
+        self.measTimer.stop()
+        if self.queue_run:
+            self.runner.stop()
+        elif self.adaptive_run:
+            self.adaptive.stop()
+        else:
+            self.engine.stop()
 
     def measLoop(self):
-        thistime = time.time()
-        if thistime - self.launchtime[-1] < self.sweepesttime:
-            if not self.simulate:
-                pwr = self.pm.readPwr()
-            else:
-                self.real_wav = self.launchwl[-1] + \
-                                (thistime - self.launchtime[-1])*self.speedSpin.value()
-                if self.real_wav > self.stopSpin.value():
-                    self.real_wav = self.stopSpin.value()
-                pwr = self.test_response(self.real_wav)
-            self.measurements[-1].append(pwr)
-            self.timestamps[-1].append(thistime - self.launchtime[-1])
+        if self.queue_run:
+            n = self.runner.poll()
+        elif self.adaptive_run:
+            n = self.adaptive.poll()
+        else:
+            n = self.engine.poll()
+        if n > 0 and self.engine.state == self.engine.SWEEPING:
+            self.statusbar.showMessage(f"Measuring ({self.engine.meas_i + 1}/{self.engine.params.sweeps})... "
+                                       f"{self.engine.acq.rate():.1f} samples/s, "
+                                       f"worst gap {self.engine.acq.worstGap()*1000.0:.1f} ms")
             if self.updateplotCheck.isChecked():
                 self.updatePlot()
+        if time.perf_counter() - self.profiletime >= 1.0:
+            self.updateProfile()
+
+    def updateProfile(self):
+        self.profiletime = time.perf_counter()
+        self.profileLabel.setText(self.engine.liveSummary())
+        if self.engine.state == self.engine.SWEEPING and self.engine.tracker is not None:
+            live = self.engine.tracker.live()
+            self.featuresLabel.setText(f"min {live['min_db']:.2f} dBm, max {live['max_db']:.2f} dBm, "
+                                       f"{live['dips']} dips / {live['peaks']} peaks so far")
+
+    def queueAdd(self):
+        filename = self.askSaveFile("Save job results to")
+        if filename == "":
+            return
+        job = self.queue.add(self.widgetRecipe(self.recipeCombo.currentText().strip()), filename)
+        self.updateQueueButton()
+        self.statusbar.showMessage(f"Queued job {job.describe()}")
+
+    def queueRun(self):
+        if self.queue.next() is None:
+            self.statusbar.showMessage(f"No pending jobs in the queue")
+            return
+        self.queue_run = True
+        self.adaptive_run = False
+        self.runner.onJobSaved = self.archiveJob if self.archiveCheck.isChecked() else None
+        self.runner.start()
+        self.measTimer.start()
 
-        else:
-            self.endSweep(thistime)
-            self.updatePlot()
+    def jobStarted(self, job):
+        self.liveplot.reset("Time stamp (s)", "Power (dBm)", "Transmission")
+        self.updateQueueButton()
 
-            if self.meas_i >= self.sweepsSpin.value():
-                self.stopMeas()
-                self.processFinal()
-                self.plotFinal()
-                self.statusbar.showMessage(f"Measurement done!")
-            else:                
-                self.prepareSweep()
-
-    def endSweep(self, thistime):
-        self.meas_i += 1
-        self.measTimer.stop()
-        self.stoptime.append(thistime)
-        if not self.simulate:
-            self.stopwl.append(self.laser.getWL(self.slotSpin.value()))
-            pwr = self.pm.readPwr()
-        else:
-            self.real_wav = self.launchwl[-1] + \
-                            (thistime - self.launchtime[-1])*self.speedSpin.value()
-            if self.real_wav > self.stopSpin.value():
-                self.real_wav = self.stopSpin.value()
-            self.stopwl.append(self.real_wav)
-            pwr = self.test_response(self.real_wav)
-        self.measurements[-1].append(pwr)
-        self.timestamps[-1].append(thistime - self.launchtime[-1])
-        self.laser.setSweepState(self.slotSpin.value(), "Stop")
-
-        self.xaxis.append([0]*len(self.timestamps[-1]))
-        lastslash = self.fullpath.rfind("/")
-        path = self.fullpath[:lastslash + 1] + self.tempfile
-        self.saveMeas(path)
+    def archiveJob(self, job, result):
+        # Runs on the queue's writer thread; SQLite connections stay on the thread that opened them
+        store = archive.SweepArchive()
+        try:
+            store.add(result.sweeps, result.meta, label=job.recipe.name)
+        finally:
+            store.close()
 
-    def updatePlot(self):
-        self.figure.clear()
-        self.graph_ax = self.figure.add_subplot()
-        self.graph_ax.set_xlabel("Time stamp (s)")
-        self.graph_ax.set_ylabel("Power (dBm)")
-        self.graph_ax.set_title("Transmission")
-        self.graph_ax.grid(True)
+    def updateQueueButton(self):
+        self.queueRunBut.setText(f"Run queue ({self.queue.count(runqueue.Job.PENDING)})")
 
-        # if self.keepplotCheck.isChecked():
-        #     for i in range(0, len(self.prev_measurements)):
-        #         self.graph_ax.plot(self.prev_timestamps[i], self.prev_measurements[i], 
-        #                             linestyle='dotted', marker='None')
-        for i in range(0, len(self.measurements)):
-            self.graph_ax.plot(self.timestamps[i], self.measurements[i], 
-                                linestyle='-', marker='None')
-        
-        # if self.legendCheck.isChecked():
-        #     self.graph_ax.legend(range(1, 1 + len(self.measurements) + len(self.prev_measurements)))
+    def sweepStarted(self, i):
+        self.liveplot.newLine()
 
-        self.graph.draw()
+    def sweepEnded(self, i):
+        self.updatePlot(True)
+        self.liveplot.finishLine()
+        self.featuresLabel.setText(f"Sweep {i + 1}: " + features.describe(self.engine.sweeps[i].features))
 
-    def processFinal(self):
-        for i in range(0, len(self.measurements)):
-            wavslope = (self.stopwl[i] - self.launchwl[i])/(self.stoptime[i] - self.launchtime[i])
-            
-            for j in range(0, len(self.measurements[i])):
-                wl = self.launchwl[i] + self.timestamps[i][j]*wavslope
-                self.xaxis[i][j] = wl
+    def measDone(self):
+        self.measTimer.stop()
+        self.updateQueueButton()
+        with self.engine.profiler.stage("gui.plotFinal"):
+            self.plotFinal()
+        self.updateProfile()
+        if self.archiveCheck.isChecked() and not self.queue_run:
+            self.archiveSweeps(self.engine.sweeps, self.engine.meta(), self.recipeCombo.currentText().strip())
+        if len(self.engine.sweeps) > 0:
+            self.featuresLabel.setText(f"Sweep {len(self.engine.sweeps)}: "
+                                       + features.describe(self.engine.sweeps.last().features))
+        wlerr = self.engine.runStats()["wl_error_max_nm"]
+        if wlerr > 0:
+            self.statusbar.showMessage(f"Measurement done! Wavelength uncertainty up to {wlerr*1e3:.2f} pm")
+        else:
+            self.statusbar.showMessage(f"Measurement done!")
 
-        lastslash = self.fullpath.rfind("/")
-        path = self.fullpath[:lastslash + 1] + self.tempfile
-        self.saveMeas(path)
+    def updatePlot(self, force=False):
+        # Only the current sweep's line is touched, at most liveplot.fps times per second
+        if force or self.liveplot.due():
+            sweep = self.engine.sweeps.last()
+            with self.engine.profiler.stage("gui.redraw"):
+                self.liveplot.setData(sweep.t, sweep.pwr)
+                self.liveplot.redraw(True)
 
     def plotFinal(self):
-        self.figure.clear()
-        self.graph_ax = self.figure.add_subplot()
+        self.liveplot.active = None
+        self.graph_ax.cla()
         self.graph_ax.set_xlabel("Wavelength (nm)")
         self.graph_ax.set_ylabel("Power (dBm)")
         self.graph_ax.set_title("Transmission")
         self.graph_ax.grid(True)
 
+        # Traces are decimated to the axes width and re-decimated on zoom and pan
+        self.lod = decimate.LODAxes(self.graph_ax)
         if self.keepplotCheck.isChecked():
-            for i in range(0, len(self.prev_measurements)):
-                self.graph_ax.plot(self.prev_xaxis[i], self.prev_measurements[i], 
-                                    linestyle='dotted', marker='None')
-        for i in range(0, len(self.measurements)):
-            self.graph_ax.plot(self.xaxis[i], self.measurements[i],
-                                linestyle='-', marker='None')
+            for sweep in self.prev_sweeps:
+                self.lod.plot(sweep.wl, sweep.pwr, linestyle='dotted', marker='None')
+        for sweep in self.engine.sweeps:
+            self.lod.plot(sweep.wl, sweep.pwr, linestyle='-', marker='None')
+        average = self.engine.average
+        if average is not None:
+            self.lod.fill_between(average.wl, average.min, average.max, color='gray', alpha=0.2)
+            self.lod.plot(average.wl, average.mean, color='k', linestyle='-', marker='None')
+        if self.adaptive_run:
+            for region in self.adaptive.regions:
+                if region.average is not None:
+                    self.lod.plot(region.average.wl, region.average.mean, color='k', linestyle='-', marker='None')
         
+        # Dip (or peak) centers found in this run
+        for sweep in self.engine.sweeps:
+            if sweep.features is not None:
+                found = sweep.features["dips"] + sweep.features["peaks"]
+                self.graph_ax.plot([f["center_wl"] for f in found], [f["level_db"] for f in found],
+                                   linestyle='None', marker='v', color='r')
+
         if self.legendCheck.isChecked():
-            self.graph_ax.legend(range(1, 1 + len(self.measurements) + len(self.prev_measurements)))
+            self.graph_ax.legend(range(1, 1 + len(self.engine.sweeps) + len(self.prev_sweeps)))
         
         self.graph.draw()
     
-    def test_response(self, wl):
-        a = self.gauss_A
-        x0 = self.startSpin.value() + self.gauss_X0*self.sweepspan
-        w = self.gauss_W*self.sweepspan
-        pwr = self.avg_power_mw*a*np.exp(-((wl - x0)**2)/(2*w**2)) + np.random.uniform(0.01, 2*self.test_noise)
-        pwrdbm = 10.0*np.log10(pwr)
-        time.sleep(0.1*(1 + np.random.uniform(-self.test_noise, self.test_noise)))
-        return pwrdbm
-
     def saveClick(self):
         self.statusbar.showMessage(f"Saving measurement...")
-        file = QFileDialog.getSaveFileName(self, "Save file", self.lastdir, "Text files (*.txt)")
+        filename = self.askSaveFile("Save file")
+        if filename == "":
+            filename = QDir.homePath() + f"/lost_measurement_{time.time():.0f}.txt"
+        try:
+            self.saveMeasurement(filename)
+        except Exception as e:
+            # An exception in a slot would abort the GUI and lose the measurement
+            lost = QDir.homePath() + f"/lost_measurement_{time.time():.0f}.txt"
+            try:
+                self.saveMeasurement(lost)
+                self.statusbar.showMessage(f"Could not save {filename} ({e}), saved to {lost}")
+            except Exception as e2:
+                self.statusbar.showMessage(f"Could not save the measurement: {e}; {e2}")
+            return
+        self.statusbar.showMessage(f"Measurement saved!")
+
+    def saveMeasurement(self, filename):
+        if self.adaptive_run:
+            self.adaptive.save(filename)
+        else:
+            self.engine.save(filename)
+
+    def askSaveFile(self, title):
+        # File name with an extension matching the chosen filter, or "" if cancelled
+        file = QFileDialog.getSaveFileName(self, title, self.lastdir, self.fileFilters())
         filename = file[0]
         if filename != "":
-            if filename[-4:] != ".txt" and filename[-4:] != ".TXT":
-                filename = filename + ".txt"   
-        else:
-            filename = QDir.homePath() + f"/lost_measurement_{time.time():.0f}.txt"
-        
-        lastslash = filename.rfind("/")
-        self.lastdir = filename[:lastslash + 1]
-        self.saveMeas(filename)
-
-    def saveMeas(self, name):
-        with open(name, "w") as file:
-            max_rows = 0
-            rows = []
-            for i in range(0, len(self.measurements)):
-                rows.append(len(self.measurements[i]))
-                if len(self.measurements[i]) > max_rows:
-                    max_rows = len(self.measurements[i])
-                file.write(f"{i}_Time (s)\t{i}_Wavlength (nm)\t{i}_Power (dBm)")
-                if i < len(self.measurements) - 1:
-                    file.write("\t")
+            if filename[-4:].lower() not in [".txt", ".npz"] and filename[-3:].lower() != ".h5":
+                if "h5" in file[1]:
+                    filename = filename + ".h5"
+                elif "npz" in file[1]:
+                    filename = filename + ".npz"
                 else:
-                    file.write("\n")
-
-            for j in range(0, max_rows):
-                for i in range(0, len(self.measurements)):
-                    if j < rows[i]:
-                        file.write(f"{self.timestamps[i][j]:.4f}\t{self.xaxis[i][j]:.4f}\t{self.measurements[i][j]:.4f}")
-                    else:
-                        file.write(f"\t\t")
-                    if i < len(self.measurements) - 1:
-                        file.write("\t")
-                    else:
-                        file.write("\n")
-            file.close()
-            
-        self.statusbar.showMessage(f"Measurement saved!")
+                    filename = filename + ".txt"
+            lastslash = filename.rfind("/")
+            self.lastdir = filename[:lastslash + 1]
+        return filename
+
+    def fileFilters(self):
+        filters = "Text files (*.txt)"
+        if measfile.h5py is not None:
+            filters = filters + ";;HDF5 files (*.h5)"
+        return filters + ";;NumPy archives (*.npz)"
 
     def clearPreviousData(self):
-        self.prev_measurements = []
-        self.prev_timestamps = []
-        self.prev_xaxis = []
+        self.prev_sweeps.clear()
 
         self.plotFinal()
 
     def loadPreviousData(self):
         self.statusbar.showMessage(f"Loading data...")
-        file = QFileDialog.getOpenFileName(self, "Open file", self.lastdir, "Text files (*.txt)")
+        file = QFileDialog.getOpenFileName(self, "Open file", self.lastdir, self.fileFilters())
         filename = file[0]
         
         lastslash = filename.rfind("/")
         self.lastdir = filename[:lastslash + 1]
         
         if os.path.isfile(filename):
-            with open(filename, "r") as file:
-                lines = file.readlines()
-                n_prev_meas = len(self.prev_measurements)
-
-                line0 = lines[0].strip("\n")
-                fields0 = line0.split("\t")
-                n_meas = int(np.floor(len(fields0)/3))
-                for i in range(n_meas):
-                    self.prev_measurements.append([])
-                    self.prev_timestamps.append([])
-                    self.prev_xaxis.append([])
-
-                for i in range(1, len(lines)):
-                    line = lines[i].strip("\n")
-                    fields = line.split("\t")
-                    for j in range(len(fields)):
-                        if j % 3 == 0:
-                            self.prev_timestamps[n_prev_meas + int(np.floor(j/3))].append(float(fields[j]))
-                        if j % 3 == 1:
-                            self.prev_xaxis[n_prev_meas + int(np.floor(j/3))].append(float(fields[j]))
-                        if j % 3 == 2:
-                            self.prev_measurements[n_prev_meas + int(np.floor(j/3))].append(float(fields[j]))
-                file.close()
+            # Reference files are cached, so loading the same one again is instant
+            store, meta = measfile.loadCached(filename)
+            store.moveTo(self.prev_sweeps)
         self.plotFinal()
         self.statusbar.showMessage(f"Data loaded!")
 
+    def openArchive(self):
+        if self.archive is None:
+            self.archive = archive.SweepArchive()
+        return self.archive
+
+    def archiveSweeps(self, sweeps, meta, label):
+        try:
+            self.openArchive().add(sweeps, meta, label=label)
+        except Exception as e:
+            self.statusbar.showMessage(f"Could not archive the sweeps: {e}")
+
+    def loadArchived(self):
+        # Memory-mapped, so only what is plotted is read from disk
+        self.statusbar.showMessage(f"Loading archived sweeps...")
+        try:
+            rows = self.openArchive().query(slot=self.slotSpin.value(),
+                                            wl=(self.startSpin.value(), self.stopSpin.value()),
+                                            limit=self.archive_load)
+        except Exception as e:
+            self.statusbar.showMessage(f"Could not read the archive: {e}")
+            return
+        self.archive.sweeps(rows).moveTo(self.prev_sweeps)
+        self.plotFinal()
+        self.statusbar.showMessage(f"{len(rows)} archived sweeps loaded")
+
     def saveSettings(self):
-        settings_dict = {}
-        settings_dict["__lastdir__"] = self.lastdir
+        widgets = {}
         for w in self.findChildren(QSpinBox):
-            settings_dict[w.objectName()] = w.value()
+            widgets[w.objectName()] = w.value()
         for w in self.findChildren(QDoubleSpinBox):
-            settings_dict[w.objectName()] = w.value()
+            widgets[w.objectName()] = w.value()
         for w in self.findChildren(QCheckBox):
-            settings_dict[w.objectName()] = w.isChecked()
+            widgets[w.objectName()] = w.isChecked()
+
+        self.recipes.gui = {"lastdir": self.lastdir, "recipe": self.recipeCombo.currentText(), "widgets": widgets}
+        try:
+            self.recipes.save()
+        except:
+            self.statusbar.showMessage(f"Could not save the settings to {self.recipes.path}")
 
-        pickle.dump(settings_dict, open(self.settingsfile, "wb"))
-        
     def loadSettings(self):
+        try:
+            self.recipes.load()
+        except:
+            self.statusbar.showMessage(f"Could not read the settings in {self.recipes.path}")
+            return
+        gui = self.recipes.gui
+        self.lastdir = gui.get("lastdir") or self.lastdir
+        for key, value in gui.get("widgets", {}).items():
+            w = self.findChild(QWidget, key)
+            if isinstance(w, (QSpinBox, QDoubleSpinBox)):
+                w.setValue(value)
+            elif isinstance(w, QCheckBox):
+                w.setChecked(value)
+        self.updateRecipeList(gui.get("recipe", ""))
+
+    def updateRecipeList(self, current=""):
+        self.recipeCombo.clear()
+        self.recipeCombo.addItems(self.recipes.names())
+        self.recipeCombo.setCurrentText(current)
+
+    def widgetRecipe(self, name):
+        return recipes.Recipe(name=name, start=self.startSpin.value(), stop=self.stopSpin.value(),
+                              speed=self.speedSpin.value(), slot=self.slotSpin.value(),
+                              sweeps=self.sweepsSpin.value(), address=self.addrSpin.value(),
+                              hwlog=self.hwlogCheck.isChecked(), logstep=self.stepSpin.value(),
+                              turnoff=self.turnoffCheck.isChecked())
+
+    def applyRecipe(self, name):
+        if name not in self.recipes.recipes:
+            return
+        recipe = self.recipes.get(name)
+        self.startSpin.setValue(recipe.start)
+        self.stopSpin.setValue(recipe.stop)
+        self.speedSpin.setValue(recipe.speed)
+        self.slotSpin.setValue(recipe.slot)
+        self.sweepsSpin.setValue(recipe.sweeps)
+        self.addrSpin.setValue(recipe.address)
+        self.hwlogCheck.setChecked(recipe.hwlog)
+        self.stepSpin.setValue(recipe.logstep)
+        self.turnoffCheck.setChecked(recipe.turnoff)
+        self.statusbar.showMessage(f"Recipe '{name}' loaded")
+        if recipe.address != self.address and self.engine is not None and not self.measTimer.isActive():
+            # Another laser: reconnect at the recipe's address
+            self.engine.close(devices=True)
+            self.engine = None
+            self.InitializeDevices()
+
+    def saveRecipe(self):
+        name = self.recipeCombo.currentText().strip()
+        if name == "":
+            self.statusbar.showMessage(f"Type a name for the recipe first")
+            return
+        self.recipes.put(self.widgetRecipe(name))
+        self.updateRecipeList(name)
+        self.saveSettings()
+        self.statusbar.showMessage(f"Recipe '{name}' saved")
+
+    def deleteRecipe(self):
+        name = self.recipeCombo.currentText().strip()
+        if name in self.recipes.recipes:
+            self.recipes.remove(name)
+            self.updateRecipeList()
+            self.saveSettings()
+            self.statusbar.showMessage(f"Recipe '{name}' deleted")
+
+    def recoverCheckpoint(self):
         lastslash = self.fullpath.rfind("/")
-        path = self.fullpath[:lastslash + 1] + self.settingsfile
-
-        if os.path.isfile(path):
-            settings_dict = pickle.load(open(path, "rb"))
-            if "__lastdir__" in settings_dict:
-                self.lastdir = settings_dict["__lastdir__"]
-            for key in settings_dict:
-                if key[:2] != "__" and key[-2:] != "__":
-                    w = self.findChild(QWidget, key)
-                    if "Spin" in key:
-                        w.setValue(settings_dict[key])
-                    if "Check" in key:
-                        w.setChecked(settings_dict[key])
+        path = self.fullpath[:lastslash + 1] + self.tempfile
+        if checkpoint.isIncomplete(path):
+            try:
+                self.engine.sweeps = checkpoint.recover(path)
+                processing.wavelengthAxes(self.engine.sweeps)
+                self.plotFinal()
+                self.statusbar.showMessage(f"Recovered {len(self.engine.sweeps)} sweeps from an interrupted run")
+            except:
+                self.statusbar.showMessage(f"Could not recover the interrupted run in {self.tempfile}")
 
     def CloseDevices(self):
+        if self.engine is None:
+            return
         if self.turnoffCheck.isChecked():
             self.laser.disableAll()
-        self.laser.closelaser()
-        self.pm.close()
+        self.engine.close(devices=True)
         self.statusbar.showMessage(f"Devices closed")
 
     def closeEvent(self, event):
         self.saveSettings()
         self.CloseDevices()
+        if self.archive is not None:
+            self.archive.close()
 
 #Run
 if __name__ == "__main__":
 
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--simulate", action="store_true", help="use simulated instruments")
+    parser.add_argument("--sim-latency", type=float, default=0.0, help="simulated latency per call (s)")
+    parser.add_argument("--sim-noise", type=float, default=1e-3, help="simulated power noise (mW)")
+    parser.add_argument("--sim-seed", type=int, default=0, help="simulation random seed")
+    args, qtargs = parser.parse_known_args()
+    MainWindow.simulate = args.simulate
+    MainWindow.sim_options = {"latency": args.sim_latency, "noise_mw": args.sim_noise, "seed": args.sim_seed}
+
+    app = QApplication(sys.argv[:1] + qtargs)
     window = MainWindow()
 
     sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Background acquisition of power meter samples.
+
+The acquisition thread owns the power meter while sampling. Every reading is
+timestamped with time.perf_counter() at the midpoint of its round-trip and
+pushed into a RingBuffer, together with the time the read took, which the
+GUI drains on its own schedule.
+"""
+
+import time
+import numpy as np
+from threading import Thread, Event
+
+
+class RingBuffer:
+    # Single producer / single consumer buffer of (timestamp, value, latency) samples.
+    # The producer only ever moves `head` and the consumer only ever moves `tail`,
+    # and each index is published after the data it covers, so no lock is needed.
+
+    def __init__(self, size=2**20):
+        self.size = size
+        self.times = np.zeros(size, dtype=np.float64)
+        self.values = np.zeros(size, dtype=np.float64)
+        self.latencies = np.zeros(size, dtype=np.float64)
+        self.head = 0
+        self.tail = 0
+        self.overruns = 0
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def push(self, t, value, latency=0.0):
+        if self.head - self.tail >= self.size:
+            self.overruns += 1
+            return False
+        i = self.head % self.size
+        self.times[i] = t
+        self.values[i] = value
+        self.latencies[i] = latency
+        self.head += 1
+        return True
+
+    def drain(self, latency=False):
+        # (times, values), or (times, values, latencies) with latency=True
+        head = self.head
+        tail = self.tail
+        n = head - tail
+        i0 = tail % self.size
+        i1 = i0 + n
+        columns = (self.times, self.values, self.latencies) if latency else (self.times, self.values)
+        if i1 <= self.size:
+            out = tuple(col[i0:i1].copy() for col in columns)
+        else:
+            i1 -= self.size
+            out = tuple(np.concatenate((col[i0:], col[:i1])) for col in columns)
+        self.tail = head
+        return out
+
+    def clear(self):
+        self.tail = self.head
+        self.overruns = 0
+
+
+class AcquisitionThread(Thread):
+    # Calls `readfunc` as fast as it returns while sampling is enabled.
+
+    def __init__(self, readfunc, bufsize=2**20):
+        super(AcquisitionThread, self).__init__(daemon=True)
+        self.readfunc = readfunc
+        self.buffer = RingBuffer(bufsize)
+        self.sampling = Event()
+        self.idle = Event()
+        self.idle.set()
+        self.stopped = False
+        self.n_samples = 0
+        self.first_t = 0.0
+        self.last_t = 0.0
+        self.max_gap = 0.0
+
+    def run(self):
+        while not self.stopped:
+            if not self.sampling.wait(0.05):
+                continue
+            self.idle.clear()
+            while self.sampling.is_set() and not self.stopped:
+                t1 = time.perf_counter()
+                try:
+                    value = self.readfunc()
+                except:
+                    value = np.nan
+                t2 = time.perf_counter()
+                # The reading was taken somewhere between t1 and t2; the midpoint is the best guess
+                t = 0.5*(t1 + t2)
+                self.buffer.push(t, value, t2 - t1)
+                if self.n_samples > 0:
+                    gap = t - self.last_t
+                    if gap > self.max_gap:
+                        self.max_gap = gap
+                else:
+                    self.first_t = t
+                self.last_t = t
+                self.n_samples += 1
+            self.idle.set()
+
+    def startSampling(self):
+        self.pauseSampling()
+        self.buffer.clear()
+        self.n_samples = 0
+        self.max_gap = 0.0
+        self.sampling.set()
+
+    def pauseSampling(self, timeout=5.0):
+        # Returns once the current read (if any) has finished, so the caller can
+        # safely talk to the instrument afterwards.
+        self.sampling.clear()
+        return self.idle.wait(timeout)
+
+    def stop(self):
+        self.stopped = True
+        self.sampling.clear()
+        self.idle.wait(5.0)
+
+    def rate(self):
+        if self.n_samples < 2 or self.last_t <= self.first_t:
+            return 0.0
+        return (self.n_samples - 1)/(self.last_t - self.first_t)
+
+    def worstGap(self):
+        return self.max_gap
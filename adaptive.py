@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive region-of-interest sweeps.
+
+Instead of repeating the full span, AdaptiveSweep runs one fast coarse sweep,
+takes the dips/peaks found in it as regions of interest, and sweeps each
+region slowly and narrowly until the noise of the averaged trace falls below
+a target (or max_sweeps is reached):
+
+    COARSE   one sweep over start..stop at coarse_speed
+    FINE     sweeps over each region at fine_speed, one region at a time
+    DONE     engine.sweeps holds the coarse sweep followed by every fine sweep
+
+Like SweepEngine it is driven by poll(), from a GUI timer or from run().
+
+    python adaptive.py --start 1540 --stop 1560 --coarse-speed 20 --fine-speed 1 -o dev.h5
+"""
+
+import os, sys, time, json, argparse
+import numpy as np
+from dataclasses import dataclass, replace
+
+import features
+import measfile
+import processing
+import sweepengine
+import sweepstore
+
+
+@dataclass
+class AdaptiveParams:
+    coarse_speed: float = 10.0
+    fine_speed: float = 1.0
+    target_noise: float = 0.05
+    min_sweeps: int = 2
+    max_sweeps: int = 10
+    margin: float = 5.0
+    min_span: float = 0.05
+    guard: float = 0.03
+
+
+class Region:
+
+    def __init__(self, start, stop, centers):
+        self.start = start
+        self.stop = stop
+        self.centers = centers
+        self.sweeps = sweepstore.SweepStore()
+        self.average = None
+        self.noise = np.inf
+        self.features = None
+
+    def summary(self):
+        return {"start": self.start, "stop": self.stop, "centers": self.centers, "sweeps": len(self.sweeps),
+                "noise_db": self.noise, "features": self.features}
+
+
+def findRegions(result, start, stop, margin=5.0, min_span=0.05, guard=0.0):
+    # Windows of +-margin FWHM (at least min_span wide, plus guard nm on each side) around
+    # every feature, merged where they overlap and clipped to the sweep range
+    found = result["dips"] + result["peaks"] if result is not None else []
+    windows = []
+    for f in sorted(found, key=lambda f: f["center_wl"]):
+        half = margin*f["fwhm_nm"] if np.isfinite(f["fwhm_nm"]) else 0.0
+        half = max(half, 0.5*min_span) + guard
+        windows.append([max(start, f["center_wl"] - half), min(stop, f["center_wl"] + half), [f["center_wl"]]])
+    regions = []
+    for w in windows:
+        if len(regions) > 0 and w[0] <= regions[-1][1]:
+            regions[-1][1] = max(regions[-1][1], w[1])
+            regions[-1][2] += w[2]
+        else:
+            regions.append(w)
+    return [Region(a, b, c) for a, b, c in regions if b > a]
+
+
+def traceNoise(average):
+    # Typical standard error (dB) of the averaged trace
+    if average is None or average.n < 2:
+        return np.inf
+    return float(np.median(average.std)/np.sqrt(average.n))
+
+
+class AdaptiveSweep:
+
+    IDLE = 0
+    COARSE = 1
+    FINE = 2
+    DONE = 3
+
+    def __init__(self, engine, adaptive=None):
+        self.engine = engine
+        self.adaptive = adaptive if adaptive is not None else AdaptiveParams()
+        self.params = sweepengine.SweepParams()
+        self.state = self.IDLE
+        self.coarse = None
+        self.regions = []
+        self.region_i = 0
+        self.starttime = 0.0
+        self.elapsed = 0.0
+        self.engine_done = None
+        self.onDone = None
+        self.onStatus = None
+
+    def status(self, msg):
+        if self.onStatus is not None:
+            self.onStatus(msg)
+
+    def start(self, params):
+        # params gives the full range, slot and feature settings; speeds and repeats come
+        # from the AdaptiveParams
+        self.params = params
+        self.coarse = None
+        self.regions = []
+        self.region_i = 0
+        self.starttime = time.perf_counter()
+        self.state = self.COARSE
+        # The engine finishes once per sweep here; only the whole run reports done
+        self.engine_done = self.engine.onDone
+        self.engine.onDone = None
+        self.engine.start(replace(params, speed=self.adaptive.coarse_speed, sweeps=1))
+
+    def poll(self):
+        if self.state not in (self.COARSE, self.FINE):
+            return 0
+        n = self.engine.poll()
+        if self.engine.state == self.engine.DONE:
+            if self.state == self.COARSE:
+                self.coarseDone()
+            else:
+                self.fineDone()
+        return n
+
+    def coarseDone(self):
+        p = self.params
+        a = self.adaptive
+        self.coarse = self.engine.sweeps.last() if len(self.engine.sweeps) > 0 else None
+        if self.coarse is None:
+            self.finish()
+            return
+        # The coarse axis comes from launch/stop timing, which is off by up to
+        # coarse_speed*guard without the wavelength log
+        guard = 0.0 if p.hwlog else a.coarse_speed*a.guard
+        self.regions = findRegions(self.coarse.features, min(p.start, p.stop), max(p.start, p.stop),
+                                   a.margin, a.min_span, guard)
+        if len(self.regions) == 0:
+            self.status(f"No features found in the coarse sweep")
+            self.finish()
+            return
+        self.status(f"{len(self.regions)} regions of interest")
+        self.startRegion()
+
+    def startRegion(self):
+        region = self.regions[self.region_i]
+        self.state = self.FINE
+        # The fine sweeps continue the coarse sweep's run, so the profile and checkpoint cover all of them
+        self.engine.resume(replace(self.params, start=region.start, stop=region.stop,
+                                  speed=self.adaptive.fine_speed, sweeps=1))
+
+    def fineDone(self):
+        a = self.adaptive
+        region = self.regions[self.region_i]
+        self.engine.sweeps.moveTo(region.sweeps)
+        if len(region.sweeps) > 1:
+            region.average = processing.averageSweeps(region.sweeps)
+            region.noise = traceNoise(region.average)
+        self.status(f"Region {self.region_i + 1}/{len(self.regions)}: {len(region.sweeps)} sweeps, "
+                    f"noise {region.noise:.3f} dB")
+
+        if len(region.sweeps) < a.max_sweeps and (len(region.sweeps) < a.min_sweeps or region.noise > a.target_noise):
+            self.startRegion()
+            return
+        region.features = regionFeatures(region, self.params, a.fine_speed)
+        self.region_i += 1
+        if self.region_i < len(self.regions):
+            self.startRegion()
+        else:
+            self.finish()
+
+    def stop(self):
+        # Aborts the run, keeping what was measured so far
+        if self.state not in (self.COARSE, self.FINE):
+            return
+        self.engine.stop()
+        if self.state == self.COARSE:
+            self.coarse = self.engine.sweeps.last() if len(self.engine.sweeps) > 0 else None
+        else:
+            self.engine.sweeps.moveTo(self.regions[self.region_i].sweeps)
+        self.finish()
+
+    def finish(self):
+        # The engine ends up holding every sweep of the run, coarse first
+        self.elapsed = time.perf_counter() - self.starttime
+        store = sweepstore.SweepStore()
+        if self.coarse is not None:
+            store.add(self.coarse)
+        for region in self.regions:
+            for sweep in region.sweeps:
+                store.add(sweep)
+        self.engine.sweeps = store
+        self.engine.average = None
+        self.engine.onDone = self.engine_done
+        self.state = self.DONE
+        self.status(f"Adaptive measurement done in {self.elapsed:.1f} s "
+                    f"({self.fullEquivalent():.1f} s for the same repeats over the full span)")
+        if self.onDone is not None:
+            self.onDone()
+
+    def fullEquivalent(self):
+        # Sweep time of max(repeats) full-span sweeps at the fine speed, without dead time
+        repeats = max([len(r.sweeps) for r in self.regions] + [1])
+        return repeats*abs(self.params.stop - self.params.start)/self.adaptive.fine_speed
+
+    def run(self, params, poll_interval=0.02):
+        self.start(params)
+        while self.state in (self.COARSE, self.FINE):
+            time.sleep(poll_interval)
+            self.poll()
+        return self.engine.sweeps
+
+    def summary(self):
+        return {"elapsed_s": self.elapsed, "full_span_equivalent_s": self.fullEquivalent(),
+                "adaptive": self.adaptive.__dict__, "coarse_features": self.coarse.features if self.coarse else None,
+                "regions": [r.summary() for r in self.regions]}
+
+    def save(self, path):
+        # All sweeps in one file, plus <name>_roi<k>_avg.txt per region and <name>_adaptive.json
+        self.engine.save(path)
+        base = os.path.splitext(path)[0]
+        for k, region in enumerate(self.regions):
+            if region.average is not None:
+                measfile.saveAverage(f"{base}_roi{k}.txt", region.average)
+        with open(base + "_adaptive.json", "w") as file:
+            json.dump(self.summary(), file, indent=1)
+
+
+def regionFeatures(region, params, speed):
+    # Features of the region's averaged trace, or of its only sweep
+    if region.average is None:
+        sweep = region.sweeps.last()
+        return features.extract(sweep, params.feature_resolution, params.feature_prominence)
+    wl = region.average.wl
+    t = (wl - wl[0])/speed
+    sweep = sweepstore.Sweep.fromArrays(t, wl, region.average.mean, launchwl=wl[0], stopwl=wl[-1],
+                                        stoptime=t[-1], speed=speed)
+    return features.extract(sweep, params.feature_resolution, params.feature_prominence)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Coarse sweep, then slow sweeps over the features found")
+    parser.add_argument("--start", type=float, required=True, help="start wavelength (nm)")
+    parser.add_argument("--stop", type=float, required=True, help="stop wavelength (nm)")
+    parser.add_argument("--coarse-speed", type=float, default=10.0, help="coarse sweep speed (nm/s)")
+    parser.add_argument("--fine-speed", type=float, default=1.0, help="region sweep speed (nm/s)")
+    parser.add_argument("--target-noise", type=float, default=0.05, help="stop repeating below this noise (dB)")
+    parser.add_argument("--max-sweeps", type=int, default=10, help="most sweeps per region")
+    parser.add_argument("--margin", type=float, default=5.0, help="region half width, in FWHM")
+    parser.add_argument("--min-span", type=float, default=0.05, help="narrowest region (nm)")
+    parser.add_argument("--guard", type=float, default=0.03,
+                        help="coarse sweep timing uncertainty (s), widens the regions without --hwlog")
+    parser.add_argument("--hwlog", action="store_true", help="use the laser's lambda logging")
+    parser.add_argument("--prominence", type=float, default=3.0, help="feature prominence (dB)")
+    parser.add_argument("--slot", type=int, default=0, help="laser slot")
+    parser.add_argument("--address", type=int, default=17, help="laser GPIB address")
+    parser.add_argument("-o", "--output", required=True, help="output file (.txt, .h5 or .npz)")
+    parser.add_argument("--simulate", action="store_true", help="use simulated instruments")
+    parser.add_argument("--sim-seed", type=int, default=0, help="simulation random seed")
+    args = parser.parse_args(argv)
+
+    laser, pm = sweepengine.openDevices(args.address, args.simulate, {"seed": args.sim_seed})
+    if not laser.laserOK or not pm.ok:
+        print("Could not open the instruments")
+        return 1
+
+    params = sweepengine.SweepParams(start=args.start, stop=args.stop, slot=args.slot,
+                                     hwlog=args.hwlog, feature_prominence=args.prominence)
+    adaptive = AdaptiveParams(coarse_speed=args.coarse_speed, fine_speed=args.fine_speed,
+                              target_noise=args.target_noise, max_sweeps=args.max_sweeps,
+                              margin=args.margin, min_span=args.min_span, guard=args.guard)
+    engine = sweepengine.SweepEngine(laser, pm)
+    sweeper = AdaptiveSweep(engine, adaptive)
+    sweeper.onStatus = print
+    try:
+        sweeper.run(params)
+        sweeper.save(args.output)
+        for k, region in enumerate(sweeper.regions):
+            print(f"Region {k}: {region.start:.4f}-{region.stop:.4f} nm, {len(region.sweeps)} sweeps")
+            print(features.describe(region.features))
+    finally:
+        engine.close(devices=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
-import visa
 import numpy as np
 
+import scpiblock
+import visasession
+
 
 class Agilent816xb:
     # definitions
@@ -12,127 +14,179 @@ class Agilent816xb:
     gpibAddr = 17
     ip = "192.168.1.2"
     port = 10001
-    visarm = None
-    visaOK = False
-    laser = None
-    laserOK = False
+    session = None
     laserID = ""
+    resource = ""
+    # ms allowed for opening the instrument and answering *IDN?, so an instrument
+    # that is off fails quickly instead of after the full VISA timeout
+    probe_timeout = 2000
 
     # main functions
     def __init__(self):
-        try:
-            self.visarm = visa.ResourceManager('@ni')
-            self.visaOK = True
-        except:
-            print("Error creating VISA Resource Manager! Is the GPIB Card connected?")
-            pass
-        if not self.visaOK:
-            try:
-                self.visarm = visa.ResourceManager('@py')
-                self.visaOK = True
-            except:
-                print("Error creating VISA Resource Manager! Is the GPIB Card connected?")
-                pass
+        True
 
     def __del__(self):
         self.closelaser()
         return 0
 
+    @property
+    def laserOK(self):
+        return self.session is not None and self.session.ok
+
     # laser functions
 
     def connectlaser(self, isgpib=True, address=17, iseth=False, ethip="192.168.1.2", ethport=10001):
-        if self.visaOK:
-            self.gpib = isgpib
-            self.gpibAddr = address
-            self.eth = iseth
-            self.ip = ethip
-            self.port = ethport
-            try:
-                if self.gpib:
-                    lasername = "GPIB0::" + str(self.gpibAddr) + "::INSTR"
-                    self.laser = self.visarm.open_resource(lasername)
-                # elif self.eth:
-                #     osaname = "TCPIP0::" + self.ip + "::" + str(self.port) + "::SOCKET"
-                #     self.laser = self.visarm.open_resource(osaname, read_termination="\r\n", timeout=5000)
-                #     self.laser.query('open "' + self.user + '"')
-                #     self.laser.query(self.passwd)
-                if "816" in self.laser.query("*IDN?"):
-                    self.laserOK = True
-                else:
-                    print("Error opening lasererator! Is it connected?")
-            except:
-                print("Error opening lasererator! Is it connected?")
-                pass
+        self.gpib = isgpib
+        self.gpibAddr = address
+        self.eth = iseth
+        self.ip = ethip
+        self.port = ethport
+        self.closelaser()
+        if self.gpib:
+            lasername = "GPIB0::" + str(self.gpibAddr) + "::INSTR"
+        # elif self.eth:
+        #     osaname = "TCPIP0::" + self.ip + "::" + str(self.port) + "::SOCKET"
+        #     self.laser = self.visarm.open_resource(osaname, read_termination="\r\n", timeout=5000)
+        #     self.laser.query('open "' + self.user + '"')
+        #     self.laser.query(self.passwd)
+        else:
+            # Only GPIB is supported for now
+            print("Error opening lasererator! Only GPIB connections are supported")
+            return
+        session = visasession.Session(lasername, self.probe_timeout)
+        if session.open() and "816" in session.idn:
+            self.session = session
+            self.laserID = session.idn
+            self.resource = lasername
+        else:
+            session.close()
+            print("Error opening lasererator! Is it connected?")
 
     def initlaser(self):
         return 0
 
+    def write(self, cmd):
+        if self.session is not None:
+            self.session.write(cmd)
+
+    def query(self, cmd, default=None):
+        if self.session is None:
+            return default
+        return self.session.query(cmd, default)
+
+    def configure(self, cmds):
+        # Settings that only need to be sent when they change
+        if self.session is not None:
+            self.session.configure(cmds)
+
+    def forgetSettings(self):
+        # Sends every setting again next time, e.g. after someone used the front panel
+        if self.session is not None:
+            self.session.forget()
+
+    def setOutputs(self, cmds):
+        # Output on/off is always sent, never skipped by the shadow state: the front panel
+        # may have changed it, and turning the laser off has to work. One message per command,
+        # so an error on an empty slot can't drop the commands after it.
+        for cmd in cmds:
+            self.write(cmd)
+
     def enableAll(self):
-        for i in range(0, 5):
-             self.setState(i, True)
+        self.setOutputs([f":sour{i}:pow:stat 1" for i in range(0, 5)])
 
     def disableAll(self):
-        for i in range(0, 5):
-             self.setState(i, False)
+        self.setOutputs([f":sour{i}:pow:stat 0" for i in range(0, 5)])
+
+    def queryBlock(self, cmd, datatype='d', npoints=None):
+        # Binary block transfer straight into a NumPy array (little endian)
+        if self.session is None:
+            return np.zeros(0)
+        return self.session.call(lambda inst: scpiblock.queryBlock(inst, cmd, datatype, False, npoints),
+                                 np.zeros(0))
 
     def closelaser(self):
-        if self.laserOK:
-            self.laserOK = False
-            self.laser.close()
+        if self.session is not None:
+            self.session.close()
+            self.session = None
 
     def getWL(self, slot):
-        if self.laserOK:
-            resp = self.laser.query(f":sour{slot}:wav?")
-            wl = float(resp)*1e9
-            return wl
-        else:
+        resp = self.query(f":sour{slot}:wav?")
+        if resp is None:
             return float(0.0)
+        return float(resp)*1e9
 
     def setWL(self, slot, wl):
-        if self.laserOK:
-            self.laser.write(f"sour{slot}:wav {wl*1e-9}")
+        # Never skipped: the wavelength moves during every sweep
+        self.write(f":sour{slot}:wav {wl*1e-9}")
 
     def getPwr(self, slot):
-        if self.laserOK:
-            pwr = float(self.laser.query(f":sour{slot}:pow?"))
-            return pwr
-        else:
+        resp = self.query(f":sour{slot}:pow?")
+        if resp is None:
             return -99.99
+        return float(resp)
 
     def setPwr(self, slot, pwr):
-        if self.laserOK:
-            self.laser.write(f":sour{slot}:pow {pwr}")
+        self.configure([f":sour{slot}:pow {pwr}"])
 
     def getState(self, slot):
-        if self.laserOK:
-            resp = self.laser.query(f":sour{slot}:pow:stat?")
-            if "0" in resp:
-                return False
-            else:
-                return True
-        else:
+        resp = self.query(f":sour{slot}:pow:stat?")
+        if resp is None or "0" in resp:
             return False
+        else:
+            return True
 
     def setState(self, slot, onoff):
-        if self.laserOK:
-            if onoff:
-                self.laser.write(f":sour{slot}:pow:stat 1")
-            else:
-                self.laser.write(f":sour{slot}:pow:stat 0")
+        if onoff:
+            self.setOutputs([f":sour{slot}:pow:stat 1"])
+        else:
+            self.setOutputs([f":sour{slot}:pow:stat 0"])
 
     def setSweep(self, slot, mode, start, stop, step, cycles, dwell, speed):
-        if self.laserOK:
-            if mode != "CONT" and mode != "STEP":
-                mode = "CONT"
-            self.laser.write(f":sour{slot}:wav:swe:mode {mode}")
-            self.laser.write(f":sour{slot}:wav:swe:start {start}nm")
-            self.laser.write(f":sour{slot}:wav:swe:stop {stop}nm")
-            self.laser.write(f":sour{slot}:wav:swe:step {step}nm")
-            self.laser.write(f":sour{slot}:wav:swe:cycl {cycles}")
-            self.laser.write(f":sour{slot}:wav:swe:dwel {dwell}ms")
-            self.laser.write(f":sour{slot}:wav:swe:spe {speed}nm/s")
+        # One transaction, and only for the parameters that changed since the last sweep
+        if mode != "CONT" and mode != "STEP":
+            mode = "CONT"
+        self.configure([f":sour{slot}:wav:swe:mode {mode}",
+                        f":sour{slot}:wav:swe:start {start}nm",
+                        f":sour{slot}:wav:swe:stop {stop}nm",
+                        f":sour{slot}:wav:swe:step {step}nm",
+                        f":sour{slot}:wav:swe:cycl {cycles}",
+                        f":sour{slot}:wav:swe:dwel {dwell}ms",
+                        f":sour{slot}:wav:swe:spe {speed}nm/s"])
 
     def setSweepState(self, slot, state):
-        if self.laserOK:
-            options = ["Stop", "Start", "Pause (Stepped)", "Continue (Stepped)"]
-            self.laser.write(f":sour{slot}:wav:swe:stat {options.index(state)}")
\ No newline at end of file
+        options = ["Stop", "Start", "Pause (Stepped)", "Continue (Stepped)"]
+        self.write(f":sour{slot}:wav:swe:stat {options.index(state)}")
+
+    def getSweepState(self, slot):
+        resp = self.query(f":sour{slot}:wav:swe:stat?")
+        if resp is None:
+            return 0
+        return int(resp)
+
+    def setTriggerOutput(self, slot, mode):
+        # STF (step finished) is what lambda logging needs
+        options = ["DIS", "AVG", "MEAS", "MOD", "STF", "SWF", "SWST"]
+        if mode not in options:
+            mode = "DIS"
+        self.configure([f":trig{slot}:outp {mode}"])
+
+    def setLambdaLogging(self, slot, onoff):
+        # Logs the actual wavelength of every sweep step; needs a continuous sweep
+        # and the trigger output set to STF
+        if onoff:
+            self.configure([f":sour{slot}:wav:swe:llog 1"])
+        else:
+            self.configure([f":sour{slot}:wav:swe:llog 0"])
+
+    def getLoggedPoints(self, slot):
+        resp = self.query(f":sour{slot}:read:poin? llog")
+        if resp is None:
+            return 0
+        return int(resp)
+
+    def getLoggedWL(self, slot):
+        # Wavelengths (nm) logged during the last sweep, downloaded as one binary block
+        npoints = self.getLoggedPoints(slot)
+        if npoints == 0:
+            return np.zeros(0)
+        return self.queryBlock(f":sour{slot}:read:data? llog", 'd', npoints)*1e9
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk archive of sweeps with a searchable index.
+
+    python archive.py add run1.h5 run2.npz --label "ring 1550"
+    python archive.py list --wl 1550.2 --since 2026-10-01
+    python archive.py diff --reference 12 --label "ring 1550" -o diff.txt
+    python archive.py drift --wl 1550.2 --label "ring 1550"
+
+Every sweep is stored as one .npy file (rows t, wl, pwr) under
+<archive>/data/<yyyy-mm>/ and opened memory-mapped, so a sweep costs nothing
+until its samples are used, and then only the pages that are touched are
+read. An SQLite index (index.db) has one row per sweep with its date, slot,
+wavelength range, speed, instruments, source file and label, and one row per
+dip or peak found in it, so sweeps are looked up without opening them.
+
+Batch operations resample the selected sweeps onto one wavelength grid, one
+sweep at a time and reading only the part of it inside the grid, into an
+(n sweeps, n points) array that the comparisons then work on as a whole:
+difference() against a golden reference, and drift() of a dip wavelength
+over time. The array can be a np.memmap for batches too large for memory.
+"""
+
+import os, sys, time, json, sqlite3, argparse
+import numpy as np
+
+import sweepstore
+import measfile
+import features
+
+default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive")
+
+schema = """
+CREATE TABLE IF NOT EXISTS sweeps (
+    id INTEGER PRIMARY KEY, run INTEGER, sweep INTEGER, date TEXT, time REAL, slot INTEGER,
+    wl_min REAL, wl_max REAL, speed REAL, n INTEGER, laser_id TEXT, pm_id TEXT,
+    source TEXT, label TEXT, file TEXT, features TEXT);
+CREATE TABLE IF NOT EXISTS features (
+    sweep_id INTEGER, kind TEXT, center_wl REAL, depth_db REAL, fwhm_nm REAL, q REAL);
+CREATE INDEX IF NOT EXISTS sweeps_time ON sweeps (time);
+CREATE INDEX IF NOT EXISTS sweeps_wl ON sweeps (wl_min, wl_max);
+CREATE INDEX IF NOT EXISTS sweeps_label ON sweeps (label);
+CREATE INDEX IF NOT EXISTS features_wl ON features (center_wl);
+CREATE INDEX IF NOT EXISTS features_sweep ON features (sweep_id);
+"""
+
+
+class ArchivedSweep:
+    # Read-only sweep backed by a memory-mapped .npy file, opened on first access
+
+    def __init__(self, path, row):
+        self.path = path
+        self.row = row
+        self.id = row["id"]
+        self.n = row["n"]
+        self.speed = row["speed"]
+        self.data = None
+        self.launchtime = 0.0
+        self.launchwl = row["wl_min"]
+        self.stoptime = 0.0
+        self.stopwl = row["wl_max"]
+
+    def __len__(self):
+        return self.n
+
+    def open(self):
+        if self.data is None:
+            self.data = np.load(self.path, mmap_mode="r")
+        return self.data
+
+    @property
+    def t(self):
+        return self.open()[0]
+
+    @property
+    def wl(self):
+        return self.open()[1]
+
+    @property
+    def pwr(self):
+        return self.open()[2]
+
+    @property
+    def features(self):
+        return json.loads(self.row["features"]) if self.row["features"] else None
+
+    def nbytes(self):
+        return 0
+
+
+class SweepArchive:
+
+    def __init__(self, path=default_path):
+        self.path = path
+        os.makedirs(os.path.join(path, "data"), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, "index.db"))
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM sweeps").fetchone()[0]
+
+    def add(self, sweeps, meta=None, source="", label=""):
+        # Archives the sweeps of one run and returns their ids. meta is the run metadata
+        # of a measurement file or SweepEngine.meta().
+        meta = meta or {}
+        date = str(meta.get("date", time.strftime("%Y-%m-%dT%H:%M:%S")))
+        runtime = parseTime(date)
+        runfeatures = json.loads(meta["features"]) if "features" in meta else []
+        sweeps = list(sweeps)
+        t0 = sweeps[0].launchtime if len(sweeps) > 0 else 0.0
+        ids = []
+        with self.db:
+            run = self.db.execute("SELECT COALESCE(MAX(run), 0) + 1 FROM sweeps").fetchone()[0]
+            for i, sweep in enumerate(sweeps):
+                if len(sweep) == 0:
+                    continue
+                found = getattr(sweep, "features", None)
+                if found is None and i < len(runfeatures):
+                    found = runfeatures[i]
+                if found is None and len(sweep) > 1:
+                    try:
+                        found = features.extract(sweep)
+                    except:
+                        found = None
+                wl = np.asarray(sweep.wl)
+                speed = getattr(sweep, "speed", 0.0) or float(meta.get("speed", 0.0))
+                cursor = self.db.execute(
+                    "INSERT INTO sweeps (run, sweep, date, time, slot, wl_min, wl_max, speed, n, laser_id, pm_id, "
+                    "source, label, features) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (run, i, date, runtime + float(sweep.launchtime - t0), int(meta.get("slot", 0)),
+                     float(np.nanmin(wl)), float(np.nanmax(wl)), float(speed), len(sweep),
+                     str(meta.get("laser_id", "")), str(meta.get("pm_id", "")), source, label,
+                     json.dumps(found) if found is not None else None))
+                id = cursor.lastrowid
+                file = os.path.join("data", date[:7], f"{id}.npy")
+                writeSweep(os.path.join(self.path, file), sweep)
+                self.db.execute("UPDATE sweeps SET file = ? WHERE id = ?", (file, id))
+                if found is not None:
+                    self.db.executemany(
+                        "INSERT INTO features (sweep_id, kind, center_wl, depth_db, fwhm_nm, q) VALUES (?, ?, ?, ?, ?, ?)",
+                        [(id, kind, f["center_wl"], f["depth_db"], f["fwhm_nm"], f["q"])
+                         for kind in ("dips", "peaks") for f in found[kind]])
+                ids.append(id)
+        return ids
+
+    def addFile(self, path, label=""):
+        store, meta = measfile.load(path)
+        return self.add(store, meta, os.path.abspath(path), label)
+
+    def remove(self, ids):
+        with self.db:
+            for id in ids:
+                row = self.db.execute("SELECT file FROM sweeps WHERE id = ?", (id,)).fetchone()
+                if row is None:
+                    continue
+                self.db.execute("DELETE FROM features WHERE sweep_id = ?", (id,))
+                self.db.execute("DELETE FROM sweeps WHERE id = ?", (id,))
+                try:
+                    os.remove(os.path.join(self.path, row["file"]))
+                except OSError:
+                    pass
+
+    def setLabel(self, ids, label):
+        with self.db:
+            self.db.executemany("UPDATE sweeps SET label = ? WHERE id = ?", [(label, id) for id in ids])
+
+    def query(self, since=None, until=None, slot=None, wl=None, speed=None, label=None, run=None,
+              feature=None, window=0.05, limit=None):
+        # Index rows of the matching sweeps, oldest first. wl is a wavelength the sweep must
+        # cover or a (min, max) range it must overlap; feature is a wavelength with a dip or
+        # peak within `window` nm; with limit only the newest `limit` sweeps are returned.
+        where, params = filters(since, until, slot, wl, speed, label, run, feature, window)
+        sql = "SELECT * FROM sweeps s" + where + " ORDER BY s.time DESC, s.id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        return self.db.execute(sql, params).fetchall()[::-1]
+
+    def get(self, id):
+        row = self.db.execute("SELECT * FROM sweeps WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            raise KeyError(f"No sweep {id} in the archive {self.path}")
+        return row
+
+    def open(self, row):
+        # ArchivedSweep for an index row or sweep id
+        if not isinstance(row, sqlite3.Row):
+            row = self.get(row)
+        return ArchivedSweep(os.path.join(self.path, row["file"]), row)
+
+    def sweeps(self, rows):
+        store = sweepstore.SweepStore()
+        for row in rows:
+            store.add(self.open(row))
+        return store
+
+    def grid(self, rows, npoints=4096):
+        # Grid over the wavelength range covered by every sweep, from the index alone
+        wl0 = max(row["wl_min"] for row in rows)
+        wl1 = min(row["wl_max"] for row in rows)
+        if wl1 <= wl0:
+            return None
+        return np.linspace(wl0, wl1, npoints)
+
+    def traces(self, rows, grid, out=None):
+        # (len(rows), len(grid)) array of the sweeps' power on the grid, nan where a sweep
+        # does not reach. out can be a np.memmap for batches too large for memory.
+        if out is None:
+            out = np.empty((len(rows), len(grid)), dtype=np.float64)
+        for i, row in enumerate(rows):
+            out[i] = resample(self.open(row), grid)
+        return out
+
+    def difference(self, reference, rows, grid=None, npoints=4096):
+        # Power difference (dB) of every sweep from a golden reference sweep (row or id),
+        # on the reference's range: (grid, differences, rms per sweep)
+        if not isinstance(reference, sqlite3.Row):
+            reference = self.get(reference)
+        if grid is None:
+            grid = np.linspace(reference["wl_min"], reference["wl_max"], npoints)
+        ref = resample(self.open(reference), grid)
+        diff = self.traces(rows, grid)
+        diff -= ref
+        count = np.count_nonzero(np.isfinite(diff), axis=1)
+        rms = np.sqrt(np.nansum(diff**2, axis=1)/np.maximum(count, 1))
+        rms[count == 0] = np.nan
+        return grid, diff, rms
+
+    def drift(self, wl, window=0.05, kind="dips", **filters_):
+        # Center wavelength over time of the dip (or peak) nearest to wl in each matching
+        # sweep: (times, centers, drift in nm/day)
+        where, params = filters(feature=None, **filters_)
+        where += (" AND" if where else " WHERE") + " f.kind = ? AND f.center_wl BETWEEN ? AND ?"
+        params += [kind, wl - window, wl + window]
+        found = np.array(self.db.execute(
+            "SELECT s.id, s.time, f.center_wl FROM sweeps s JOIN features f ON f.sweep_id = s.id" + where,
+            params).fetchall(), dtype=np.float64).reshape(-1, 3)
+        if len(found) == 0:
+            return np.zeros(0), np.zeros(0), np.nan
+        # Nearest feature per sweep: sort by sweep, then distance, and keep the first of each
+        order = np.lexsort((np.abs(found[:, 2] - wl), found[:, 0]))
+        found = found[order]
+        found = found[np.concatenate(([True], np.diff(found[:, 0]) != 0))]
+        found = found[np.argsort(found[:, 1], kind="stable")]
+        times, centers = found[:, 1], found[:, 2]
+        rate = np.nan
+        if len(times) > 1 and times[-1] > times[0]:
+            rate = np.polyfit((times - times[0])/86400.0, centers, 1)[0]
+        return times, centers, rate
+
+
+def filters(since=None, until=None, slot=None, wl=None, speed=None, label=None, run=None, feature=None,
+            window=0.05):
+    # WHERE clause and parameters over the sweeps table (aliased s)
+    clauses = []
+    params = []
+    if since is not None:
+        clauses.append("s.time >= ?")
+        params.append(parseTime(since))
+    if until is not None:
+        clauses.append("s.time <= ?")
+        params.append(parseTime(until))
+    if slot is not None:
+        clauses.append("s.slot = ?")
+        params.append(int(slot))
+    if wl is not None:
+        lo, hi = (wl, wl) if np.isscalar(wl) else wl
+        clauses.append("s.wl_min <= ? AND s.wl_max >= ?")
+        params += [float(hi), float(lo)]
+    if speed is not None:
+        clauses.append("ABS(s.speed - ?) < 1e-9")
+        params.append(float(speed))
+    if label is not None:
+        clauses.append("s.label = ?")
+        params.append(label)
+    if run is not None:
+        clauses.append("s.run = ?")
+        params.append(int(run))
+    if feature is not None:
+        clauses.append("s.id IN (SELECT sweep_id FROM features WHERE center_wl BETWEEN ? AND ?)")
+        params += [float(feature) - window, float(feature) + window]
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def parseTime(value):
+    # Seconds since the epoch from a number, "YYYY-MM-DD" or "YYYY-MM-DDTHH:MM:SS"
+    if isinstance(value, (int, float)):
+        return float(value)
+    for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise ValueError(f"Unknown date {value!r}, use YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS")
+
+
+def writeSweep(path, sweep):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = np.vstack((np.asarray(sweep.t), np.asarray(sweep.wl), np.asarray(sweep.pwr))).astype(np.float64)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as file:
+        np.save(file, data)
+    os.replace(tmp, path)
+
+
+def resample(sweep, grid):
+    # Power on the grid, reading only the samples inside it; nan outside the sweep
+    wl = sweep.wl
+    pwr = sweep.pwr
+    if len(wl) > 1 and wl[-1] < wl[0]:
+        wl = wl[::-1]
+        pwr = pwr[::-1]
+    i0 = max(np.searchsorted(wl, grid[0]) - 1, 0)
+    i1 = np.searchsorted(wl, grid[-1], side="right") + 1
+    return np.interp(grid, wl[i0:i1], pwr[i0:i1], left=np.nan, right=np.nan)
+
+
+def describe(row):
+    label = f" '{row['label']}'" if row["label"] else ""
+    return (f"#{row['id']}{label} {row['date']} run {row['run']}/{row['sweep']} slot {row['slot']} "
+            f"{row['wl_min']:.3f}-{row['wl_max']:.3f} nm @ {row['speed']} nm/s, {row['n']} points")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archive sweeps and compare them")
+    parser.add_argument("--archive", default=default_path, help="archive folder")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="archive measurement files")
+    add.add_argument("files", nargs="+", help="measurement files (.txt, .h5 or .npz)")
+    add.add_argument("--label", default="", help="label for the sweeps, e.g. the device")
+
+    queries = []
+    for name, text in (("list", "show matching sweeps"), ("diff", "difference from a reference sweep"),
+                       ("drift", "drift of a dip over time")):
+        command = commands.add_parser(name, help=text)
+        command.add_argument("--since", help="date (YYYY-MM-DD)")
+        command.add_argument("--until", help="date (YYYY-MM-DD)")
+        command.add_argument("--slot", type=int, help="laser slot")
+        command.add_argument("--speed", type=float, help="sweep speed (nm/s)")
+        command.add_argument("--label", help="label")
+        command.add_argument("--limit", type=int, help="only the newest sweeps")
+        queries.append(command)
+    queries[0].add_argument("--wl", type=float, help="wavelength the sweeps must cover (nm)")
+    queries[0].add_argument("--feature", type=float, help="wavelength of a dip or peak (nm)")
+    queries[1].add_argument("--reference", type=int, required=True, help="id of the reference sweep")
+    queries[1].add_argument("-o", "--output", help="text file for the differences")
+    queries[2].add_argument("--wl", type=float, required=True, help="approximate dip wavelength (nm)")
+    queries[2].add_argument("--window", type=float, default=0.05, help="search window (nm)")
+    queries[2].add_argument("--peaks", action="store_true", help="follow a peak instead of a dip")
+    args = parser.parse_args(argv)
+
+    store = SweepArchive(args.archive)
+    try:
+        if args.command == "add":
+            for path in args.files:
+                ids = store.addFile(path, args.label)
+                print(f"{path}: {len(ids)} sweeps archived")
+            return 0
+        common = {"since": args.since, "until": args.until, "slot": args.slot, "speed": args.speed,
+                  "label": args.label}
+        if args.command == "list":
+            for row in store.query(wl=args.wl, feature=args.feature, limit=args.limit, **common):
+                print(describe(row))
+        elif args.command == "diff":
+            reference = store.get(args.reference)
+            rows = store.query(wl=(reference["wl_min"], reference["wl_max"]), limit=args.limit, **common)
+            grid, diff, rms = store.difference(reference, rows)
+            for row, r in zip(rows, rms):
+                print(f"{describe(row)}: {r:.3f} dB rms")
+            if args.output:
+                np.savetxt(args.output, np.vstack((grid, diff)).T, fmt="%.6f", delimiter="\t", comments="",
+                           header="Wavelength (nm)\t" + "\t".join(f"#{row['id']} (dB)" for row in rows))
+        elif args.command == "drift":
+            times, centers, rate = store.drift(args.wl, args.window, "peaks" if args.peaks else "dips", **common)
+            for t, wl in zip(times, centers):
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))}\t{wl:.4f}")
+            print(f"{len(times)} sweeps, drift {rate*1e3:.2f} pm/day")
+    except (KeyError, ValueError) as e:
+        print(e.args[0])
+        return 1
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio layer over the blocking instrument drivers.
+
+Each instrument gets its own single worker thread, so calls to the same
+instrument stay serialized while calls to different instruments (the laser
+on GPIB, the power meter on USB) run at the same time. Every call is
+timestamped at the midpoint of its round-trip.
+"""
+
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Reading:
+
+    def __init__(self, value, t1, t2):
+        self.value = value
+        self.t1 = t1
+        self.t2 = t2
+
+    @property
+    def t(self):
+        return 0.5*(self.t1 + self.t2)
+
+    @property
+    def latency(self):
+        return self.t2 - self.t1
+
+
+class AsyncInstrument:
+
+    def __init__(self, driver, name="instrument"):
+        self.driver = driver
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def timed(self, func, *args):
+        t1 = time.perf_counter()
+        value = func(*args)
+        t2 = time.perf_counter()
+        return Reading(value, t1, t2)
+
+    async def call(self, method, *args, driver=None):
+        # driver: another view of the same instrument (e.g. a profiled one), still run on this worker
+        func = getattr(driver if driver is not None else self.driver, method)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.timed, func, *args)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class AsyncPair:
+    # Laser + power meter, with helpers that query both at the same time
+
+    def __init__(self, laser, pm, laser_io=None):
+        # laser_io lets several pairs share one laser worker (one mainframe, many slots)
+        self.laser = laser_io if laser_io is not None else AsyncInstrument(laser, "laser")
+        self.laser_driver = laser
+        self.pm = AsyncInstrument(pm, "pm")
+        self.loop = asyncio.new_event_loop()
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    async def readPairAsync(self, slot, db=True):
+        return await asyncio.gather(self.laser.call("getWL", slot, driver=self.laser_driver), self.pm.call("readPwr", db))
+
+    def readPair(self, slot, db=True):
+        # (wavelength Reading, power Reading) taken concurrently
+        return self.run(self.readPairAsync(slot, db))
+
+    async def openAsync(self, address):
+        return await asyncio.gather(self.laser.call("connectlaser", True, address), self.pm.call("init"))
+
+    def open(self, address=17):
+        # Connects both instruments at once
+        return self.run(self.openAsync(address))
+
+    async def closeAsync(self):
+        return await asyncio.gather(self.laser.call("closelaser"), self.pm.call("close"))
+
+    def close(self, devices=True):
+        if devices:
+            self.run(self.closeAsync())
+        self.laser.close()
+        self.pm.close()
+        self.loop.close()
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmarks for the acquisition, processing, file and plotting paths.
+
+Everything runs against the zero-latency simulated instruments and synthetic
+sweeps of fixed sizes and seeds, so results from different commits can be
+compared directly:
+
+    python benchmark.py -o bench_new.json
+    python benchmark.py --quick --only processing io
+    python benchmark.py --compare bench_old.json bench_new.json
+
+Each timing is the median of several runs. The JSON report records the git
+commit it was measured on.
+"""
+
+import os, sys, time, json, argparse, platform, subprocess, tempfile
+import numpy as np
+
+import acquisition
+import decimate
+import sweepstore
+import measfile
+import simulated
+import sweepengine
+
+suites = ["acquisition", "processing", "io", "plot"]
+
+
+def median(func, repeat=3):
+    # Median wall time of `repeat` calls, and the result of the last one
+    times = []
+    result = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t)
+    return float(np.median(times)), result
+
+
+def syntheticSweeps(npoints, nsweeps, seed=0, start=1550.0, stop=1560.0, speed=10.0):
+    # Sweeps as the engine leaves them after acquisition: time and power, no wavelength yet
+    rng = np.random.default_rng(seed)
+    model = simulated.SpectralModel()
+    duration = (stop - start)/speed
+    store = sweepstore.SweepStore()
+    for i in range(nsweeps):
+        t = np.linspace(0.0, duration, npoints)
+        mw = model.evaluate(start + t*speed) + 1e-3*rng.standard_normal(npoints)
+        pwr = 10.0*np.log10(np.maximum(np.abs(mw), 1e-12))
+        store.add(sweepstore.Sweep.fromArrays(t, np.zeros(npoints), pwr, launchtime=0.0, launchwl=start,
+                                              stoptime=duration, stopwl=stop, speed=speed))
+    return store
+
+
+def benchAcquisition(quick=False):
+    duration = 0.5 if quick else 2.0
+    laser, pm = simulated.createDevices(start_delay=0.05)
+    laser.connectlaser(True, 17)
+    pm.init()
+
+    # Raw acquisition thread: readPwr straight into the ring buffer
+    acq = acquisition.AcquisitionThread(pm.readPwr)
+    acq.start()
+    acq.startSampling()
+    time.sleep(duration)
+    acq.pauseSampling()
+    thread_rate = acq.rate()
+    acq.stop()
+
+    # Full engine path: launch detection, draining, storing and checkpointing
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = sweepengine.SweepEngine(laser, pm, os.path.join(tmp, "bench.ckpt"))
+        params = sweepengine.SweepParams(start=1550.0, stop=1551.0, speed=1.0/duration, sweeps=2)
+        engine.run(params)
+        stats = engine.runStats()
+        drain = engine.profiler.get("engine.drain")
+        engine.close()
+    return {"thread_samples_per_s": thread_rate, "engine_samples_per_s": stats["sample_rate_hz"],
+            "engine_jitter_s": stats["jitter_s"], "engine_worst_gap_s": stats["worst_gap_s"],
+            "drain_mean_s": drain.mean(), "overruns": stats["overruns"]}
+
+
+def processFinal(sweeps):
+    # The engine's own post-processing; the synthetic sweeps have no feature trackers,
+    # so their features are extracted in one pass
+    return sweepengine.processSweeps(sweeps, sweepengine.SweepParams(start=sweeps[0].launchwl,
+                                                                     stop=sweeps[0].stopwl, speed=sweeps[0].speed))
+
+
+def benchProcessing(quick=False):
+    lengths = [10000, 100000] if quick else [10000, 100000, 1000000]
+    repeats = [1, 4] if quick else [1, 4, 16]
+    results = []
+    for npoints in lengths:
+        for nsweeps in repeats:
+            if npoints*nsweeps > 8e6:
+                continue
+            sweeps = syntheticSweeps(npoints, nsweeps)
+            dt, _ = median(lambda: processFinal(sweeps))
+            results.append({"points": npoints, "sweeps": nsweeps, "time_s": dt,
+                            "points_per_s": npoints*nsweeps/dt})
+    return results
+
+
+def benchIO(quick=False):
+    npoints = 100000 if quick else 500000
+    nsweeps = 4
+    sweeps = syntheticSweeps(npoints, nsweeps)
+    processFinal(sweeps)
+    nbytes = sweeps.nbytes()
+    formats = [".npz", ".txt"]
+    if measfile.h5py is not None:
+        formats.insert(0, ".h5")
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for ext in formats:
+            path = os.path.join(tmp, "bench" + ext)
+            save_s, _ = median(lambda: measfile.save(path, sweeps, {"benchmark": True}), 1 if ext == ".txt" else 3)
+
+            def load():
+                # Lazy formats are only done once every column has been read
+                store, meta = measfile.load(path)
+                for sweep in store:
+                    sweep.t, sweep.wl, sweep.pwr
+                return store
+            load_s, _ = median(load, 1 if ext == ".txt" else 3)
+            results.append({"format": ext[1:], "mbytes": nbytes/1e6, "file_mbytes": os.path.getsize(path)/1e6,
+                            "save_s": save_s, "load_s": load_s,
+                            "save_mb_per_s": nbytes/1e6/save_s, "load_mb_per_s": nbytes/1e6/load_s})
+    return results
+
+
+def benchPlot(quick=False):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import liveplot
+
+    counts = [1000, 10000, 100000] if quick else [1000, 10000, 100000, 1000000]
+    results = []
+    for npoints in counts:
+        sweeps = syntheticSweeps(npoints, 1)
+        processFinal(sweeps)
+        sweep = sweeps[0]
+
+        figure = Figure(figsize=(8, 6), dpi=100)
+        canvas = FigureCanvasAgg(figure)
+        ax = figure.add_subplot()
+        live = liveplot.LivePlot(canvas, ax)
+        live.reset("Time stamp (s)", "Power (dBm)")
+        live.newLine()
+        live.setData(sweep.t, sweep.pwr)
+        live.redraw(True)
+        blit_s, _ = median(lambda: live.redraw(True), 5)
+        full_s, _ = median(canvas.draw, 3)
+
+        # Same path as plotFinal: a cleared axes with the trace decimated by LODAxes
+        def final():
+            ax.cla()
+            lod = decimate.LODAxes(ax)
+            lod.plot(sweep.wl, sweep.pwr, linestyle='-', marker='None')
+            canvas.draw()
+        final_s, _ = median(final, 3)
+        results.append({"points": npoints, "blit_s": blit_s, "full_draw_s": full_s, "final_plot_s": final_s})
+    return results
+
+
+def gitCommit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=here, capture_output=True,
+                                text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=here,
+                               capture_output=True, text=True).stdout.strip() != ""
+    except:
+        commit, dirty = "", False
+    return commit, dirty
+
+
+def run(only=None, quick=False):
+    benches = {"acquisition": benchAcquisition, "processing": benchProcessing, "io": benchIO, "plot": benchPlot}
+    commit, dirty = gitCommit()
+    report = {"commit": commit, "dirty": dirty, "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "quick": quick,
+              "python": platform.python_version(), "numpy": np.__version__, "machine": platform.platform(),
+              "results": {}}
+    for name in only or suites:
+        print(f"Running {name}...", file=sys.stderr)
+        report["results"][name] = benches[name](quick)
+    return report
+
+
+def flatten(report):
+    # {"suite/key=value/metric": number}, used to line up two reports
+    flat = {}
+    for suite, result in report["results"].items():
+        rows = result if isinstance(result, list) else [result]
+        for row in rows:
+            keys = [f"{k}={v}" for k, v in row.items() if k in ("points", "sweeps", "format")]
+            for metric, value in row.items():
+                if metric not in ("points", "sweeps", "format") and isinstance(value, (int, float)):
+                    flat["/".join([suite] + keys + [metric])] = value
+    return flat
+
+
+def compare(old, new):
+    a = flatten(old)
+    b = flatten(new)
+    print(f"{'':60s} {old['commit'][:8]:>12s} {new['commit'][:8]:>12s}  ratio")
+    for key in sorted(a.keys() & b.keys()):
+        ratio = b[key]/a[key] if a[key] != 0 else np.nan
+        print(f"{key:60s} {a[key]:12.4g} {b[key]:12.4g}  {ratio:.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark acquisition, processing, file and plot throughput")
+    parser.add_argument("--only", nargs="+", choices=suites, help="run only these suites")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes, for a fast check")
+    parser.add_argument("-o", "--output", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two saved reports")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as a, open(args.compare[1]) as b:
+            compare(json.load(a), json.load(b))
+        return 0
+
+    report = run(args.only, args.quick)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
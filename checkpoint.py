@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only checkpoint file for measurements in progress.
+
+Samples are appended as they are drained from the acquisition buffer and the
+file is fsync'ed periodically and at the end of every sweep, so each write
+costs O(new samples). After a crash, recover() rebuilds the sweeps that made
+it to disk.
+
+Layout (tab separated text records, one per line; sample batches are followed
+by n interleaved little-endian float64 (t, power) pairs):
+    #checkpoint 2
+    #sweep <i> <launchtime> <launchwl> <speed>
+    #samples <i> <n>
+    <16*n bytes>
+    #end <i> <stoptime> <stopwl>
+    #done
+
+A run that is continued with SweepEngine.resume() appends its next sweeps
+after the #done record.
+"""
+
+import os
+import time
+import numpy as np
+
+import sweepstore
+
+
+class CheckpointWriter:
+
+    version = 2
+
+    def __init__(self, path, fsync_interval=1.0, append=False):
+        # append: carries on with the file of a run that was closed, for more sweeps of it
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.last_sync = time.perf_counter()
+        if append and os.path.isfile(path):
+            self.file = open(path, "ab")
+        else:
+            self.file = open(path, "wb")
+            self.record(f"#checkpoint\t{self.version}")
+        self.sync()
+
+    def record(self, line):
+        self.file.write((line + "\n").encode())
+
+    def beginSweep(self, index, launchtime, launchwl, speed):
+        # float() first: the repr of a NumPy scalar is not a plain number
+        self.record(f"#sweep\t{index}\t{float(launchtime)!r}\t{float(launchwl)!r}\t{float(speed)!r}")
+
+    def writeSamples(self, index, t, pwr):
+        if len(t) == 0:
+            return
+        block = np.empty((len(t), 2), dtype='<f8')
+        block[:, 0] = t
+        block[:, 1] = pwr
+        self.record(f"#samples\t{index}\t{len(t)}")
+        self.file.write(block.tobytes())
+        if time.perf_counter() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def endSweep(self, index, stoptime, stopwl):
+        self.record(f"#end\t{index}\t{float(stoptime)!r}\t{float(stopwl)!r}")
+        self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_sync = time.perf_counter()
+
+    def close(self, done=True):
+        if self.file is not None and not self.file.closed:
+            if done:
+                self.record("#done")
+            self.sync()
+            self.file.close()
+
+
+def isIncomplete(path):
+    # True if the checkpoint holds a run that never reached "#done"
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        return False
+    with open(path, "rb") as file:
+        file.seek(max(0, os.path.getsize(path) - 64))
+        tail = file.read()
+    return not tail.endswith(b"#done\n")
+
+
+def recover(path):
+    # Rebuilds a SweepStore from a checkpoint. A trailing partial record is ignored, and
+    # sweeps that never ended get their stop point extrapolated from the sweep speed.
+    store = sweepstore.SweepStore()
+    sweeps = {}
+    speeds = {}
+    with open(path, "rb") as file:
+        raw = file.read()
+
+    pos = 0
+    while pos < len(raw):
+        eol = raw.find(b"\n", pos)
+        if eol < 0:
+            break
+        fields = raw[pos:eol].decode().split("\t")
+        pos = eol + 1
+        if fields[0] == "#sweep":
+            i = int(fields[1])
+            sweeps[i] = store.new()
+            sweeps[i].launchtime = float(fields[2])
+            sweeps[i].launchwl = float(fields[3])
+            speeds[i] = float(fields[4])
+        elif fields[0] == "#samples":
+            i = int(fields[1])
+            n = min(int(fields[2]), (len(raw) - pos)//16)
+            block = np.frombuffer(raw, dtype='<f8', count=2*n, offset=pos).reshape(n, 2)
+            sweeps[i].extend(block[:, 0], block[:, 1])
+            pos += 16*int(fields[2])
+        elif fields[0] == "#end":
+            i = int(fields[1])
+            sweeps[i].stoptime = float(fields[2])
+            sweeps[i].stopwl = float(fields[3])
+
+    for i in sweeps:
+        sweep = sweeps[i]
+        sweep.trim()
+        if sweep.stoptime == 0.0 and len(sweep) > 0:
+            sweep.stoptime = sweep.launchtime + sweep.t[-1]
+            sweep.stopwl = sweep.launchwl + sweep.t[-1]*speeds[i]
+    return store
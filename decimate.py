@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Min/max level-of-detail decimation for plotting long traces.
+
+A Pyramid holds, for every level k, the index of the minimum and of the
+maximum of each block of 2**(k+1) raw points. Drawing a visible x-range picks
+the coarsest level that still has about two blocks per pixel column and emits
+both extremes of every block in their original order, so the plotted line
+covers exactly the same vertical extent as the raw data: peaks and notches
+are never lost, while the number of points drawn is bounded by the axes
+width instead of by the trace length.
+
+    lod = decimate.LODAxes(ax)
+    lod.plot(sweep.wl, sweep.pwr, linestyle='-')
+    canvas.draw()
+
+LODAxes re-decimates its lines whenever the x-limits change (zoom, pan).
+
+Stream does the same min/max decimation for a trace that is still growing,
+such as the live sweep: only the points added since the last update are
+reduced, so the cost of a frame does not grow with the length of the trace.
+"""
+
+import numpy as np
+
+
+class Pyramid:
+
+    def __init__(self, x, y, min_points=2048):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if len(x) > 1 and x[-1] < x[0]:
+            x = x[::-1]
+            y = y[::-1]
+        self.x = x
+        self.y = y
+        self.n = len(x)
+        self.sorted = self.n < 2 or bool(np.all(np.diff(x) >= 0))
+        self.imin = []
+        self.imax = []
+
+        # NaN never wins a comparison, all-NaN blocks point at a NaN sample
+        ylo = np.where(np.isnan(y), np.inf, y)
+        yhi = np.where(np.isnan(y), -np.inf, y)
+        idx = np.arange(self.n, dtype=np.int64 if self.n >= 2**31 else np.int32)
+        imin, imax = idx, idx
+        while len(imin) > min_points:
+            imin = self.reduce(imin, ylo, np.less_equal)
+            imax = self.reduce(imax, yhi, np.greater_equal)
+            self.imin.append(imin)
+            self.imax.append(imax)
+
+    @staticmethod
+    def reduce(indices, y, better):
+        # Pairs up blocks, keeping the index of the better of each pair. An odd block at
+        # the end is carried over on its own.
+        npairs = len(indices)//2
+        a = indices[0:2*npairs:2]
+        b = indices[1:2*npairs:2]
+        out = np.where(better(y[a], y[b]), a, b)
+        if len(indices) % 2:
+            out = np.append(out, indices[-1])
+        return out
+
+    def visibleRange(self, x0, x1):
+        # Raw index range [i0, i1) covering x0..x1, plus one point on each side
+        if not self.sorted:
+            return 0, self.n
+        i0 = max(int(np.searchsorted(self.x, x0, side='left')) - 1, 0)
+        i1 = min(int(np.searchsorted(self.x, x1, side='right')) + 1, self.n)
+        return i0, i1
+
+    def level(self, x0, x1, npix):
+        # Coarsest level with at least two blocks per pixel over x0..x1 (-1 for raw data),
+        # and the block range it covers
+        i0, i1 = self.visibleRange(x0, x1)
+        level = -1
+        while level + 1 < len(self.imin) and (i1 - i0)/2**(level + 2) >= 2*npix:
+            level += 1
+        if level < 0:
+            return level, i0, i1
+        # Blocks at this level hold 2**(level+1) points each
+        size = 2**(level + 1)
+        return level, i0//size, min(-(-i1//size), len(self.imin[level]))
+
+    def select(self, x0, x1, npix):
+        # (x, y) to draw for the range x0..x1 on an axes npix pixels wide
+        level, b0, b1 = self.level(x0, x1, npix)
+        if level < 0:
+            return self.x[b0:b1], self.y[b0:b1]
+        # The first and last point of the block range keep the line reaching the edges
+        size = 2**(level + 1)
+        lo = self.imin[level][b0:b1]
+        hi = self.imax[level][b0:b1]
+        idx = np.empty(2*len(lo) + 2, dtype=lo.dtype)
+        idx[1:-1:2] = np.minimum(lo, hi)
+        idx[2:-1:2] = np.maximum(lo, hi)
+        idx[0] = b0*size
+        idx[-1] = min(b1*size, self.n) - 1
+        return self.x[idx], self.y[idx]
+
+
+class Stream:
+    # Min/max decimation of a trace that grows at the end. Full blocks of `block` raw points
+    # are reduced to their minimum and maximum, in order; once there are more than
+    # max_points/2 blocks, pairs of blocks are merged and the block size doubles. Points
+    # after the last full block are kept raw.
+
+    def __init__(self, max_points=4096):
+        self.max_points = max_points
+        self.block = 1
+        self.n = 0
+        self.bx = np.zeros(0)
+        self.by = np.zeros(0)
+        self.tx = np.zeros(0)
+        self.ty = np.zeros(0)
+
+    @staticmethod
+    def reduce(x, y, size):
+        # Minimum and maximum of every `size` points, in their original order
+        ylo = np.where(np.isnan(y), np.inf, y).reshape(-1, size)
+        yhi = np.where(np.isnan(y), -np.inf, y).reshape(-1, size)
+        offset = np.arange(0, len(x), size)
+        imin = offset + np.argmin(ylo, axis=1)
+        imax = offset + np.argmax(yhi, axis=1)
+        idx = np.column_stack((np.minimum(imin, imax), np.maximum(imin, imax))).ravel()
+        return x[idx], y[idx]
+
+    def extend(self, x, y):
+        self.n += len(x)
+        tx = np.concatenate((self.tx, x))
+        ty = np.concatenate((self.ty, y))
+        nfull = (len(tx)//self.block)*self.block
+        if nfull > 0:
+            bx, by = self.reduce(tx[:nfull], ty[:nfull], self.block)
+            self.bx = np.concatenate((self.bx, bx))
+            self.by = np.concatenate((self.by, by))
+        self.tx = tx[nfull:]
+        self.ty = ty[nfull:]
+        while len(self.bx) > self.max_points:
+            # Two points per block: pairs of blocks are groups of 4. An odd block at the
+            # end is carried over as it is.
+            npairs = 4*(len(self.bx)//4)
+            bx, by = self.reduce(self.bx[:npairs], self.by[:npairs], 4)
+            self.bx = np.concatenate((bx, self.bx[npairs:]))
+            self.by = np.concatenate((by, self.by[npairs:]))
+            self.block *= 2
+
+    def data(self):
+        return np.concatenate((self.bx, self.tx)), np.concatenate((self.by, self.ty))
+
+
+class LODAxes:
+    # Lines and min/max bands on an axes, re-decimated for the visible x-range.
+    # Artists are only updated in place on zoom, since adding new ones while the
+    # axes autoscale re-enters the limit update.
+
+    def __init__(self, ax, min_points=2048):
+        self.ax = ax
+        self.min_points = min_points
+        self.lines = []
+        self.bands = []
+        ax.callbacks.connect('xlim_changed', self.onXlim)
+
+    def width(self):
+        return max(int(self.ax.bbox.width), 100)
+
+    def plot(self, x, y, **kwargs):
+        pyramid = Pyramid(x, y, self.min_points)
+        x0, x1 = (pyramid.x[0], pyramid.x[-1]) if pyramid.n > 0 else (0.0, 1.0)
+        line, = self.ax.plot(*pyramid.select(x0, x1, self.width()), **kwargs)
+        self.lines.append((line, pyramid))
+        return line
+
+    def fill_between(self, x, ymin, ymax, **kwargs):
+        from matplotlib.collections import PolyCollection
+        # Both edges share x, so one pyramid per edge has the same block layout
+        lower = Pyramid(x, ymin, self.min_points)
+        upper = Pyramid(x, ymax, self.min_points)
+        x0, x1 = (lower.x[0], lower.x[-1]) if lower.n > 0 else (0.0, 1.0)
+        collection = PolyCollection([self.bandVerts(lower, upper, x0, x1)], **kwargs)
+        self.ax.add_collection(collection)
+        self.bands.append((collection, lower, upper))
+        return collection
+
+    def bandVerts(self, lower, upper, x0, x1):
+        # Outline of the band. Decimated bands are steps spanning each block, from the
+        # lowest point of the lower edge to the highest point of the upper edge.
+        level, b0, b1 = lower.level(x0, x1, self.width())
+        if level < 0:
+            x = lower.x[b0:b1]
+            ylo = lower.y[b0:b1]
+            yhi = upper.y[b0:b1]
+        else:
+            size = 2**(level + 1)
+            edges = lower.x[np.minimum(np.arange(b0, b1 + 1)*size, lower.n - 1)]
+            ylo = np.repeat(lower.y[lower.imin[level][b0:b1]], 2)
+            yhi = np.repeat(upper.y[upper.imax[level][b0:b1]], 2)
+            x = np.repeat(edges, 2)[1:-1]
+        return np.column_stack((np.concatenate((x, x[::-1])), np.concatenate((ylo, yhi[::-1]))))
+
+    def onXlim(self, ax):
+        x0, x1 = sorted(ax.get_xlim())
+        npix = self.width()
+        for line, pyramid in self.lines:
+            line.set_data(*pyramid.select(x0, x1, npix))
+        for collection, lower, upper in self.bands:
+            collection.set_verts([self.bandVerts(lower, upper, x0, x1)])
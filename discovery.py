@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Instrument discovery and connection off the GUI thread.
+
+A Connector creates the drivers and connects the laser and the power meter on
+a background thread, both at once, and retries whatever failed up to
+`retries` times. Progress messages are queued for poll(), which the GUI calls
+from a timer like SweepEngine.poll(); run() does the same work in the calling
+thread for scripts.
+
+The VISA resource each instrument was found at is kept in `resources`, so the
+next connection opens the power meter directly instead of scanning every
+interface with list_resources(). A cached resource that stops answering is
+dropped and the retry scans the bus again.
+"""
+
+import time
+import asyncio
+from queue import SimpleQueue, Empty
+from threading import Thread
+
+import asyncdrivers
+
+
+def createDevices(simulate=False, sim_options={}):
+    # Driver objects only; the VISA modules are imported here, not at startup
+    if simulate:
+        import simulated
+        return simulated.createDevices(**sim_options)
+    import agilent816xb
+    import thorlabsPM300
+    return agilent816xb.Agilent816xb(), thorlabsPM300.ThorLabsPM300()
+
+
+class Connector:
+
+    IDLE = 0
+    CONNECTING = 1
+    DONE = 2
+
+    def __init__(self, address=17, simulate=False, sim_options={}, resources=None, retries=2, retry_delay=1.0):
+        self.address = address
+        self.simulate = simulate
+        self.sim_options = sim_options
+        self.resources = resources if resources is not None else {}
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.laser = None
+        self.pm = None
+        self.state = self.IDLE
+        self.elapsed = 0.0
+        self.messages = SimpleQueue()
+        self.thread = None
+
+    def status(self, msg):
+        self.messages.put(msg)
+
+    def start(self):
+        self.state = self.CONNECTING
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def poll(self):
+        # Progress messages since the last call
+        msgs = []
+        while True:
+            try:
+                msgs.append(self.messages.get_nowait())
+            except Empty:
+                return msgs
+
+    def ok(self):
+        return self.laser is not None and self.laser.laserOK and self.pm.ok
+
+    def run(self):
+        t = time.perf_counter()
+        self.state = self.CONNECTING
+        self.status(f"Loading instrument drivers...")
+        self.laser, self.pm = createDevices(self.simulate, self.sim_options)
+        io = asyncdrivers.AsyncPair(self.laser, self.pm)
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    time.sleep(self.retry_delay)
+                self.status(self.describe(attempt))
+                io.run(self.connectAsync(io))
+                if self.ok():
+                    break
+                if not self.pm.ok:
+                    self.resources.pop("pm", None)
+        finally:
+            io.close(devices=False)
+
+        if self.laser.laserOK:
+            self.resources["laser"] = self.laser.resource
+        if self.pm.ok:
+            self.resources["pm"] = self.pm.resource
+        self.elapsed = time.perf_counter() - t
+        self.state = self.DONE
+        return self.laser, self.pm
+
+    async def connectAsync(self, io):
+        # Only the instruments that are not connected yet
+        calls = []
+        if not self.laser.laserOK:
+            calls.append(io.laser.call("connectlaser", True, self.address))
+        if not self.pm.ok:
+            calls.append(io.pm.call("init", 0, self.resources.get("pm")))
+        return await asyncio.gather(*calls)
+
+    def describe(self, attempt):
+        missing = []
+        if not self.laser.laserOK:
+            missing.append(f"laser (GPIB {self.address})")
+        if not self.pm.ok:
+            missing.append("power meter" + (f" ({self.resources['pm']})" if "pm" in self.resources else ""))
+        msg = f"Connecting to the {' and '.join(missing)}..."
+        if attempt > 0:
+            msg = msg[:-3] + f", retry {attempt}/{self.retries}..."
+        return msg
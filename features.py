@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming spectral feature extraction.
+
+A FeatureTracker is fed the samples of one sweep as they are drained from the
+acquisition buffer. Samples are averaged into bins `resolution` nm wide, so
+the work per sample is vectorized and independent of the sampling rate, and
+the bins run through a hysteresis detector that confirms a dip (or peak) as
+soon as the power has come back up (down) by `prominence` dB. The running
+min/max and the confirmed extrema are available at any time.
+
+The detector alternates, so the baseline between two dips also shows up as a
+peak. At the end of the sweep, finish() decides from the median level whether
+the spectrum has dips on a high baseline (through port, notch) or peaks on a
+low one (drop port), and measures only those on the binned trace: center
+wavelength (midpoint of the half-depth crossings), FWHM, Q and extinction
+ratio against the weaker of the two shoulders. When the source power is known
+the insertion loss of the sweep is reported as well.
+"""
+
+import numpy as np
+
+
+class FeatureTracker:
+
+    def __init__(self, speed, resolution=0.001, prominence=3.0, source_dbm=None):
+        self.speed = speed
+        self.bin_time = resolution/speed if speed > 0 else 1e-3
+        self.prominence = prominence
+        self.source_dbm = source_dbm
+        self.hold_t = np.empty(0)
+        self.hold_p = np.empty(0)
+        self.bins_t = []
+        self.bins_p = []
+        self.nbins = 0
+        self.min_db = np.inf
+        self.min_t = 0.0
+        self.max_db = -np.inf
+        self.max_t = 0.0
+
+        # Hysteresis detector state, on bin indices
+        self.look_for_dip = True
+        self.lo = np.inf
+        self.lo_i = 0
+        self.hi = -np.inf
+        self.hi_i = 0
+        self.dips = []
+        self.peaks = []
+
+    def extend(self, t, pwr):
+        # t in seconds from the sweep launch, pwr in dBm
+        if len(t) == 0:
+            return
+        finite = np.isfinite(pwr)
+        if finite.any():
+            i = np.argmin(np.where(finite, pwr, np.inf))
+            if pwr[i] < self.min_db:
+                self.min_db, self.min_t = float(pwr[i]), float(t[i])
+            i = np.argmax(np.where(finite, pwr, -np.inf))
+            if pwr[i] > self.max_db:
+                self.max_db, self.max_t = float(pwr[i]), float(t[i])
+
+        # The last, possibly incomplete, bin is held back until the next call
+        t = np.concatenate((self.hold_t, t))
+        pwr = np.concatenate((self.hold_p, pwr))
+        idx = np.floor(t/self.bin_time).astype(np.int64)
+        done = np.searchsorted(idx, idx[-1], side='left')
+        self.hold_t = t[done:]
+        self.hold_p = pwr[done:]
+        self.addBins(t[:done], pwr[:done], idx[:done])
+
+    def addBins(self, t, pwr, idx):
+        if len(t) == 0:
+            return
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(idx)) + 1))
+        finite = np.isfinite(pwr)
+        counts = np.add.reduceat(finite.astype(np.int64), starts)
+        sums = np.add.reduceat(np.where(finite, pwr, 0.0), starts)
+        times = np.add.reduceat(t, starts)/np.diff(np.append(starts, len(t)))
+        keep = counts > 0
+        bp = sums[keep]/counts[keep]
+        bt = times[keep]
+        self.detect(bp)
+        self.bins_t.append(bt)
+        self.bins_p.append(bp)
+        self.nbins += len(bp)
+
+    def detect(self, bp):
+        delta = self.prominence
+        i = self.nbins
+        for v in bp.tolist():
+            if v > self.hi:
+                self.hi, self.hi_i = v, i
+            if v < self.lo:
+                self.lo, self.lo_i = v, i
+            if self.look_for_dip:
+                if v < self.hi - delta:
+                    # Fell far enough below the last maximum: that maximum was a peak
+                    self.peaks.append(self.hi_i)
+                    self.lo, self.lo_i = v, i
+                    self.look_for_dip = False
+            elif v > self.lo + delta:
+                self.dips.append(self.lo_i)
+                self.hi, self.hi_i = v, i
+                self.look_for_dip = True
+            i += 1
+
+    def binned(self):
+        if len(self.bins_t) > 1:
+            self.bins_t = [np.concatenate(self.bins_t)]
+            self.bins_p = [np.concatenate(self.bins_p)]
+        if len(self.bins_t) == 0:
+            return np.empty(0), np.empty(0)
+        return self.bins_t[0], self.bins_p[0]
+
+    def flush(self):
+        # Closes the held-back bin at the end of the sweep
+        if len(self.hold_t) > 0:
+            self.addBins(self.hold_t, self.hold_p, np.zeros(len(self.hold_t), dtype=np.int64))
+            self.hold_t = np.empty(0)
+            self.hold_p = np.empty(0)
+
+    def live(self):
+        # Cheap summary while the sweep is running
+        return {"min_db": self.min_db, "min_t": self.min_t, "max_db": self.max_db, "max_t": self.max_t,
+                "dips": len(self.dips), "peaks": len(self.peaks)}
+
+    def finish(self, wlfunc):
+        # Measures the features found so far. wlfunc maps time from launch to wavelength;
+        # calling finish() again with a better axis just measures again.
+        self.flush()
+        bt, bp = self.binned()
+        result = {"min_db": float(self.min_db), "min_wl": float(wlfunc(self.min_t)),
+                  "max_db": float(self.max_db), "max_wl": float(wlfunc(self.max_t)),
+                  "er_db": float(self.max_db - self.min_db),
+                  "il_db": float(self.source_dbm - self.max_db) if self.source_dbm is not None else None,
+                  "dips": [], "peaks": []}
+        if len(bp) == 0:
+            return result
+        median = np.median(bp)
+        dip = self.max_db - median < median - self.min_db
+        kind, found = ("dips", self.dips) if dip else ("peaks", self.peaks)
+        extrema = sorted(self.dips + self.peaks)
+        for k in found:
+            j = extrema.index(k)
+            left = extrema[j - 1] if j > 0 else 0
+            right = extrema[j + 1] if j + 1 < len(extrema) else len(bp) - 1
+            result[kind].append(measure(bt, bp, k, left, right, dip, wlfunc))
+        return result
+
+
+def measure(bt, bp, k, left, right, dip, wlfunc):
+    # Width at half depth (in mW) of the dip or peak at bin k, between the neighbouring
+    # extrema at bins left and right
+    sign = 1.0 if dip else -1.0
+    shoulder_l = sign*np.max(sign*bp[left:k + 1])
+    shoulder_r = sign*np.max(sign*bp[k:right + 1])
+    base = min(shoulder_l, shoulder_r) if dip else max(shoulder_l, shoulder_r)
+    lin = 10.0**(bp[left:right + 1]/10.0)
+    half = 0.5*(10.0**(base/10.0) + 10.0**(bp[k]/10.0))
+    c = k - left
+
+    # Last bin on each side that is still beyond the half level, interpolated to the crossing
+    beyond = sign*(lin - half) >= 0
+    lside = np.flatnonzero(beyond[:c])
+    rside = np.flatnonzero(beyond[c:])
+    t_l = t_r = np.nan
+    if len(lside) > 0:
+        i = left + lside[-1]
+        t_l = crossing(bt[i], bt[i + 1], lin[i - left], lin[i + 1 - left], half)
+    if len(rside) > 0:
+        i = k + rside[0]
+        t_r = crossing(bt[i - 1], bt[i], lin[i - 1 - left], lin[i - left], half)
+
+    if np.isfinite(t_l) and np.isfinite(t_r):
+        center = float(wlfunc(0.5*(t_l + t_r)))
+        fwhm = float(abs(wlfunc(t_r) - wlfunc(t_l)))
+    else:
+        center = float(wlfunc(bt[k]))
+        fwhm = np.nan
+    return {"center_wl": center, "level_db": float(bp[k]), "depth_db": float(sign*(base - bp[k])),
+            "fwhm_nm": fwhm, "q": center/fwhm if fwhm > 0 else np.nan}
+
+
+def crossing(t0, t1, y0, y1, level):
+    if y1 == y0:
+        return 0.5*(t0 + t1)
+    return t0 + (level - y0)/(y1 - y0)*(t1 - t0)
+
+
+def linearAxis(sweep):
+    # time from launch -> wavelength, from the sweep's launch and stop points
+    duration = sweep.stoptime - sweep.launchtime
+    slope = (sweep.stopwl - sweep.launchwl)/duration if duration > 0 else 0.0
+    return lambda t: sweep.launchwl + slope*t
+
+
+def sweepAxis(sweep):
+    # time from launch -> wavelength, from the sweep's final wavelength column
+    t = np.array(sweep.t)
+    wl = np.array(sweep.wl)
+    return lambda x: np.interp(x, t, wl)
+
+
+def extract(sweep, resolution=0.001, prominence=3.0, source_dbm=None):
+    # One-shot extraction for a sweep that is already complete (loaded or recovered)
+    duration = sweep.stoptime - sweep.launchtime
+    speed = getattr(sweep, "speed", 0.0)
+    if speed <= 0 and duration > 0:
+        speed = abs(sweep.stopwl - sweep.launchwl)/duration
+    tracker = FeatureTracker(speed, resolution, prominence, source_dbm)
+    tracker.extend(np.asarray(sweep.t), np.asarray(sweep.pwr))
+    return tracker.finish(sweepAxis(sweep))
+
+
+def describe(result, count=3):
+    # Short text for the UI
+    if result is None:
+        return ""
+    lines = [f"min {result['min_db']:.2f} dBm @ {result['min_wl']:.4f} nm, ER {result['er_db']:.2f} dB"]
+    if result.get("il_db") is not None:
+        lines[0] += f", IL {result['il_db']:.2f} dB"
+    for kind in ("dips", "peaks"):
+        for f in result[kind][:count]:
+            lines.append(f"{kind[:-1]} {f['center_wl']:.4f} nm, FWHM {f['fwhm_nm']*1e3:.1f} pm, "
+                         f"Q {f['q']:.3g}, ER {f['depth_db']:.2f} dB")
+        if len(result[kind]) > count:
+            lines.append(f"(+{len(result[kind]) - count} more {kind})")
+    return "\n".join(lines)
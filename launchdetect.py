@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Non-blocking detection of the moment a laser sweep starts.
+
+Instead of spinning on getWL, the detector is polled from the caller's own
+loop and queries the laser at an adaptive rate: slowly while the wavelength
+sits at the start, then a short burst of closely spaced readings once it
+starts moving. A straight line fitted to the burst gives the time at which
+the sweep crossed the start wavelength, independent of when the poll
+happened to notice the change.
+"""
+
+import time
+import numpy as np
+
+
+class LaunchDetector:
+
+    WAITING = 0
+    LAUNCHED = 1
+    TIMEOUT = 2
+
+    def __init__(self, getwl, start, timeout=10.0, min_interval=0.001, max_interval=0.05,
+                 nfit=5, clock=time.perf_counter):
+        self.getwl = getwl
+        self.start = start
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.nfit = nfit
+        self.clock = clock
+        self.t0 = clock()
+        self.interval = min_interval
+        self.next_poll = self.t0
+        self.state = self.WAITING
+        self.launchtime = self.t0
+        self.launchwl = start
+        self.fit = None
+        self.times = []
+        self.wls = []
+
+    def read(self):
+        # Stamps the reading at the midpoint of the query round-trip
+        t1 = self.clock()
+        wl = self.getwl()
+        t2 = self.clock()
+        return 0.5*(t1 + t2), wl
+
+    def poll(self):
+        if self.state != self.WAITING:
+            return self.state
+        now = self.clock()
+        if now - self.t0 >= self.timeout:
+            self.launchtime = now
+            self.state = self.TIMEOUT
+            return self.state
+        if now < self.next_poll:
+            return self.state
+
+        t, wl = self.read()
+        if wl <= self.start:
+            # Still parked: back off, up to max_interval
+            self.interval = min(2*self.interval, self.max_interval)
+            self.next_poll = t + self.interval
+            return self.state
+
+        # Moving: take a short burst of readings and fit wl = a + b*t
+        self.times = [t]
+        self.wls = [wl]
+        while len(self.times) < self.nfit:
+            time.sleep(self.min_interval)
+            t, wl = self.read()
+            self.times.append(t)
+            self.wls.append(wl)
+        self.launch()
+        return self.state
+
+    def launch(self):
+        times = np.array(self.times)
+        wls = np.array(self.wls)
+        tref = times[0]
+        b, a = np.polyfit(times - tref, wls, 1)
+        self.fit = (a, b, tref)
+        if b > 0 and np.all(np.diff(wls) >= 0):
+            self.launchtime = tref + (self.start - a)/b
+            self.launchwl = self.start
+        else:
+            # Readings not consistent with a running sweep, fall back to the first one
+            self.launchtime = self.times[0]
+            self.launchwl = self.wls[0]
+        self.state = self.LAUNCHED
+
+    def residual(self):
+        # RMS deviation (nm) of the burst from the fitted line
+        if self.fit is None:
+            return np.nan
+        a, b, tref = self.fit
+        wls = np.array(self.wls)
+        model = a + b*(np.array(self.times) - tref)
+        return float(np.sqrt(np.mean((wls - model)**2)))
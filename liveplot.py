@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental live plotting with persistent lines and blitting.
+
+Only the line that is still receiving data is animated. Finished lines become
+part of the cached background, so a frame costs one background restore plus
+drawing the active line, and frames are throttled to a fixed rate. The
+active line is min/max decimated to a few points per pixel column as its
+data comes in (decimate.Stream), so a frame costs the same at the start and
+at the end of a long sweep.
+"""
+
+import time
+import numpy as np
+
+import decimate
+
+
+class LivePlot:
+
+    def __init__(self, canvas, ax, fps=20.0, headroom=0.1):
+        self.canvas = canvas
+        self.ax = ax
+        self.fps = fps
+        self.headroom = headroom
+        self.lines = []
+        self.active = None
+        self.stream = None
+        self.background = None
+        self.limits = None
+        self.last_draw = 0.0
+        self.canvas.mpl_connect("draw_event", self.onDraw)
+
+    def reset(self, xlabel, ylabel, title=""):
+        self.ax.cla()
+        self.ax.set_xlabel(xlabel)
+        self.ax.set_ylabel(ylabel)
+        self.ax.set_title(title)
+        self.ax.grid(True)
+        self.lines = []
+        self.active = None
+        self.limits = None
+        self.fullDraw()
+
+    def newLine(self, linestyle='-'):
+        self.finishLine()
+        line, = self.ax.plot([], [], linestyle=linestyle, marker='None', animated=True)
+        self.lines.append(line)
+        self.active = line
+        self.stream = decimate.Stream(4*max(int(self.ax.bbox.width), 100))
+        return line
+
+    def finishLine(self):
+        # The finished line goes into the cached background on the next full draw
+        if self.active is not None:
+            self.active.set_animated(False)
+            self.active = None
+            self.fullDraw()
+
+    def setData(self, x, y):
+        # x, y: all of the active line's data so far. Only the points added since the last
+        # call are decimated and checked against the limits.
+        if self.active is None:
+            self.newLine()
+        if len(x) < self.stream.n:
+            self.stream = decimate.Stream(self.stream.max_points)
+        x = np.asarray(x[self.stream.n:], dtype=np.float64)
+        y = np.asarray(y[self.stream.n:], dtype=np.float64)
+        self.stream.extend(x, y)
+        self.active.set_data(*self.stream.data())
+        if len(x) > 0:
+            self.growLimits(x, y)
+
+    def growLimits(self, x, y):
+        finite = np.isfinite(y)
+        if not finite.any():
+            return
+        xmin, xmax = x[0], x[-1]
+        if xmax < xmin:
+            xmin, xmax = xmax, xmin
+        ymin, ymax = np.min(y[finite]), np.max(y[finite])
+        if self.limits is not None:
+            x0, x1, y0, y1 = self.limits
+            if xmin >= x0 and xmax <= x1 and ymin >= y0 and ymax <= y1:
+                return
+            xmin, xmax = min(xmin, x0), max(xmax, x1)
+            ymin, ymax = min(ymin, y0), max(ymax, y1)
+        dx = (xmax - xmin)*self.headroom or 1.0
+        dy = (ymax - ymin)*self.headroom or 1.0
+        self.limits = (xmin, xmax + dx, ymin - dy, ymax + dy)
+        self.ax.set_xlim(self.limits[0], self.limits[1])
+        self.ax.set_ylim(self.limits[2], self.limits[3])
+        self.background = None
+
+    def due(self):
+        return time.perf_counter() - self.last_draw >= 1.0/self.fps
+
+    def redraw(self, force=False):
+        if not force and not self.due():
+            return False
+        self.last_draw = time.perf_counter()
+        if self.background is None:
+            self.fullDraw()
+        else:
+            self.canvas.restore_region(self.background)
+            if self.active is not None:
+                self.ax.draw_artist(self.active)
+            self.canvas.blit(self.ax.bbox)
+            self.canvas.flush_events()
+        return True
+
+    def fullDraw(self):
+        self.canvas.draw()
+
+    def onDraw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        if self.active is not None:
+            self.ax.draw_artist(self.active)
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+Measurement files.
+
+Sweeps are stored as typed float64 arrays together with their launch/stop
+metadata and the run parameters (slot, speed, start/stop, instrument IDs).
+HDF5 (.h5, needs h5py) is chunked and compressed; uncompressed HDF5 datasets
+are memory-mapped directly on load. NumPy archives (.npz) are the fallback
+when h5py is not installed. Either way, sweep arrays are only read from disk
+when they are first accessed. Besides time, wavelength and power, HDF5 and
+NumPy files keep the read latency and the wavelength uncertainty of every
+sample when the sweep has them. The tab separated text layout (.txt) is kept
+as an export.
+
+loadCached() keeps the last few files that were loaded, keyed by path and
+modification time, so reference files can be reloaded without parsing them
+again.
+
+Loaded sweeps keep reading from their file, so save() first releases a file
+it is about to overwrite: its sweeps read the rest of their data into memory,
+the file is closed and it leaves the cache.
+"""
+
+import os
+import json
+import weakref
+import numpy as np
+from collections import OrderedDict
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+import sweepstore
+
+format_version = 1
+chunk_size = 65536
+cache_size = 8
+cache = OrderedDict()
+# Open files that lazy sweeps read from, by full path: [(file, sweeps)]
+open_files = {}
+
+
+class LazySweep:
+    # Read-only sweep whose columns are fetched from the file on first access
+
+    def __init__(self, source, n, meta):
+        self.source = source
+        self.n = n
+        self.cache = {}
+        self.launchtime = meta.get("launchtime", 0.0)
+        self.launchwl = meta.get("launchwl", 0.0)
+        self.stoptime = meta.get("stoptime", 0.0)
+        self.stopwl = meta.get("stopwl", 0.0)
+
+    def __len__(self):
+        return self.n
+
+    def column(self, name):
+        if name not in self.cache:
+            self.cache[name] = self.source(name)
+        return self.cache[name]
+
+    @property
+    def t(self):
+        return self.column("t")
+
+    @property
+    def wl(self):
+        return self.column("wl")
+
+    @property
+    def pwr(self):
+        return self.column("pwr")
+
+    @property
+    def lat(self):
+        return self.column("lat")
+
+    @property
+    def wlerr(self):
+        # None for files written without it
+        return self.column("wlerr")
+
+    def nbytes(self):
+        return sum(a.nbytes for a in self.cache.values() if a is not None)
+
+    def detach(self):
+        # Reads every column into memory, after which the file is no longer needed
+        for name in ("t", "wl", "pwr", "lat", "wlerr"):
+            data = self.column(name)
+            self.cache[name] = None if data is None else np.array(data).view(np.ndarray)
+        self.source = lambda name: None
+
+
+# Columns written when the sweep has them
+optional_columns = ("lat", "wlerr")
+
+
+def sweepColumns(sweep):
+    columns = ["t", "wl", "pwr"]
+    columns += [name for name in optional_columns if getattr(sweep, name, None) is not None]
+    return columns
+
+
+def sweepMeta(sweep):
+    return {"launchtime": float(sweep.launchtime), "launchwl": float(sweep.launchwl),
+            "stoptime": float(sweep.stoptime), "stopwl": float(sweep.stopwl)}
+
+
+def track(path, file, sweeps):
+    # Files whose sweeps are all gone are closed here
+    for fullpath in list(open_files):
+        entries = []
+        for entry in open_files[fullpath]:
+            if len(entry[1]) > 0:
+                entries.append(entry)
+            else:
+                entry[0].close()
+        if entries:
+            open_files[fullpath] = entries
+        else:
+            del open_files[fullpath]
+    open_files.setdefault(os.path.abspath(path), []).append((file, weakref.WeakSet(sweeps)))
+
+
+def release(path):
+    # Detaches the sweeps loaded from path and closes the file, so it can be overwritten
+    fullpath = os.path.abspath(path)
+    for key in [k for k in cache if k[0] == fullpath]:
+        del cache[key]
+    for file, sweeps in open_files.pop(fullpath, []):
+        for sweep in list(sweeps):
+            sweep.detach()
+        file.close()
+
+
+def save(path, sweeps, meta=None, compress=True):
+    release(path)
+    if path.lower().endswith(".txt"):
+        saveTSV(path, sweeps)
+    elif path.lower().endswith(".npz"):
+        saveNpz(path, sweeps, meta, compress)
+    else:
+        saveH5(path, sweeps, meta, compress)
+
+
+def load(path):
+    if path.lower().endswith(".txt"):
+        return loadTSV(path), {}
+    elif path.lower().endswith(".npz"):
+        return loadNpz(path)
+    return loadH5(path)
+
+
+def saveTSV(name, sweeps):
+    with open(name, "w") as file:
+        max_rows = sweeps.maxLength()
+        for i in range(0, len(sweeps)):
+            file.write(f"{i}_Time (s)\t{i}_Wavlength (nm)\t{i}_Power (dBm)")
+            if i < len(sweeps) - 1:
+                file.write("\t")
+            else:
+                file.write("\n")
+
+        for j in range(0, max_rows):
+            for i in range(0, len(sweeps)):
+                sweep = sweeps[i]
+                if j < len(sweep):
+                    file.write(f"{sweep.t[j]:.4f}\t{sweep.wl[j]:.4f}\t{sweep.pwr[j]:.4f}")
+                else:
+                    file.write(f"\t\t")
+                if i < len(sweeps) - 1:
+                    file.write("\t")
+                else:
+                    file.write("\n")
+        file.close()
+
+
+def loadTSV(name):
+    # Columns are ragged: shorter sweeps leave their cells empty at the end
+    with open(name, "r") as file:
+        header = file.readline()
+        text = file.read()
+    nfields = len(header.rstrip("\n").split("\t"))
+    ncols = 3*(nfields//3)
+    try:
+        data = parseTSV(text, nfields)[:, :ncols]
+    except:
+        data = parseTSVLines(text, ncols)
+
+    store = sweepstore.SweepStore()
+    for i in range(ncols//3):
+        valid = np.nonzero(~np.isnan(data[:, 3*i]))[0]
+        n = valid[-1] + 1 if len(valid) > 0 else 0
+        store.add(sweepstore.Sweep.fromArrays(data[:n, 3*i], data[:n, 3*i + 1], data[:n, 3*i + 2]))
+    return store
+
+
+def parseTSV(text, nfields):
+    # Rows above the first empty cell are parsed in one go; only the ragged tail needs its
+    # empty cells filled with nan (runs of empty cells need two passes)
+    text = text.rstrip("\n") + "\n"
+    marks = [k for k in (text.find("\t\t"), text.find("\t\n"), text.find("\n\t")) if k >= 0]
+    if text.startswith("\t"):
+        marks.append(0)
+    split = text.rfind("\n", 0, min(marks)) + 1 if marks else len(text)
+
+    tail = text[split:]
+    tail = tail.replace("\t\t", "\tnan\t").replace("\t\t", "\tnan\t")
+    tail = tail.replace("\t\n", "\tnan\n").replace("\n\t", "\nnan\t")
+    if tail.startswith("\t"):
+        tail = "nan" + tail
+    values = np.concatenate((np.fromstring(text[:split], sep="\t"), np.fromstring(tail, sep="\t")))
+    return values.reshape(-1, nfields)
+
+
+def parseTSVLines(text, ncols):
+    # Field by field, for files the bulk parser rejects (rows with missing fields)
+    lines = text.splitlines()
+    data = np.full((len(lines), ncols), np.nan)
+    for i, line in enumerate(lines):
+        fields = line.split("\t")
+        for j in range(min(len(fields), ncols)):
+            if fields[j] != "":
+                data[i, j] = float(fields[j])
+    return data
+
+
+def loadCached(path):
+    # load() through an LRU cache keyed by path, mtime and size. The sweeps are shared
+    # with the cache and returned in a new SweepStore, so moving them elsewhere is safe.
+    stat = os.stat(path)
+    fullpath = os.path.abspath(path)
+    key = (fullpath, stat.st_mtime_ns, stat.st_size)
+    if key in cache:
+        cache.move_to_end(key)
+    else:
+        for old in [k for k in cache if k[0] == fullpath]:
+            del cache[old]
+        cache[key] = load(path)
+        while len(cache) > cache_size:
+            cache.popitem(last=False)
+    store, meta = cache[key]
+    copy = sweepstore.SweepStore()
+    for sweep in store:
+        copy.add(sweep)
+    return copy, dict(meta)
+
+
+def saveAverage(name, average):
+    np.savetxt(os.path.splitext(name)[0] + "_avg.txt", average.columns().T, fmt="%.6f", delimiter="\t",
+               header="Wavelength (nm)\tMean (dBm)\tStd (dB)\tMin (dBm)\tMax (dBm)", comments="")
+
+
+def saveH5(path, sweeps, meta=None, compress=True):
+    if h5py is None:
+        raise ImportError("h5py is needed to write HDF5 measurement files")
+    with h5py.File(path, "w") as file:
+        file.attrs["format_version"] = format_version
+        for key, value in (meta or {}).items():
+            file.attrs[key] = value
+        group = file.create_group("sweeps")
+        for i, sweep in enumerate(sweeps):
+            g = group.create_group(str(i))
+            for key, value in sweepMeta(sweep).items():
+                g.attrs[key] = value
+            for name in sweepColumns(sweep):
+                data = np.ascontiguousarray(getattr(sweep, name), dtype=np.float64)
+                if compress and len(data) > 0:
+                    g.create_dataset(name, data=data, chunks=(min(len(data), chunk_size),),
+                                     compression="gzip", compression_opts=4, shuffle=True)
+                else:
+                    g.create_dataset(name, data=data)
+
+
+def h5Source(path, file, group):
+    def source(name):
+        if name not in file[group]:
+            return None
+        ds = file[group][name]
+        offset = ds.id.get_offset()
+        if ds.chunks is None and ds.compression is None and offset is not None:
+            return np.memmap(path, dtype=ds.dtype, mode="r", offset=offset, shape=ds.shape)
+        return ds[()]
+    return source
+
+
+def loadH5(path):
+    # Returns (SweepStore of LazySweep, run metadata). The file stays open until the
+    # sweeps are garbage collected or the file is released.
+    if h5py is None:
+        raise ImportError("h5py is needed to read HDF5 measurement files")
+    file = h5py.File(path, "r")
+    meta = dict(file.attrs)
+    store = sweepstore.SweepStore()
+    groups = sorted(file["sweeps"].keys(), key=int)
+    for key in groups:
+        g = file["sweeps"][key]
+        store.add(LazySweep(h5Source(path, file, "sweeps/" + key), g["pwr"].shape[0], dict(g.attrs)))
+    track(path, file, store)
+    return store, meta
+
+
+def saveNpz(path, sweeps, meta=None, compress=True):
+    arrays = {}
+    sweepmeta = []
+    for i, sweep in enumerate(sweeps):
+        m = sweepMeta(sweep)
+        m["n"] = len(sweep)
+        sweepmeta.append(m)
+        for name in sweepColumns(sweep):
+            arrays[f"{name}_{i}"] = np.asarray(getattr(sweep, name), dtype=np.float64)
+    header = dict(meta or {})
+    header["format_version"] = format_version
+    header["sweeps"] = sweepmeta
+    arrays["meta"] = np.array(json.dumps(header))
+    if compress:
+        np.savez_compressed(path, **arrays)
+    else:
+        np.savez(path, **arrays)
+
+
+def loadNpz(path):
+    archive = np.load(path)
+    header = json.loads(str(archive["meta"]))
+    sweepmeta = header.pop("sweeps")
+    store = sweepstore.SweepStore()
+    for i, m in enumerate(sweepmeta):
+        def source(name, i=i):
+            key = f"{name}_{i}"
+            return archive[key] if key in archive.files else None
+        store.add(LazySweep(source, m["n"], m))
+    track(path, archive, store)
+    return store, header
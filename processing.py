@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized post-processing of sweeps.
+"""
+
+import numpy as np
+
+# A wavelength reading this close to the sweep end (nm) may have been taken after the
+# laser got there and stopped, so it says nothing about the sweep speed
+end_tolerance = 1e-4
+
+
+class SweepAverage:
+    # Repeated sweeps resampled onto a common wavelength grid
+
+    def __init__(self, wl, traces):
+        self.wl = wl
+        self.n = traces.shape[0]
+        self.mean = traces.mean(axis=0)
+        self.std = traces.std(axis=0)
+        self.min = traces.min(axis=0)
+        self.max = traces.max(axis=0)
+
+    def columns(self):
+        return np.vstack((self.wl, self.mean, self.std, self.min, self.max))
+
+
+def wavelengthAxes(sweeps):
+    # Fills every sweep's wavelength column from its launch/stop metadata in one pass.
+    # A sweep whose stop reading is at the sweep end may have been parked there for a
+    # while before it was read, so its slope is the nominal speed instead.
+    sweeps = [s for s in sweeps if len(s) > 0]
+    if len(sweeps) == 0:
+        return
+    lengths = np.array([len(s) for s in sweeps])
+    launchwl = np.array([s.launchwl for s in sweeps])
+    stopwl = np.array([s.stopwl for s in sweeps])
+    endwl = np.array([getattr(s, "endwl", 0.0) for s in sweeps])
+    speed = np.array([getattr(s, "speed", 0.0) for s in sweeps])
+    duration = np.array([s.stoptime - s.launchtime for s in sweeps])
+    slope = np.divide(stopwl - launchwl, duration, out=np.zeros(len(sweeps)), where=duration != 0)
+    parked = (endwl > 0) & (speed > 0) & (np.abs(stopwl - endwl) <= end_tolerance)
+    slope = np.where(parked, np.sign(endwl - launchwl)*speed, slope)
+
+    t = np.concatenate([s.t for s in sweeps])
+    wl = np.repeat(launchwl, lengths) + t*np.repeat(slope, lengths)
+    ends = np.cumsum(lengths)
+    for s, i1, n, p in zip(sweeps, ends, lengths, parked):
+        s.wl[:] = wl[i1 - n:i1]
+        if p:
+            clipWavelength(s)
+
+
+def clipWavelength(sweep):
+    # The laser stays at the sweep end once it gets there
+    if sweep.endwl >= sweep.launchwl:
+        np.minimum(sweep.wl, sweep.endwl, out=sweep.wl)
+    else:
+        np.maximum(sweep.wl, sweep.endwl, out=sweep.wl)
+
+
+def fitWavelengthAxis(sweep, degree=3):
+    # Replaces the linear wavelength axis with a polynomial fitted to the wavelength
+    # readings taken during the sweep, which follows a sweep speed that is not constant.
+    # Readings at the sweep end are left out (see wavelengthAxes). Sets sweep.timing to
+    # the fit summary and returns True if there were enough readings for a fit.
+    if len(sweep) < 2 or len(sweep.readbacks) == 0:
+        return False
+    rb = np.array(sweep.readbacks, dtype=np.float64)
+    moving = np.abs(rb[:, 1] - sweep.endwl) > end_tolerance
+    rb = rb[moving]
+    t = sweep.t
+    if len(rb) < 3 or rb[:, 0].max() - rb[:, 0].min() < 0.5*(t[-1] - t[0]):
+        # Readings too few or too close together (e.g. only the launch burst) to beat
+        # the linear axis
+        return False
+    # Closely spaced readings, like the launch burst, pin down a single point of the curve:
+    # a new group starts where the gap is more than a quarter of the largest one. The degree
+    # is limited by the number of groups and leaves at least one residual degree of freedom,
+    # so the fit error can be estimated.
+    t0, t1 = rb[:, 0].min(), rb[:, 0].max()
+    gaps = np.diff(np.sort(rb[:, 0]))
+    groups = 1 + np.count_nonzero(gaps > 0.25*gaps.max())
+    degree = min(degree, groups - 2, len(rb) - 2)
+    if degree < 1:
+        return False
+    fit, rms = polyFit(rb, 1)
+    if degree > 1:
+        # A higher degree is only kept if it clearly fits the readings better than a line
+        curve, curve_rms = polyFit(rb, degree)
+        if curve_rms < 0.5*rms:
+            fit, rms = curve, curve_rms
+        else:
+            degree = 1
+
+    # Outside the readings the fit is continued in a straight line
+    slope = fit.deriv()
+    tc = np.clip(t, t0, t1)
+    sweep.wl[:] = fit(tc) + slope(tc)*(t - tc)
+    if sweep.endwl > 0:
+        clipWavelength(sweep)
+    # Largest deviation of the fit from a constant speed sweep over the readings
+    tr = np.linspace(t0, t1, 256)
+    wr = fit(tr)
+    line = wr[0] + (tr - t0)*(wr[-1] - wr[0])/(t1 - t0)
+    sweep.timing = {"readbacks": len(rb), "degree": int(degree), "rms_nm": rms,
+                    "nonlinearity_nm": float(np.max(np.abs(wr - line)))}
+    return True
+
+
+def polyFit(rb, degree):
+    # Polynomial fit of (t, wl) readings and its residual RMS
+    fit = np.polynomial.Polynomial.fit(rb[:, 0], rb[:, 1], degree)
+    residuals = rb[:, 1] - fit(rb[:, 0])
+    return fit, float(np.sqrt(np.sum(residuals**2)/(len(rb) - degree - 1)))
+
+
+def wavelengthError(sweep):
+    # Per-sample wavelength uncertainty (nm, 1 sigma): the error of the wavelength axis fit,
+    # plus the wavelength swept while the power reading was in flight. A reading stamped at
+    # the midpoint of a round-trip of length L was taken within L/2 of its stamp, a uniform
+    # distribution with sigma L/sqrt(12).
+    if len(sweep) == 0:
+        sweep.wlerr = np.zeros(0)
+        return sweep.wlerr
+    slope = np.full(len(sweep), float(sweep.speed))
+    if len(sweep) > 1:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gradient = np.gradient(sweep.wl, sweep.t)
+        np.copyto(slope, gradient, where=np.isfinite(gradient))
+    rms = sweep.timing["rms_nm"] if sweep.timing is not None else 0.0
+    sweep.wlerr = np.sqrt(rms**2 + (slope*sweep.lat)**2/12.0)
+    return sweep.wlerr
+
+
+def applyWavelengthLog(sweep):
+    # Replaces the linear wavelength guess with the laser's lambda log. Logged point k
+    # was taken k*step/speed seconds after the sweep started; the log is aligned to the
+    # host time axis at the detected launch wavelength. Sets sweep.timing to the log summary.
+    logwl = sweep.logwl
+    if logwl is None or len(logwl) < 2 or sweep.speed <= 0 or len(sweep) == 0:
+        return False
+    logwl = np.asarray(logwl, dtype=np.float64)
+    tlog = np.arange(len(logwl))*(sweep.logstep/sweep.speed)
+    t0 = np.interp(sweep.launchwl, logwl, tlog)
+    sweep.wl[:] = np.interp(sweep.t + t0, tlog, logwl)
+    # The axis error is that of the linear interpolation between logged points, h^2/8 times
+    # the curvature, taken from the second differences of the log
+    curvature = np.diff(logwl, 2) if len(logwl) > 2 else np.zeros(1)
+    line = np.linspace(logwl[0], logwl[-1], len(logwl))
+    sweep.timing = {"logged": len(logwl), "rms_nm": float(np.sqrt(np.mean(curvature**2))/8.0),
+                    "nonlinearity_nm": float(np.max(np.abs(logwl - line)))}
+    return True
+
+
+def commonGrid(sweeps, npoints=None):
+    # Grid over the wavelength range covered by every sweep
+    wl0 = max(np.nanmin(s.wl) for s in sweeps)
+    wl1 = min(np.nanmax(s.wl) for s in sweeps)
+    if npoints is None:
+        npoints = max(len(s) for s in sweeps)
+    if wl1 <= wl0:
+        return None
+    return np.linspace(wl0, wl1, npoints)
+
+
+def averageSweeps(sweeps, npoints=None, linear=False):
+    # Resamples the sweeps onto a shared grid and returns mean, std and min/max traces.
+    # With linear=True the statistics are computed in mW and converted back to dBm.
+    sweeps = [s for s in sweeps if len(s) > 1]
+    if len(sweeps) == 0:
+        return None
+    grid = commonGrid(sweeps, npoints)
+    if grid is None:
+        return None
+
+    traces = np.empty((len(sweeps), len(grid)), dtype=np.float64)
+    for i, s in enumerate(sweeps):
+        wl = s.wl
+        pwr = s.pwr
+        if wl[-1] < wl[0]:
+            wl = wl[::-1]
+            pwr = pwr[::-1]
+        traces[i] = np.interp(grid, wl, pwr)
+
+    if not linear:
+        return SweepAverage(grid, traces)
+
+    avg = SweepAverage(grid, 10.0**(traces/10.0))
+    std_hi = avg.mean + avg.std
+    avg.mean = 10.0*np.log10(avg.mean)
+    avg.std = 10.0*np.log10(std_hi) - avg.mean
+    avg.min = 10.0*np.log10(avg.min)
+    avg.max = 10.0*np.log10(avg.max)
+    return avg
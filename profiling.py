@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Timing instrumentation for drivers and pipeline stages.
+
+A Profiler keeps one log-binned latency histogram per name. Driver methods are
+timed through a view of the driver that belongs to the profiler (proxy()), so
+a driver shared by several engines is timed separately by each of them.
+Pipeline stages are timed with the stage() context manager, and anything else
+with record(). The report can be shown as
+a one-line summary or dumped as JSON.
+"""
+
+import json
+import math
+import time
+import numpy as np
+from threading import Lock
+from contextlib import contextmanager
+
+
+class LatencyHistogram:
+
+    # 10 bins per decade from 100 ns to 100 s; bin i holds edges[i-1] < dt <= edges[i]
+    decades = 10
+    lowest = -7
+    edges = np.logspace(-7, 2, 91)
+
+    def __init__(self):
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.n = 0
+        self.total = 0.0
+        self.total2 = 0.0
+        self.min = np.inf
+        self.max = 0.0
+
+    def record(self, dt):
+        i = 0
+        if dt > 0:
+            i = min(max(math.ceil((math.log10(dt) - self.lowest)*self.decades), 0), len(self.edges))
+        self.counts[i] += 1
+        self.n += 1
+        self.total += dt
+        self.total2 += dt*dt
+        if dt < self.min:
+            self.min = dt
+        if dt > self.max:
+            self.max = dt
+
+    def extend(self, dts):
+        # Vectorized record() for a batch of samples
+        if len(dts) == 0:
+            return
+        with np.errstate(divide="ignore", invalid="ignore"):
+            idx = np.ceil((np.log10(dts) - self.lowest)*self.decades)
+        idx = np.clip(np.nan_to_num(idx, nan=0.0, neginf=0.0), 0, len(self.edges)).astype(np.intp)
+        self.counts += np.bincount(idx, minlength=len(self.counts))
+        self.n += len(dts)
+        self.total += float(np.sum(dts))
+        self.total2 += float(np.dot(dts, dts))
+        self.min = min(self.min, float(np.min(dts)))
+        self.max = max(self.max, float(np.max(dts)))
+
+    def mean(self):
+        return self.total/self.n if self.n > 0 else 0.0
+
+    def std(self):
+        if self.n < 2:
+            return 0.0
+        var = (self.total2 - self.total*self.total/self.n)/(self.n - 1)
+        return float(np.sqrt(max(var, 0.0)))
+
+    def percentile(self, q):
+        # Upper edge of the bin holding the q-th percentile
+        if self.n == 0:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(self.counts), q/100.0*self.n))
+        return float(self.edges[min(i, len(self.edges) - 1)])
+
+    def report(self):
+        return {"count": self.n, "total_s": self.total, "mean_s": self.mean(), "std_s": self.std(),
+                "min_s": float(self.min) if self.n else 0.0, "max_s": self.max,
+                "p50_s": self.percentile(50), "p99_s": self.percentile(99),
+                "histogram": {"edges_s": self.edges.tolist(),
+                              "bins": {int(i): int(self.counts[i]) for i in np.nonzero(self.counts)[0]}}}
+
+
+class ProfiledDriver:
+    # Passes everything through to the driver, except the timed methods
+
+    def __init__(self, driver, timed):
+        self.driver = driver
+        self.__dict__.update(timed)
+
+    def __getattr__(self, name):
+        return getattr(self.driver, name)
+
+
+class Profiler:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.hists = {}
+        self.t0 = time.perf_counter()
+
+    def reset(self):
+        with self.lock:
+            self.hists = {}
+            self.t0 = time.perf_counter()
+
+    def record(self, name, dt):
+        with self.lock:
+            hist = self.hists.get(name)
+            if hist is None:
+                hist = self.hists[name] = LatencyHistogram()
+            hist.record(dt)
+
+    def extend(self, name, dts):
+        with self.lock:
+            hist = self.hists.get(name)
+            if hist is None:
+                hist = self.hists[name] = LatencyHistogram()
+            hist.extend(dts)
+
+    @contextmanager
+    def stage(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t)
+
+    def proxy(self, obj, methods, prefix):
+        # obj with the listed methods timed into this profiler; obj itself is left alone
+        return ProfiledDriver(obj, {name: self.timed(getattr(obj, name), f"{prefix}.{name}")
+                                    for name in methods if hasattr(obj, name)})
+
+    def timed(self, method, key):
+        def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.record(key, time.perf_counter() - t)
+        return wrapper
+
+    def get(self, name):
+        return self.hists.get(name, LatencyHistogram())
+
+    def report(self, extra=None):
+        with self.lock:
+            stages = {name: self.hists[name].report() for name in sorted(self.hists)}
+        report = {"elapsed_s": time.perf_counter() - self.t0, "stages": stages}
+        if extra is not None:
+            report.update(extra)
+        return report
+
+    def summary(self, exclude=(), count=3):
+        # Short "name mean/p99" list for the status bar, the stages with the most total time first
+        with self.lock:
+            items = [(name, h) for name, h in self.hists.items() if name not in exclude]
+        items.sort(key=lambda item: -item[1].total)
+        return ", ".join(f"{name} {formatTime(h.mean())}/{formatTime(h.percentile(99))}"
+                         for name, h in items[:count])
+
+    def dump(self, path, extra=None):
+        with open(path, "w") as file:
+            json.dump(self.report(extra), file, indent=1)
+
+
+def formatTime(dt):
+    if dt < 1e-3:
+        return f"{dt*1e6:.0f} us"
+    if dt < 1.0:
+        return f"{dt*1e3:.1f} ms"
+    return f"{dt:.2f} s"
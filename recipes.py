@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Named sweep recipes and GUI settings, in one versioned JSON file.
+
+    {"version": 1,
+     "recipes": {"ring 1550": {"start": 1545.0, "stop": 1555.0, "speed": 5.0, ...}},
+     "gui": {"lastdir": "...", "recipe": "ring 1550", "widgets": {"speedSpin": 5.0, ...}},
+     "devices": {"laser": "GPIB0::17::INSTR", "pm": "USB0::0x1313::...::INSTR"}}
+
+A Recipe holds everything needed to repeat a measurement on another device
+(range, speed, slot, repeats, GPIB address and logging options). Values are
+checked against the field types when the file is read, so a hand-edited file
+with a typo fails with a clear message instead of a bad sweep. Files written
+by the old GUI (settings.p, a pickled dict of widget states) are imported once.
+"devices" caches the VISA resources the instruments were last found at.
+
+The file lives next to the scripts by default, for both loading and saving.
+"""
+
+import os, json, pickle
+from dataclasses import dataclass, asdict, fields
+
+import sweepengine
+
+version = 1
+default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.json")
+# The old GUI loaded settings.p from the script directory but saved it to the working directory
+legacy_paths = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.p"), "settings.p"]
+
+
+@dataclass
+class Recipe:
+    name: str = ""
+    start: float = 1550.0
+    stop: float = 1560.0
+    speed: float = 1.0
+    slot: int = 0
+    sweeps: int = 1
+    address: int = 17
+    hwlog: bool = False
+    logstep: float = 1.0
+    turnoff: bool = False
+
+    @classmethod
+    def fromDict(cls, name, values):
+        kwargs = {"name": name}
+        for f in fields(cls):
+            if f.name == "name" or f.name not in values:
+                continue
+            value = values[f.name]
+            if f.type is float and isinstance(value, int) and not isinstance(value, bool):
+                value = float(value)
+            if type(value) is not f.type:
+                raise ValueError(f"Recipe '{name}': {f.name} should be {f.type.__name__}, not {value!r}")
+            kwargs[f.name] = value
+        return cls(**kwargs)
+
+    def toDict(self):
+        values = asdict(self)
+        del values["name"]
+        return values
+
+    def params(self, **kwargs):
+        # SweepParams for this recipe; logstep is stored in pm like in the GUI
+        return sweepengine.SweepParams(start=self.start, stop=self.stop, speed=self.speed, slot=self.slot,
+                                       sweeps=self.sweeps, hwlog=self.hwlog, logstep=self.logstep/1000.0,
+                                       turnoff=self.turnoff, **kwargs)
+
+
+class RecipeStore:
+
+    def __init__(self, path=default_path):
+        self.path = path
+        self.recipes = {}
+        self.gui = {}
+        self.devices = {}
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            self.importLegacy()
+            return self
+        with open(self.path, "r") as file:
+            data = json.load(file)
+        if data.get("version", 0) > version:
+            raise ValueError(f"{self.path} was written by a newer version (format {data['version']})")
+        self.recipes = {name: Recipe.fromDict(name, values) for name, values in data.get("recipes", {}).items()}
+        self.gui = data.get("gui", {})
+        self.devices = data.get("devices", {})
+        return self
+
+    def importLegacy(self, paths=legacy_paths):
+        # The old GUI pickled {widget name: value, "__lastdir__": dir}; the newest file wins
+        found = [p for p in paths if os.path.isfile(p)]
+        if len(found) == 0:
+            return False
+        try:
+            with open(max(found, key=os.path.getmtime), "rb") as file:
+                old = pickle.load(file)
+        except:
+            return False
+        self.gui = {"lastdir": old.get("__lastdir__", ""),
+                    "widgets": {k: v for k, v in old.items() if k[:2] != "__" and k[-2:] != "__"}}
+        return True
+
+    def save(self):
+        # Written to a temporary file first, so a crash never leaves half a file behind
+        data = {"version": version,
+                "recipes": {name: self.recipes[name].toDict() for name in sorted(self.recipes)},
+                "gui": self.gui,
+                "devices": self.devices}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as file:
+            json.dump(data, file, indent=1)
+        os.replace(tmp, self.path)
+
+    def names(self):
+        return sorted(self.recipes)
+
+    def get(self, name):
+        if name not in self.recipes:
+            raise KeyError(f"No recipe '{name}' in {self.path} (have: {', '.join(self.names()) or 'none'})")
+        return self.recipes[name]
+
+    def put(self, recipe):
+        self.recipes[recipe.name] = recipe
+
+    def remove(self, name):
+        self.recipes.pop(name, None)
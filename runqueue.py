@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent queue of sweep jobs for unattended runs.
+
+    python runqueue.py add -o dev1.h5 --recipe "ring 1550"
+    python runqueue.py add -o dev2.h5 --start 1540 --stop 1560 --speed 5 --sweeps 10
+    python runqueue.py list
+    python runqueue.py run --simulate
+
+Jobs are kept in queue.json next to the scripts, and every state change is
+written to it at once, so the queue survives restarts. A job that was running
+or being saved when the program stopped is run again, and a job that fails is
+retried up to max_attempts times before it is marked failed.
+
+QueueRunner runs the pending jobs back to back on one SweepEngine, driven by
+poll() like the engine. When a job's last sweep ends, its data is handed to a
+writer thread and the next job starts right away, so files are written while
+the laser is already sweeping. The instruments are the ones the engine was
+opened with; the GPIB address stored in a job's recipe is not switched to.
+"""
+
+import os, sys, time, json, argparse, traceback
+from dataclasses import dataclass
+from queue import Queue
+from threading import Thread, RLock
+
+import recipes
+import sweepengine
+
+version = 1
+default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "queue.json")
+
+
+@dataclass
+class Job:
+
+    PENDING = "pending"
+    RUNNING = "running"
+    SAVING = "saving"
+    DONE = "done"
+    FAILED = "failed"
+
+    id: int
+    output: str
+    recipe: recipes.Recipe
+    state: str = "pending"
+    attempts: int = 0
+    error: str = ""
+    started: str = ""
+    finished: str = ""
+
+    @classmethod
+    def fromDict(cls, values):
+        values = dict(values)
+        values["recipe"] = recipes.Recipe.fromDict(values.get("name", ""), values.pop("recipe"))
+        values.pop("name", None)
+        return cls(**values)
+
+    def toDict(self):
+        values = {k: getattr(self, k) for k in ("id", "output", "state", "attempts", "error", "started", "finished")}
+        values["name"] = self.recipe.name
+        values["recipe"] = self.recipe.toDict()
+        return values
+
+    def describe(self):
+        r = self.recipe
+        label = f" '{r.name}'" if r.name else ""
+        return (f"#{self.id}{label} {r.start}-{r.stop} nm @ {r.speed} nm/s x{r.sweeps} -> {self.output} "
+                f"[{self.state}{', ' + self.error if self.error else ''}]")
+
+
+class RunQueue:
+
+    max_attempts = 3
+
+    def __init__(self, path=default_path):
+        self.path = path
+        self.jobs = []
+        self.lock = RLock()
+
+    def load(self):
+        # Jobs that were interrupted while running or saving are run again
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as file:
+                data = json.load(file)
+            if data.get("version", 0) > version:
+                raise ValueError(f"{self.path} was written by a newer version (format {data['version']})")
+            self.jobs = [Job.fromDict(values) for values in data.get("jobs", [])]
+        for job in self.jobs:
+            if job.state in (Job.RUNNING, Job.SAVING):
+                job.state = Job.PENDING if job.attempts < self.max_attempts else Job.FAILED
+        return self
+
+    def save(self):
+        with self.lock:
+            data = {"version": version, "jobs": [job.toDict() for job in self.jobs]}
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as file:
+                json.dump(data, file, indent=1)
+            os.replace(tmp, self.path)
+
+    def add(self, recipe, output):
+        with self.lock:
+            job = Job(max([j.id for j in self.jobs] + [0]) + 1, output, recipe)
+            self.jobs.append(job)
+            self.save()
+        return job
+
+    def update(self, job, **changes):
+        # Changes a job and writes the queue file; called from the runner and the writer thread
+        with self.lock:
+            for key, value in changes.items():
+                setattr(job, key, value)
+            self.save()
+
+    def next(self):
+        with self.lock:
+            for job in self.jobs:
+                if job.state == Job.PENDING:
+                    return job
+        return None
+
+    def count(self, state):
+        with self.lock:
+            return sum(1 for job in self.jobs if job.state == state)
+
+    def outputPath(self, job):
+        # Relative outputs are relative to the queue file
+        if os.path.isabs(job.output):
+            return job.output
+        return os.path.join(os.path.dirname(os.path.abspath(self.path)), job.output)
+
+
+class ResultWriter:
+    # Saves finished jobs on a background thread, one at a time, in the order submitted
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.todo = Queue()
+        # Called with (job, result) on this thread once a job is saved
+        self.onSaved = None
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, job, result):
+        self.todo.put((job, result))
+
+    def pending(self):
+        return self.todo.unfinished_tasks
+
+    def wait(self):
+        self.todo.join()
+
+    def run(self):
+        while True:
+            job, result = self.todo.get()
+            path = self.queue.outputPath(job)
+            try:
+                folder = os.path.dirname(path)
+                if folder != "":
+                    os.makedirs(folder, exist_ok=True)
+                sweepengine.saveResult(path, result, profile=True)
+                self.queue.update(job, state=Job.DONE, error="", finished=time.strftime("%Y-%m-%dT%H:%M:%S"))
+                if self.onSaved is not None:
+                    try:
+                        self.onSaved(job, result)
+                    except Exception as e:
+                        self.queue.update(job, error=f"saved, but onSaved failed: {e}")
+            except Exception as e:
+                # The data is only in memory: keep it next to the queue file rather than losing it
+                rescue = os.path.join(os.path.dirname(os.path.abspath(self.queue.path)),
+                                      f"lost_job{job.id}_{time.time():.0f}.npz")
+                try:
+                    sweepengine.saveResult(rescue, result)
+                    error = f"could not write {path} ({e}), saved to {rescue}"
+                except:
+                    error = f"could not write {path} ({e})"
+                self.queue.update(job, state=Job.FAILED, error=error)
+            self.todo.task_done()
+
+
+class QueueRunner:
+
+    IDLE = 0
+    RUNNING = 1
+    DONE = 2
+
+    def __init__(self, engine, queue):
+        self.engine = engine
+        self.queue = queue
+        self.writer = None
+        self.job = None
+        self.state = self.IDLE
+        self.starttime = 0.0
+        self.elapsed = 0.0
+        self.swept = 0.0
+        self.jobs_run = 0
+        self.engine_done = None
+        self.onJobStart = None
+        self.onJobDone = None
+        # Called from the writer thread after a job's file is written, for work that should not
+        # hold up the poll() thread (e.g. archiving the sweeps)
+        self.onJobSaved = None
+        self.onDone = None
+        self.onStatus = None
+
+    def status(self, msg):
+        if self.onStatus is not None:
+            self.onStatus(msg)
+
+    def start(self):
+        if self.writer is None:
+            self.writer = ResultWriter(self.queue)
+        self.writer.onSaved = self.onJobSaved
+        self.starttime = time.perf_counter()
+        self.swept = 0.0
+        self.jobs_run = 0
+        self.engine_done = self.engine.onDone
+        self.engine.onDone = None
+        self.state = self.RUNNING
+        self.startNext()
+
+    def startNext(self):
+        self.job = self.queue.next()
+        if self.job is None:
+            self.state = self.DONE
+            self.status(f"Queue finished, saving the last results...")
+            return
+        job = self.job
+        self.queue.update(job, state=Job.RUNNING, attempts=job.attempts + 1,
+                          started=time.strftime("%Y-%m-%dT%H:%M:%S"))
+        self.status(f"Job {job.describe()}")
+        if self.onJobStart is not None:
+            self.onJobStart(job)
+        try:
+            self.engine.start(job.recipe.params(timeout=self.engine.params.timeout))
+        except Exception as e:
+            self.fail(e)
+
+    def poll(self):
+        if self.state == self.DONE:
+            # Done once the writer has saved everything
+            if self.writer.pending() == 0:
+                self.finish()
+            return 0
+        if self.state != self.RUNNING:
+            return 0
+        try:
+            n = self.engine.poll()
+        except Exception as e:
+            self.fail(e)
+            return 0
+        if self.engine.state == self.engine.DONE:
+            self.jobDone()
+        return n
+
+    def jobDone(self):
+        job = self.job
+        swept = sum(sweep.t[-1] for sweep in self.engine.sweeps if len(sweep) > 1)
+        if swept == 0:
+            self.fail(RuntimeError("no samples were measured"))
+            return
+        self.swept += swept
+        self.jobs_run += 1
+        self.queue.update(job, state=Job.SAVING)
+        result = self.engine.result()
+        if self.onJobDone is not None:
+            self.onJobDone(job, result)
+        self.writer.submit(job, result)
+        self.startNext()
+
+    def fail(self, error):
+        job = self.job
+        traceback.print_exception(type(error), error, error.__traceback__)
+        try:
+            self.engine.stop()
+        except:
+            pass
+        state = Job.PENDING if job.attempts < self.queue.max_attempts else Job.FAILED
+        self.queue.update(job, state=state, error=str(error))
+        self.startNext()
+
+    def stop(self):
+        # Aborts the current job, which stays pending, and waits for the writer
+        if self.state == self.RUNNING and self.job is not None:
+            self.engine.stop()
+            self.queue.update(self.job, state=Job.PENDING, attempts=max(self.job.attempts - 1, 0))
+        if self.writer is not None:
+            self.writer.wait()
+        self.finish()
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.starttime
+        self.state = self.IDLE
+        self.engine.onDone = self.engine_done
+        self.status(self.summary())
+        if self.onDone is not None:
+            self.onDone()
+
+    def dutyCycle(self):
+        # Fraction of the run the laser spent sweeping
+        elapsed = self.elapsed if self.state == self.IDLE else time.perf_counter() - self.starttime
+        return self.swept/elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        return (f"{self.jobs_run} jobs in {self.elapsed:.1f} s, sweeping {100.0*self.dutyCycle():.0f}% of the time; "
+                f"{self.queue.count(Job.DONE)} done, {self.queue.count(Job.PENDING)} pending, "
+                f"{self.queue.count(Job.FAILED)} failed")
+
+    def run(self, poll_interval=0.02):
+        self.start()
+        while self.state != self.IDLE:
+            time.sleep(poll_interval)
+            self.poll()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Queue sweep jobs and run them unattended")
+    parser.add_argument("--queue", default=default_path, help="queue file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="add a job")
+    add.add_argument("-o", "--output", required=True, help="output file (.txt, .h5 or .npz)")
+    add.add_argument("--recipe", help="named recipe; the options below override its values")
+    add.add_argument("--recipes", help="recipe file (default: settings.json next to the scripts)")
+    add.add_argument("--start", type=float, help="start wavelength (nm)")
+    add.add_argument("--stop", type=float, help="stop wavelength (nm)")
+    add.add_argument("--speed", type=float, help="sweep speed (nm/s)")
+    add.add_argument("--slot", type=int, help="laser slot")
+    add.add_argument("--sweeps", type=int, help="number of repeated sweeps")
+    add.add_argument("--hwlog", action="store_true", default=None, help="use the laser's lambda logging")
+    add.add_argument("--logstep", type=float, help="lambda logging step (pm)")
+
+    commands.add_parser("list", help="show the jobs")
+    retry = commands.add_parser("retry", help="make failed jobs pending again")
+    retry.add_argument("ids", type=int, nargs="*", help="job ids (default: all failed)")
+    commands.add_parser("clear", help="remove the jobs that are done")
+
+    run = commands.add_parser("run", help="run the pending jobs")
+    run.add_argument("--address", type=int, default=17, help="laser GPIB address")
+    run.add_argument("--simulate", action="store_true", help="use simulated instruments")
+    run.add_argument("--sim-seed", type=int, default=0, help="simulation random seed")
+    args = parser.parse_args(argv)
+
+    queue = RunQueue(args.queue).load()
+    if args.command == "add":
+        store = recipes.RecipeStore(args.recipes or recipes.default_path)
+        try:
+            recipe = store.load().get(args.recipe) if args.recipe is not None else recipes.Recipe()
+        except (KeyError, ValueError) as e:
+            print(e.args[0])
+            return 1
+        if args.recipe is None and (args.start is None or args.stop is None):
+            parser.error("--start and --stop are required without --recipe")
+        for key in ("start", "stop", "speed", "slot", "sweeps", "hwlog", "logstep"):
+            if getattr(args, key) is not None:
+                setattr(recipe, key, getattr(args, key))
+        print(queue.add(recipe, args.output).describe())
+    elif args.command == "list":
+        for job in queue.jobs:
+            print(job.describe())
+    elif args.command == "retry":
+        for job in queue.jobs:
+            if job.state == Job.FAILED and (len(args.ids) == 0 or job.id in args.ids):
+                queue.update(job, state=Job.PENDING, attempts=0, error="")
+    elif args.command == "clear":
+        with queue.lock:
+            queue.jobs = [job for job in queue.jobs if job.state != Job.DONE]
+            queue.save()
+    elif args.command == "run":
+        laser, pm = sweepengine.openDevices(args.address, args.simulate, {"seed": args.sim_seed})
+        if not laser.laserOK or not pm.ok:
+            print("Could not open the instruments")
+            return 1
+        engine = sweepengine.SweepEngine(laser, pm)
+        runner = QueueRunner(engine, queue)
+        runner.onStatus = print
+        try:
+            runner.run()
+        except KeyboardInterrupt:
+            runner.stop()
+        finally:
+            engine.close(devices=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
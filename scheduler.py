@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Sweeps on several laser slots, each read by its own power meter.
+
+Every channel is a (slot, power meter) pair driven by its own SweepEngine, so
+each keeps its own acquisition thread, sample stream, checkpoint and result.
+All channels share one laser mainframe and one laser I/O worker, which keeps
+the mainframe's GPIB traffic serialized.
+
+    concurrent   all slots sweep at the same time (default)
+    interleaved  one sweep per channel in turn, repeated `sweeps` times
+"""
+
+import os, sys, time, argparse
+from dataclasses import replace
+
+import asyncdrivers
+import processing
+import sweepengine
+import sweepstore
+
+
+class Channel:
+
+    def __init__(self, slot, pm, params, checkpoint_path=None, laser_io=None, laser=None):
+        self.slot = slot
+        self.pm = pm
+        self.params = replace(params, slot=slot)
+        self.engine = sweepengine.SweepEngine(laser, pm, checkpoint_path, laser_io)
+        self.sweeps = sweepstore.SweepStore()
+        self.average = None
+
+    def busy(self):
+        return self.engine.state in (self.engine.LAUNCHING, self.engine.SWEEPING, self.engine.DOWNLOADING)
+
+
+class ChannelScheduler:
+
+    def __init__(self, laser, pms, slots, params, mode="concurrent", checkpoint_base=None):
+        if len(pms) != len(slots):
+            raise ValueError("One power meter is needed per laser slot")
+        self.laser = laser
+        self.laser_io = asyncdrivers.AsyncInstrument(laser, "laser")
+        self.mode = mode
+        self.channels = []
+        for slot, pm in zip(slots, pms):
+            path = None
+            if checkpoint_base is not None:
+                path = f"{checkpoint_base}_slot{slot}.ckpt"
+            self.channels.append(Channel(slot, pm, params, path, self.laser_io, laser))
+
+        self.onStatus = None
+
+    def status(self, msg):
+        if self.onStatus is not None:
+            self.onStatus(msg)
+
+    def pollAll(self, poll_interval):
+        while any(ch.busy() for ch in self.channels):
+            time.sleep(poll_interval)
+            for ch in self.channels:
+                ch.engine.poll()
+
+    def run(self, poll_interval=0.02):
+        if self.mode == "interleaved":
+            self.runInterleaved(poll_interval)
+        else:
+            self.runConcurrent(poll_interval)
+        return self.channels
+
+    def runConcurrent(self, poll_interval):
+        for ch in self.channels:
+            ch.engine.start(ch.params)
+        self.pollAll(poll_interval)
+        for ch in self.channels:
+            ch.sweeps = ch.engine.sweeps
+            ch.average = ch.engine.average
+        self.status(f"{len(self.channels)} channels done")
+
+    def runInterleaved(self, poll_interval):
+        repeats = self.channels[0].params.sweeps
+        for ch in self.channels:
+            ch.sweeps = sweepstore.SweepStore()
+        for r in range(repeats):
+            for ch in self.channels:
+                self.status(f"Slot {ch.slot}: sweep {r + 1}/{repeats}")
+                # Later repeats continue the channel's run, so its profile and checkpoint cover every sweep
+                if r == 0:
+                    ch.engine.start(replace(ch.params, sweeps=1))
+                else:
+                    ch.engine.resume(replace(ch.params, sweeps=1))
+                self.pollAll(poll_interval)
+                ch.engine.sweeps.moveTo(ch.sweeps)
+        for ch in self.channels:
+            if len(ch.sweeps) > 1:
+                ch.average = processing.averageSweeps(ch.sweeps)
+
+    def save(self, path):
+        # One file per channel: <name>_slot<n>.<ext>
+        base, ext = os.path.splitext(path)
+        paths = []
+        for ch in self.channels:
+            chpath = f"{base}_slot{ch.slot}{ext}"
+            ch.engine.params = ch.params
+            ch.engine.sweeps = ch.sweeps
+            ch.engine.average = ch.average
+            ch.engine.save(chpath)
+            paths.append(chpath)
+        return paths
+
+    def close(self, devices=False):
+        for ch in self.channels:
+            ch.engine.close(devices=False)
+        if devices:
+            for ch in self.channels:
+                ch.pm.close()
+            self.laser.closelaser()
+        self.laser_io.close()
+
+
+def openChannels(slots, address=17, simulate=False, sim_options={}):
+    # Laser plus one power meter per slot, taken in the order they are found on the bus
+    if simulate:
+        import simulated
+        laser, pms = simulated.createChannels(slots, **sim_options)
+        for pm in pms:
+            pm.init()
+    else:
+        import agilent816xb
+        import thorlabsPM300
+        laser = agilent816xb.Agilent816xb()
+        pms = []
+        for i in range(len(slots)):
+            pm = thorlabsPM300.ThorLabsPM300()
+            pm.init(i)
+            pms.append(pm)
+    laser.connectlaser(True, address)
+    return laser, pms
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run sweeps on several laser slots at once")
+    parser.add_argument("--slots", type=int, nargs="+", required=True, help="laser slots, one power meter each")
+    parser.add_argument("--mode", choices=["concurrent", "interleaved"], default="concurrent")
+    parser.add_argument("--start", type=float, required=True, help="start wavelength (nm)")
+    parser.add_argument("--stop", type=float, required=True, help="stop wavelength (nm)")
+    parser.add_argument("--speed", type=float, default=1.0, help="sweep speed (nm/s)")
+    parser.add_argument("--sweeps", type=int, default=1, help="number of repeated sweeps")
+    parser.add_argument("--address", type=int, default=17, help="laser GPIB address")
+    parser.add_argument("-o", "--output", required=True, help="output file, one per slot (.txt, .h5 or .npz)")
+    parser.add_argument("--simulate", action="store_true", help="use simulated instruments")
+    args = parser.parse_args(argv)
+
+    laser, pms = openChannels(args.slots, args.address, args.simulate)
+    if not laser.laserOK or not all(pm.ok for pm in pms):
+        print("Could not open the instruments")
+        return 1
+
+    params = sweepengine.SweepParams(start=args.start, stop=args.stop, speed=args.speed, sweeps=args.sweeps)
+    sched = ChannelScheduler(laser, pms, args.slots, params, args.mode)
+    sched.onStatus = print
+    try:
+        sched.run()
+        for path in sched.save(args.output):
+            print(f"Saved {path}")
+    finally:
+        sched.close(devices=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk transfers of IEEE 488.2 definite-length blocks (#<n><length><data>)
+straight into NumPy arrays.
+"""
+
+import numpy as np
+
+# Conservative sustained rate of a GPIB/USB link, used to size the read timeout
+bus_rate = 200e3
+base_timeout = 2000
+max_chunk = 2**20
+
+
+def parseBlock(raw, dtype='<f8'):
+    # Returns the payload of a definite (#<n><len>) or indefinite (#0) length block
+    start = raw.find(b"#")
+    if start < 0:
+        raise ValueError("No IEEE 488.2 block header found")
+    ndigits = int(raw[start + 1:start + 2])
+    if ndigits == 0:
+        payload = raw[start + 2:].rstrip(b"\r\n")
+    else:
+        length = int(raw[start + 2:start + 2 + ndigits])
+        offset = start + 2 + ndigits
+        payload = raw[offset:offset + length]
+        if len(payload) < length:
+            raise ValueError(f"Truncated block: expected {length} bytes, got {len(payload)}")
+    itemsize = np.dtype(dtype).itemsize
+    return np.frombuffer(payload[:len(payload) - len(payload) % itemsize], dtype=dtype)
+
+
+def transferSettings(npoints, itemsize=8):
+    # Chunk size and timeout (ms) for a block of npoints values
+    nbytes = npoints*itemsize + 16
+    chunk = int(min(max(nbytes, 20*1024), max_chunk))
+    timeout = int(base_timeout + 1000.0*nbytes/bus_rate)
+    return chunk, timeout
+
+
+def queryBlock(resource, cmd, datatype='d', is_big_endian=False, npoints=None):
+    # Reads a binary block in as few transactions as possible, using pyvisa's block reader
+    # (which copes with termination characters inside the payload). If npoints is known
+    # the chunk size and timeout are sized for the whole transfer.
+    itemsize = np.dtype(datatype).itemsize
+    old_timeout = resource.timeout
+    try:
+        chunk = None
+        if npoints is not None:
+            chunk, resource.timeout = transferSettings(npoints, itemsize)
+        return resource.query_binary_values(cmd, datatype=datatype, is_big_endian=is_big_endian,
+                                            container=np.array, data_points=npoints or 0,
+                                            chunk_size=chunk)
+    finally:
+        resource.timeout = old_timeout
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated instruments with the same interface as Agilent816xb and ThorLabsPM300.
+
+The laser sweeps in real time from the moment its sweep is started, the power
+meter reads the laser's current wavelength through a spectral model, and every
+call can be given a fixed latency (zero by default). All randomness comes from
+one seeded generator, so runs are reproducible.
+"""
+
+import math
+import time
+import numpy as np
+
+
+class SpectralModel:
+    # Transmission (mW) of a device with Lorentzian dips on a flat baseline.
+    # `features` holds (center nm, FWHM nm, depth 0-1) tuples. With fsr > 0 the dips
+    # repeat every fsr nm, like a ring resonator, so any sweep range shows features.
+
+    def __init__(self, power_mw=1.0, features=((1550.0, 0.05, 0.9),), fsr=2.0):
+        self.power_mw = power_mw
+        self.features = [tuple(f) for f in features]
+        self.fsr = fsr
+
+    def __call__(self, wl):
+        t = 1.0
+        for center, fwhm, depth in self.features:
+            d = wl - center
+            if self.fsr > 0:
+                d = (d + 0.5*self.fsr) % self.fsr - 0.5*self.fsr
+            x = 2.0*d/fwhm
+            t -= depth/(1.0 + x*x)
+        return self.power_mw*max(t, 1e-9)
+
+    def evaluate(self, wl):
+        wl = np.asarray(wl, dtype=np.float64)
+        t = np.ones_like(wl)
+        for center, fwhm, depth in self.features:
+            d = wl - center
+            if self.fsr > 0:
+                d = (d + 0.5*self.fsr) % self.fsr - 0.5*self.fsr
+            x = 2.0*d/fwhm
+            t -= depth/(1.0 + x*x)
+        return self.power_mw*np.maximum(t, 1e-9)
+
+
+class SimulatedLaser:
+
+    gpib = True
+    gpibAddr = 17
+    visaOK = True
+    laser = None
+    laserOK = False
+    laserID = "SIMULATED,816xB,0,0"
+    resource = ""
+
+    def __init__(self, latency=0.0, start_delay=0.2, nonlinearity=0.0, seed=0, clock=time.perf_counter):
+        self.latency = latency
+        self.start_delay = start_delay
+        self.nonlinearity = nonlinearity
+        self.rng = np.random.default_rng(seed)
+        self.clock = clock
+        self.slots = {}
+        self.active_slot = 0
+
+    def slot(self, slot):
+        if slot not in self.slots:
+            self.slots[slot] = {"wl": 1550.0, "pwr": 0.0, "state": False, "mode": "CONT",
+                                "start": 1550.0, "stop": 1560.0, "step": 1.0, "speed": 1.0,
+                                "t0": None, "llog": False, "trig": "DIS", "log": np.zeros(0)}
+        return self.slots[slot]
+
+    def wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    # laser functions
+
+    def connectlaser(self, isgpib=True, address=17, iseth=False, ethip="192.168.1.2", ethport=10001):
+        self.gpibAddr = address
+        self.resource = f"GPIB0::{address}::INSTR"
+        self.laserOK = True
+
+    def initlaser(self):
+        return 0
+
+    def forgetSettings(self):
+        return 0
+
+    def enableAll(self):
+        for i in range(0, 5):
+            self.setState(i, True)
+
+    def disableAll(self):
+        for i in range(0, 5):
+            self.setState(i, False)
+
+    def closelaser(self):
+        self.laserOK = False
+
+    def sweepWL(self, s, t, t0):
+        # Wavelength at clock time t of a sweep that started at t0, with an optional
+        # smooth deviation from a perfectly linear sweep
+        elapsed = t - t0
+        if elapsed <= 0:
+            return s["start"]
+        span = s["stop"] - s["start"]
+        wl = s["start"] + elapsed*s["speed"]
+        if self.nonlinearity != 0 and span != 0:
+            wl += self.nonlinearity*math.sin(math.pi*(wl - s["start"])/span)
+        return min(wl, s["stop"])
+
+    def sweepDone(self, s, t):
+        return s["t0"] is not None and t - s["t0"] >= (s["stop"] - s["start"])/s["speed"]
+
+    def getWL(self, slot):
+        self.wait()
+        if not self.laserOK:
+            return float(0.0)
+        s = self.slot(slot)
+        t0 = s["t0"]
+        if t0 is not None:
+            t = self.clock()
+            s["wl"] = self.sweepWL(s, t, t0)
+            if self.sweepDone(s, t):
+                self.finishSweep(s)
+        return s["wl"]
+
+    def setWL(self, slot, wl):
+        self.wait()
+        self.slot(slot)["wl"] = wl
+
+    def getPwr(self, slot):
+        self.wait()
+        if not self.laserOK:
+            return -99.99
+        return self.slot(slot)["pwr"]
+
+    def setPwr(self, slot, pwr):
+        self.wait()
+        self.slot(slot)["pwr"] = pwr
+
+    def getState(self, slot):
+        self.wait()
+        return self.laserOK and self.slot(slot)["state"]
+
+    def setState(self, slot, onoff):
+        self.wait()
+        self.slot(slot)["state"] = bool(onoff)
+
+    def setSweep(self, slot, mode, start, stop, step, cycles, dwell, speed):
+        self.wait()
+        s = self.slot(slot)
+        s["mode"] = mode
+        s["start"] = start
+        s["stop"] = stop
+        s["step"] = step
+        s["speed"] = speed
+
+    def setSweepState(self, slot, state):
+        self.wait()
+        s = self.slot(slot)
+        if state == "Start":
+            self.active_slot = slot
+            s["wl"] = s["start"]
+            s["t0"] = self.clock() + self.start_delay*(1 + 0.1*self.rng.uniform(-1, 1))
+            s["log"] = np.zeros(0)
+        elif state == "Stop" and s["t0"] is not None:
+            self.finishSweep(s)
+
+    def finishSweep(self, s):
+        if s["llog"] and s["trig"] == "STF" and s["step"] > 0:
+            # Log only the steps that were actually reached before the sweep ended
+            t = self.clock()
+            nsteps = int(np.floor((s["stop"] - s["start"])/s["step"])) + 1
+            tsteps = s["t0"] + np.arange(nsteps)*(s["step"]/s["speed"])
+            tsteps = tsteps[tsteps <= t]
+            s["log"] = np.array([self.sweepWL(s, tk, s["t0"]) for tk in tsteps])
+        s["t0"] = None
+
+    def getSweepState(self, slot):
+        self.wait()
+        s = self.slot(slot)
+        if s["t0"] is None:
+            return 0
+        if self.sweepDone(s, self.clock()):
+            self.finishSweep(s)
+            return 0
+        return 1
+
+    def setTriggerOutput(self, slot, mode):
+        self.wait()
+        self.slot(slot)["trig"] = mode
+
+    def setLambdaLogging(self, slot, onoff):
+        self.wait()
+        self.slot(slot)["llog"] = bool(onoff)
+
+    def getLoggedPoints(self, slot):
+        self.wait()
+        return len(self.slot(slot)["log"])
+
+    def getLoggedWL(self, slot):
+        self.wait()
+        return self.slot(slot)["log"].copy()
+
+    def queryBlock(self, cmd, datatype='d', npoints=None):
+        self.wait()
+        return np.zeros(0)
+
+
+class SimulatedPM:
+
+    stringsearch = "P300"
+    ok = False
+    pm = None
+    rm = None
+    pmID = "SIMULATED,PM300,0,0"
+    resource = ""
+
+    def __init__(self, laser, slot=None, model=None, noise_mw=1e-3, latency=0.0, seed=0):
+        self.laser = laser
+        self.slot = slot
+        self.model = model if model is not None else SpectralModel()
+        self.noise_mw = noise_mw
+        self.latency = latency
+        self.rng = np.random.default_rng(seed)
+
+    def close(self):
+        self.ok = False
+
+    def init(self, index=0, resource=None):
+        self.resource = "SIM::P300::INSTR"
+        self.ok = True
+
+    def queryBlock(self, cmd, datatype='f', npoints=None):
+        return np.zeros(0)
+
+    def readPwr(self, db=True):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if not self.ok:
+            if db:
+                return -99.99
+            else:
+                return 0.00
+        # Follows the slot that was swept last unless tied to a slot
+        slot = self.laser.active_slot if self.slot is None else self.slot
+        s = self.laser.slot(slot)
+        t0 = s["t0"]
+        wl = s["wl"] if t0 is None else self.laser.sweepWL(s, self.laser.clock(), t0)
+        val = abs(self.model(wl) + self.noise_mw*self.rng.standard_normal())*1e-3
+        if db:
+            return 10.0*math.log10(max(val, 1e-15)/0.001)
+        else:
+            return val
+
+
+def createDevices(slot=None, latency=0.0, noise_mw=1e-3, seed=0, model=None, start_delay=0.2, nonlinearity=0.0):
+    # Laser and power meter pair sharing one simulated optical path
+    laser = SimulatedLaser(latency=latency, start_delay=start_delay, nonlinearity=nonlinearity, seed=seed)
+    pm = SimulatedPM(laser, slot=slot, model=model, noise_mw=noise_mw, latency=latency, seed=seed + 1)
+    return laser, pm
+
+
+def createChannels(slots, latency=0.0, noise_mw=1e-3, seed=0, models=None, start_delay=0.2):
+    # One laser mainframe and one power meter per slot, each looking at its own device
+    laser = SimulatedLaser(latency=latency, start_delay=start_delay, seed=seed)
+    pms = []
+    for i, slot in enumerate(slots):
+        model = models[i] if models is not None else None
+        pms.append(SimulatedPM(laser, slot=slot, model=model, noise_mw=noise_mw, latency=latency,
+                               seed=seed + 1 + i))
+    return laser, pms
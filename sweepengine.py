@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+"""
+GUI-independent sweep engine.
+
+SweepEngine runs repeated laser sweeps while the acquisition thread samples
+the power meter, post-processes the result and writes it to disk. The GUI
+drives it by calling poll() from a timer; scripts call run(), which blocks
+until the measurement is done.
+
+    laser, pm = sweepengine.openDevices(address=17)
+    engine = sweepengine.SweepEngine(laser, pm)
+    engine.run(sweepengine.SweepParams(start=1540, stop=1560, speed=5, sweeps=3))
+    engine.save("device_01.h5")
+
+The same is available from the command line:
+
+    python sweepengine.py --start 1540 --stop 1560 --speed 5 --sweeps 3 -o device_01.h5
+"""
+
+import os, sys, time, json, argparse
+import numpy as np
+from dataclasses import dataclass, asdict
+
+import acquisition
+import sweepstore
+import processing
+import checkpoint
+import measfile
+import launchdetect
+import asyncdrivers
+import discovery
+import profiling
+import features
+
+
+@dataclass
+class SweepParams:
+    start: float = 1550.0
+    stop: float = 1560.0
+    speed: float = 1.0
+    slot: int = 0
+    sweeps: int = 1
+    hwlog: bool = False
+    logstep: float = 0.001
+    turnoff: bool = False
+    timeout: float = 10.0
+    launch_poll: float = 0.05
+    feature_resolution: float = 0.001
+    feature_prominence: float = 3.0
+    # Seconds between laser wavelength readings during a sweep (0: none), and the degree
+    # of the polynomial fitted to them for the wavelength axis
+    readback_interval: float = 0.2
+    wl_fit_degree: int = 3
+
+
+laser_methods = ["setState", "setWL", "getWL", "getPwr", "setSweep", "setSweepState", "getSweepState",
+                 "setTriggerOutput", "setLambdaLogging", "getLoggedWL", "disableAll"]
+pm_methods = ["readPwr"]
+
+
+class SweepEngine:
+
+    IDLE = 0
+    LAUNCHING = 1
+    SWEEPING = 2
+    DONE = 3
+    # Waiting for the laser to finish the sweep so its wavelength log can be read
+    DOWNLOADING = 4
+
+    def __init__(self, laser, pm, checkpoint_path=None, laser_io=None):
+        self.profiler = profiling.Profiler()
+        # Calls through self.laser and self.pm are timed by this engine's profiler only,
+        # the drivers may be shared with other engines
+        self.laser = self.profiler.proxy(laser, laser_methods, "laser")
+        self.pm = self.profiler.proxy(pm, pm_methods, "pm")
+        self.params = SweepParams()
+        self.sweeps = sweepstore.SweepStore()
+        self.average = None
+        self.state = self.IDLE
+        self.meas_i = 0
+        # Index of the current sweep in the run, as written to the checkpoint
+        self.run_i = -1
+        self.sweepesttime = 0
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = None
+        self.detector = None
+        self.pending = []
+        self.tracker = None
+        self.trackers = {}
+        self.source_dbm = None
+        self.last_stoptime = None
+        self.last_sample_t = None
+        self.sweepstarttime = 0.0
+        self.next_readback = 0.0
+        self.log_deadline = 0.0
+        self.io = asyncdrivers.AsyncPair(self.laser, self.pm, laser_io)
+        # The acquisition thread keeps the untimed readPwr, its reads are timed per sample
+        self.acq = acquisition.AcquisitionThread(pm.readPwr)
+        self.acq.start()
+
+        # Optional callbacks, all called from the thread that calls poll()
+        self.onSweepStart = None
+        self.onSweepEnd = None
+        self.onDone = None
+        self.onStatus = None
+
+    def status(self, msg):
+        if self.onStatus is not None:
+            self.onStatus(msg)
+
+    def start(self, params):
+        self.params = params
+        self.sweeps = sweepstore.SweepStore()
+        self.average = None
+        self.meas_i = 0
+        self.run_i = -1
+        self.trackers = {}
+        self.last_stoptime = None
+        self.profiler.reset()
+        if self.checkpoint_path is not None:
+            self.checkpoint = checkpoint.CheckpointWriter(self.checkpoint_path)
+        # Settings are sent again once per measurement, then only when they change
+        self.laser.forgetSettings()
+        self.laser.setState(params.slot, True)
+        # Laser output power (dBm), for the insertion loss
+        self.source_dbm = self.laser.getPwr(params.slot)
+        self.status(f"Starting measurement...")
+        self.prepareSweep()
+
+    def resume(self, params):
+        # More sweeps in the same run once it is done, e.g. over a new range or at a new speed.
+        # self.sweeps starts empty again, but unlike start() the profile, the dead time between
+        # sweeps and the checkpoint carry on from the previous sweeps.
+        self.params = params
+        self.sweeps = sweepstore.SweepStore()
+        self.average = None
+        self.meas_i = 0
+        self.trackers = {}
+        if self.checkpoint_path is not None:
+            self.checkpoint = checkpoint.CheckpointWriter(self.checkpoint_path, append=True)
+        self.laser.setState(params.slot, True)
+        self.prepareSweep()
+
+    def prepareSweep(self):
+        p = self.params
+        sweep = self.sweeps.new()
+        self.run_i += 1
+        sweep.speed = p.speed
+        sweep.endwl = p.stop
+        step = 1
+        if p.hwlog:
+            step = p.logstep
+            sweep.logstep = step
+            self.laser.setTriggerOutput(p.slot, "STF")
+        self.laser.setLambdaLogging(p.slot, p.hwlog)
+        self.laser.setWL(p.slot, p.start)
+        self.laser.setSweep(p.slot, "CONT", p.start, p.stop, step, 1, 0, p.speed)
+        self.laser.setSweepState(p.slot, "Start")
+        self.sweepstarttime = time.perf_counter()
+
+        # Sampling starts now; samples taken before the fitted launch time are dropped
+        self.acq.startSampling()
+        self.last_sample_t = None
+        self.pending = []
+        self.detector = launchdetect.LaunchDetector(lambda: self.laser.getWL(p.slot), p.start,
+                                                    p.timeout, max_interval=p.launch_poll)
+        self.state = self.LAUNCHING
+        self.status(f"Waiting for sweep {self.meas_i + 1}/{p.sweeps} to start...")
+
+    def checkLaunch(self):
+        p = self.params
+        self.pending.append(self.drainBuffer())
+        if self.detector.poll() == self.detector.WAITING:
+            return
+        sweep = self.sweeps.last()
+        sweep.launchtime = self.detector.launchtime
+        self.profiler.record("engine.launchWait", sweep.launchtime - self.sweepstarttime)
+        if self.last_stoptime is not None:
+            self.profiler.record("engine.deadTime", sweep.launchtime - self.last_stoptime)
+        if self.detector.state == self.detector.LAUNCHED:
+            sweep.launchwl = self.detector.launchwl
+            # The launch burst is the first set of wavelength readings of the sweep
+            sweep.readbacks = [(t - sweep.launchtime, wl) for t, wl in zip(self.detector.times, self.detector.wls)]
+        else:
+            sweep.launchwl = self.laser.getWL(p.slot)
+            sweep.readbacks = [(0.0, sweep.launchwl)]
+        self.next_readback = time.perf_counter() + p.readback_interval
+
+        if self.checkpoint is not None:
+            self.checkpoint.beginSweep(self.run_i, sweep.launchtime, sweep.launchwl, p.speed)
+        if sweep.launchwl < 100:
+            self.sweepesttime = (p.stop - p.start)/p.speed
+        else:
+            self.sweepesttime = abs(p.stop - sweep.launchwl)/p.speed
+
+        self.tracker = features.FeatureTracker(p.speed, p.feature_resolution, p.feature_prominence,
+                                               self.source_dbm)
+        self.trackers[len(self.sweeps) - 1] = self.tracker
+        self.pending.append(self.drainBuffer())
+        for times, values, latencies in self.pending:
+            keep = times >= sweep.launchtime
+            self.storeSamples(times[keep], values[keep], latencies[keep])
+        self.pending = []
+        self.state = self.SWEEPING
+        if self.onSweepStart is not None:
+            self.onSweepStart(self.meas_i)
+        self.status(f"Measuring ({self.meas_i + 1}/{p.sweeps})...")
+
+    def poll(self):
+        # Drains new samples and advances to the next sweep when the current one is over.
+        # Returns the number of new samples.
+        if self.state == self.LAUNCHING:
+            with self.profiler.stage("engine.checkLaunch"):
+                self.checkLaunch()
+            return 0
+        if self.state == self.DOWNLOADING:
+            with self.profiler.stage("engine.wavelengthLog"):
+                done = self.readWavelengthLog()
+            if done:
+                self.closeSweep()
+                self.nextSweep()
+            return 0
+        if self.state != self.SWEEPING:
+            return 0
+        thistime = time.perf_counter()
+        n = self.drainSamples()
+        if self.params.readback_interval > 0 and thistime >= self.next_readback:
+            self.readWavelength()
+        if thistime - self.sweeps.last().launchtime >= self.sweepesttime:
+            with self.profiler.stage("engine.endSweep"):
+                self.endSweep()
+            if self.state == self.SWEEPING:
+                self.nextSweep()
+        return n
+
+    def nextSweep(self):
+        if self.meas_i >= self.params.sweeps:
+            self.finish()
+        else:
+            with self.profiler.stage("engine.prepareSweep"):
+                self.prepareSweep()
+
+    def drainBuffer(self):
+        # Drains the acquisition buffer, adding the read latencies and sample intervals to the profile
+        with self.profiler.stage("engine.drain"):
+            times, values, latencies = self.acq.buffer.drain(latency=True)
+        if len(times) > 0:
+            self.profiler.extend("acq.read", latencies)
+            if self.last_sample_t is not None:
+                self.profiler.extend("acq.interval", np.diff(times, prepend=self.last_sample_t))
+            else:
+                self.profiler.extend("acq.interval", np.diff(times))
+            self.last_sample_t = times[-1]
+        return times, values, latencies
+
+    def drainSamples(self):
+        times, values, latencies = self.drainBuffer()
+        self.storeSamples(times, values, latencies)
+        return len(times)
+
+    def readWavelength(self):
+        # Laser wavelength during the sweep, stamped at the midpoint of the query
+        sweep = self.sweeps.last()
+        t1 = time.perf_counter()
+        wl = self.laser.getWL(self.params.slot)
+        t2 = time.perf_counter()
+        sweep.readbacks.append((0.5*(t1 + t2) - sweep.launchtime, wl))
+        self.next_readback = t2 + self.params.readback_interval
+
+    def storeSamples(self, times, values, latencies=None):
+        sweep = self.sweeps.last()
+        with self.profiler.stage("engine.store"):
+            sweep.extend(times - sweep.launchtime, values, lat=latencies)
+        with self.profiler.stage("features.extend"):
+            self.tracker.extend(times - sweep.launchtime, values)
+        if self.checkpoint is not None:
+            with self.profiler.stage("checkpoint.write"):
+                self.checkpoint.writeSamples(self.run_i, times - sweep.launchtime, values)
+
+    def endSweep(self):
+        p = self.params
+        self.meas_i += 1
+        self.acq.pauseSampling()
+        self.drainSamples()
+        # Final wavelength and power are read at the same instant
+        wl, pwr = self.io.readPair(p.slot)
+        self.storeSamples(np.array([pwr.t]), np.array([pwr.value]), np.array([pwr.latency]))
+        sweep = self.sweeps.last()
+        sweep.trim()
+        sweep.readbacks.append((wl.t - sweep.launchtime, wl.value))
+        sweep.stoptime = wl.t
+        sweep.stopwl = wl.value
+        self.last_stoptime = wl.t
+        self.profiler.record("engine.readPair", max(wl.latency, pwr.latency))
+        with self.profiler.stage("features.finish"):
+            sweep.features = self.tracker.finish(features.linearAxis(sweep))
+        if p.hwlog:
+            # The log is read by poll() once the laser has finished the sweep
+            self.state = self.DOWNLOADING
+            self.log_deadline = time.perf_counter() + 2.0
+            return
+        self.closeSweep()
+
+    def closeSweep(self):
+        sweep = self.sweeps.last()
+        self.laser.setSweepState(self.params.slot, "Stop")
+        if self.checkpoint is not None:
+            self.checkpoint.endSweep(self.run_i, sweep.stoptime, sweep.stopwl)
+        self.state = self.SWEEPING
+        if self.onSweepEnd is not None:
+            self.onSweepEnd(self.meas_i - 1)
+
+    def readWavelengthLog(self, wait=True):
+        # Returns False while the laser is still sweeping, for up to 2 s; then the log is read
+        sweep = self.sweeps.last()
+        if wait and time.perf_counter() < self.log_deadline and self.laser.getSweepState(self.params.slot) != 0:
+            return False
+        try:
+            sweep.logwl = self.laser.getLoggedWL(self.params.slot)
+        except:
+            sweep.logwl = None
+            self.status(f"Could not read the wavelength log, using linear wavelength axis")
+        return True
+
+    def stop(self):
+        # Aborts the measurement, keeping the data of the sweep in progress
+        if self.state == self.LAUNCHING:
+            # Nothing was measured in a sweep that never started
+            self.acq.pauseSampling()
+            self.sweeps.sweeps.pop()
+            self.finish()
+        elif self.state in (self.SWEEPING, self.DOWNLOADING):
+            if self.state == self.SWEEPING:
+                self.endSweep()
+            if self.state == self.DOWNLOADING:
+                # No waiting for the laser here, the log is read as it is
+                self.readWavelengthLog(wait=False)
+                self.closeSweep()
+            self.finish()
+        self.status(f"Measurement stopped")
+
+    def finish(self):
+        self.laser.setSweepState(self.params.slot, "Stop")
+        if self.params.turnoff:
+            self.laser.disableAll()
+        with self.profiler.stage("engine.processFinal"):
+            self.processFinal()
+        self.state = self.DONE
+        if self.onDone is not None:
+            self.onDone()
+
+    def processFinal(self):
+        self.average = processSweeps(self.sweeps, self.params, self.trackers)
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+
+    def run(self, params, poll_interval=0.02):
+        self.start(params)
+        while self.state in (self.LAUNCHING, self.SWEEPING, self.DOWNLOADING):
+            if self.state == self.LAUNCHING:
+                time.sleep(max(0.0, min(poll_interval, self.detector.next_poll - time.perf_counter())))
+            else:
+                time.sleep(poll_interval)
+            self.poll()
+        return self.sweeps
+
+    def meta(self):
+        meta = asdict(self.params)
+        meta["laser_id"] = self.laser.laserID
+        meta["pm_id"] = self.pm.pmID
+        meta["date"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        if any(sweep.features is not None for sweep in self.sweeps):
+            meta["features"] = json.dumps([sweep.features for sweep in self.sweeps])
+        if any(sweep.timing is not None for sweep in self.sweeps):
+            meta["timing"] = json.dumps([sweep.timing for sweep in self.sweeps])
+        return meta
+
+    def runStats(self):
+        # Effective rate over the sampled time, sample jitter and dead time between sweeps
+        nsamples = sum(len(sweep) for sweep in self.sweeps)
+        sampled = sum(sweep.t[-1] for sweep in self.sweeps if len(sweep) > 0)
+        interval = self.profiler.get("acq.interval")
+        deadtime = self.profiler.get("engine.deadTime")
+        wlerr = [np.max(sweep.wlerr) for sweep in self.sweeps if sweep.wlerr is not None and len(sweep.wlerr) > 0]
+        nonlinearity = [sweep.timing["nonlinearity_nm"] for sweep in self.sweeps if sweep.timing is not None]
+        return {"samples": nsamples, "sweeps": len(self.sweeps),
+                "sample_rate_hz": nsamples/sampled if sampled > 0 else 0.0,
+                "interval_mean_s": interval.mean(), "jitter_s": interval.std(),
+                "worst_gap_s": interval.max, "dead_time_mean_s": deadtime.mean(),
+                "dead_time_total_s": deadtime.total, "overruns": self.acq.buffer.overruns,
+                "wl_error_max_nm": float(max(wlerr)) if wlerr else 0.0,
+                "nonlinearity_nm": float(max(nonlinearity)) if nonlinearity else 0.0}
+
+    def liveSummary(self):
+        # One line for a status bar: rate, jitter, dead time and the costliest stages so far
+        stats = self.runStats()
+        return (f"{stats['sample_rate_hz']:.0f} S/s, jitter {profiling.formatTime(stats['jitter_s'])}, "
+                f"dead time {profiling.formatTime(stats['dead_time_mean_s'])} | "
+                + self.profiler.summary(("acq.interval", "engine.launchWait", "engine.deadTime")))
+
+    def result(self):
+        # The finished run detached from the engine, which can start the next one meanwhile
+        meta = self.meta()
+        return RunResult(self.sweeps, self.average, meta, self.profiler.report({"run": self.runStats(), "meta": meta}))
+
+    def save(self, path):
+        result = self.result()
+        with self.profiler.stage("engine.save"):
+            saveResult(path, result)
+        self.profiler.dump(os.path.splitext(path)[0] + "_profile.json", {"run": result.profile["run"], "meta": result.meta})
+
+    def close(self, devices=False):
+        # With devices=True the laser and power meter are closed too, concurrently
+        self.acq.stop()
+        self.io.close(devices)
+
+
+def processSweeps(sweeps, params, trackers=None):
+    # Final wavelength axes, wavelength errors, features and average of a run. trackers maps
+    # sweep indices to the FeatureTrackers fed during the run; without them the features
+    # are extracted in one pass. Returns the average, or None for a single sweep.
+    processing.wavelengthAxes(sweeps)
+    for sweep in sweeps:
+        # The readback fit is only needed without the laser's own wavelength log
+        if not processing.applyWavelengthLog(sweep):
+            processing.fitWavelengthAxis(sweep, params.wl_fit_degree)
+        processing.wavelengthError(sweep)
+    # Features are measured again on the final wavelength axes
+    if trackers is None:
+        for sweep in sweeps:
+            if len(sweep) > 1:
+                sweep.features = features.extract(sweep, params.feature_resolution, params.feature_prominence)
+    else:
+        for i, tracker in trackers.items():
+            if len(sweeps[i]) > 1:
+                sweeps[i].features = tracker.finish(features.sweepAxis(sweeps[i]))
+    if len(sweeps) > 1:
+        return processing.averageSweeps(sweeps)
+    return None
+
+
+class RunResult:
+
+    def __init__(self, sweeps, average, meta, profile):
+        self.sweeps = sweeps
+        self.average = average
+        self.meta = meta
+        self.profile = profile
+
+
+def saveResult(path, result, profile=False):
+    # Sweeps, average and features of a run; with profile=True also <name>_profile.json
+    measfile.save(path, result.sweeps, result.meta)
+    if result.average is not None:
+        measfile.saveAverage(path, result.average)
+    if path.lower().endswith(".txt") and "features" in result.meta:
+        # Text files have no room for metadata
+        with open(os.path.splitext(path)[0] + "_features.json", "w") as file:
+            file.write(result.meta["features"])
+    if profile:
+        with open(os.path.splitext(path)[0] + "_profile.json", "w") as file:
+            json.dump(result.profile, file, indent=1)
+
+
+def openDevices(address=17, simulate=False, sim_options={}, resources=None):
+    # Creates and connects the laser and power meter (real or simulated). resources holds
+    # the VISA resource strings found last time, and is updated in place.
+    return discovery.Connector(address, simulate, sim_options, resources).run()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run laser sweeps without the GUI")
+    parser.add_argument("--recipe", help="named recipe to run; the options below override its values")
+    parser.add_argument("--recipes", help="recipe file (default: settings.json next to the scripts)")
+    parser.add_argument("--start", type=float, help="start wavelength (nm)")
+    parser.add_argument("--stop", type=float, help="stop wavelength (nm)")
+    parser.add_argument("--speed", type=float, help="sweep speed (nm/s, default 1)")
+    parser.add_argument("--slot", type=int, help="laser slot (default 0)")
+    parser.add_argument("--sweeps", type=int, help="number of repeated sweeps (default 1)")
+    parser.add_argument("--address", type=int, help="laser GPIB address (default 17)")
+    parser.add_argument("--hwlog", action="store_true", default=None, help="use the laser's lambda logging")
+    parser.add_argument("--logstep", type=float, help="lambda logging step (pm, default 1)")
+    parser.add_argument("--turnoff", action="store_true", default=None, help="turn the laser off afterwards")
+    parser.add_argument("-o", "--output", required=True, help="output file (.txt, .h5 or .npz)")
+    parser.add_argument("--simulate", action="store_true", help="use simulated instruments")
+    parser.add_argument("--sim-latency", type=float, default=0.0, help="simulated latency per call (s)")
+    parser.add_argument("--sim-seed", type=int, default=0, help="simulation random seed")
+    parser.add_argument("--sim-nonlinearity", type=float, default=0.0,
+                        help="simulated deviation from a constant speed sweep (nm)")
+    parser.add_argument("--readback-interval", type=float, default=0.2,
+                        help="seconds between wavelength readings during a sweep (0: none)")
+    args = parser.parse_args(argv)
+
+    import recipes
+    store = recipes.RecipeStore(args.recipes or recipes.default_path)
+    try:
+        store.load()
+        recipe = store.get(args.recipe) if args.recipe is not None else recipes.Recipe()
+    except (KeyError, ValueError) as e:
+        print(e.args[0])
+        return 1
+    if args.recipe is None and (args.start is None or args.stop is None):
+        parser.error("--start and --stop are required without --recipe")
+    for key in ("start", "stop", "speed", "slot", "sweeps", "address", "hwlog", "logstep", "turnoff"):
+        if getattr(args, key) is not None:
+            setattr(recipe, key, getattr(args, key))
+
+    sim_options = {"latency": args.sim_latency, "seed": args.sim_seed, "nonlinearity": args.sim_nonlinearity}
+    laser, pm = openDevices(recipe.address, args.simulate, sim_options, store.devices)
+    if not laser.laserOK or not pm.ok:
+        print("Could not open the instruments")
+        return 1
+
+    params = recipe.params(readback_interval=args.readback_interval)
+    engine = SweepEngine(laser, pm)
+    engine.onStatus = print
+    try:
+        engine.run(params)
+        engine.save(args.output)
+        print(f"{len(engine.sweeps)} sweeps saved to {args.output} "
+              f"({engine.acq.rate():.1f} samples/s)")
+        print(engine.liveSummary())
+        stats = engine.runStats()
+        print(f"Wavelength uncertainty up to {stats['wl_error_max_nm']*1e3:.2f} pm, "
+              f"sweep nonlinearity {stats['nonlinearity_nm']*1e3:.2f} pm")
+    finally:
+        engine.close(devices=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Compact storage for sweep data.
+
+Each Sweep keeps its time, wavelength, power and read latency columns in one
+preallocated float64 block that doubles when full, so appends are amortized
+O(1) and the columns are exposed as zero-copy views.
+"""
+
+import numpy as np
+
+
+class Sweep:
+
+    T = 0
+    WL = 1
+    PWR = 2
+    LAT = 3
+    ROWS = 4
+
+    def __init__(self, capacity=4096):
+        self.data = np.zeros((self.ROWS, max(int(capacity), 1)), dtype=np.float64)
+        self.n = 0
+        self.launchtime = 0.0
+        self.launchwl = 0.0
+        self.stoptime = 0.0
+        self.stopwl = 0.0
+        self.speed = 0.0
+        self.logwl = None
+        self.logstep = 0.0
+        self.features = None
+        # Sweep end wavelength requested from the laser, and (t, wl) readings of the
+        # laser wavelength taken during the sweep, for the wavelength axis fit
+        self.endwl = 0.0
+        self.readbacks = []
+        self.timing = None
+        self.wlerr = None
+
+    @classmethod
+    def fromArrays(cls, t, wl, pwr, **meta):
+        sweep = cls(len(t))
+        sweep.extend(t, pwr, wl)
+        for key in meta:
+            setattr(sweep, key, meta[key])
+        return sweep
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def t(self):
+        return self.data[self.T, :self.n]
+
+    @property
+    def wl(self):
+        return self.data[self.WL, :self.n]
+
+    @property
+    def pwr(self):
+        return self.data[self.PWR, :self.n]
+
+    @property
+    def lat(self):
+        return self.data[self.LAT, :self.n]
+
+    def reserve(self, size):
+        if size > self.data.shape[1]:
+            capacity = self.data.shape[1]
+            while capacity < size:
+                capacity *= 2
+            data = np.zeros((self.ROWS, capacity), dtype=np.float64)
+            data[:, :self.n] = self.data[:, :self.n]
+            self.data = data
+
+    def append(self, t, pwr, wl=0.0, lat=0.0):
+        self.reserve(self.n + 1)
+        self.data[:, self.n] = (t, wl, pwr, lat)
+        self.n += 1
+
+    def extend(self, t, pwr, wl=None, lat=None):
+        k = len(t)
+        self.reserve(self.n + k)
+        self.data[self.T, self.n:self.n + k] = t
+        self.data[self.PWR, self.n:self.n + k] = pwr
+        if wl is not None:
+            self.data[self.WL, self.n:self.n + k] = wl
+        if lat is not None:
+            self.data[self.LAT, self.n:self.n + k] = lat
+        self.n += k
+
+    def trim(self):
+        # Drops the unused capacity once a sweep is complete
+        if self.data.shape[1] > self.n:
+            self.data = self.data[:, :max(self.n, 1)].copy()
+
+    def nbytes(self):
+        return self.data.nbytes
+
+
+class SweepStore:
+    # Ordered collection of Sweep records. Sweeps are moved between stores by
+    # reference, never copied.
+
+    def __init__(self):
+        self.sweeps = []
+
+    def __len__(self):
+        return len(self.sweeps)
+
+    def __iter__(self):
+        return iter(self.sweeps)
+
+    def __getitem__(self, i):
+        return self.sweeps[i]
+
+    def new(self, capacity=4096):
+        sweep = Sweep(capacity)
+        self.sweeps.append(sweep)
+        return sweep
+
+    def add(self, sweep):
+        self.sweeps.append(sweep)
+
+    def last(self):
+        return self.sweeps[-1]
+
+    def clear(self):
+        self.sweeps = []
+
+    def moveTo(self, other):
+        other.sweeps.extend(self.sweeps)
+        self.sweeps = []
+
+    def maxLength(self):
+        if len(self.sweeps) == 0:
+            return 0
+        return max(len(s) for s in self.sweeps)
+
+    def nbytes(self):
+        return sum(s.nbytes() for s in self.sweeps)
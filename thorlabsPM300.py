@@ -5,15 +5,19 @@ Created on Mon Jan 8 11:00:00 2019
 @author: Paulo Jarschel
 """
 
-import visa
 import numpy as np
 
+import scpiblock
+import visasession
+
 class ThorLabsPM300:
 
     stringsearch = "P300"
-    ok = False
-    pm = None
-    rm = None
+    session = None
+    pmID = ""
+    resource = ""
+    # ms allowed for opening the power meter and answering *IDN?
+    probe_timeout = 2000
 
     def __init__(self):
         True
@@ -22,31 +26,53 @@ class ThorLabsPM300:
         self.close()
         return 0
 
+    @property
+    def ok(self):
+        return self.session is not None and self.session.ok
+
     def close(self):
-        if self.ok:
-            self.pm.close()
-            self.ok = False
-
-    def init(self):
-        self.rm = visa.ResourceManager("@ni")
-        list = self.rm.list_resources()
-        self.pm = None
-        for i in range(0, len(list)):
-            if self.stringsearch in list[i]:
-                self.pm = self.rm.open_resource(list[i])
-                self.ok = True
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def listDevices(self):
+        return [r for r in visasession.listResources() if self.stringsearch in r]
+
+    def init(self, index=0, resource=None):
+        # Opens the index-th power meter found on the bus. A resource string from an
+        # earlier connection is tried first, which skips the scan of every interface.
+        self.close()
+        if resource and self.openResource(resource):
+            return
+        list = self.listDevices()
+        for i in range(index, len(list)):
+            if self.stringsearch in list[i] and self.openResource(list[i]):
                 break
 
+    def openResource(self, name):
+        session = visasession.Session(name, self.probe_timeout)
+        if not session.open():
+            return False
+        self.session = session
+        self.resource = name
+        self.pmID = session.idn
+        return True
+
+    def queryBlock(self, cmd, datatype='f', npoints=None):
+        # Binary block transfer straight into a NumPy array (little endian)
+        if self.session is None:
+            return np.zeros(0)
+        return self.session.call(lambda inst: scpiblock.queryBlock(inst, cmd, datatype, False, npoints),
+                                 np.zeros(0))
+
     def readPwr(self, db=True):
-        if self.ok:
-            val = float(self.pm.query("READ?"))
-            if db:
-                pwr = 10.0*np.log10(val/0.001)
-                return pwr
-            else:
-                return val
+        # Raises when the power meter can't be read, so the acquisition thread records the
+        # sample as NaN; the session reconnects in the background meanwhile
+        if self.session is None:
+            raise IOError("Power meter not connected")
+        val = float(self.session.read(lambda inst: inst.query("READ?")))
+        if db:
+            pwr = 10.0*np.log10(val/0.001)
+            return pwr
         else:
-            if db:
-                return -99.99
-            else:
-                return 0.00
+            return val
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Cached replacement for uic.loadUiType.
+
+loadUiType parses and compiles the Designer file on every start. Here the
+generated Python is kept in __pycache__ next to the .ui file and rebuilt only
+when the .ui is newer, so a normal start neither imports PyQt5.uic nor parses
+XML. Where __pycache__ cannot be written it falls back to uic.loadUiType.
+"""
+
+import os
+from xml.etree import ElementTree
+
+
+def loadUiType(path):
+    # (form class, Qt base class), like uic.loadUiType
+    path = os.path.abspath(path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache = os.path.join(os.path.dirname(path), "__pycache__", name + "_ui.py")
+    try:
+        if not os.path.isfile(cache) or os.path.getmtime(cache) < os.path.getmtime(path):
+            compileForm(path, cache)
+        with open(cache, "r") as file:
+            source = file.read()
+    except OSError:
+        from PyQt5 import uic
+        return uic.loadUiType(path)
+
+    from PyQt5 import QtWidgets
+    namespace = {}
+    exec(compile(source, cache, "exec"), namespace)
+    form = [v for k, v in namespace.items() if k.startswith("Ui_")][0]
+    return form, getattr(QtWidgets, namespace["base_class"])
+
+
+def compileForm(path, cache):
+    from PyQt5 import uic
+    os.makedirs(os.path.dirname(cache), exist_ok=True)
+    base = ElementTree.parse(path).getroot().find("widget").get("class")
+    tmp = cache + ".tmp"
+    with open(tmp, "w") as file:
+        uic.compileUi(path, file)
+        file.write(f"\nbase_class = {base!r}\n")
+    os.replace(tmp, cache)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Shared VISA sessions for the instrument drivers.
+
+All drivers share one ResourceManager per process (NI-VISA if it loads,
+pyvisa-py otherwise). A Session wraps one instrument:
+
+- every call goes through call(), which on an I/O error reopens the resource
+  and retries once. While the instrument is unreachable calls return the
+  driver's default value, and reopening is tried again every
+  `reconnect_interval` seconds instead of never.
+- read() is call() for the sampling path: a failed read raises at once and
+  the reconnect runs on a background thread, so a lost instrument costs the
+  acquisition loop a failed sample rather than a 2 s *IDN? probe.
+- configure() sends setting commands as one semicolon-joined transaction and
+  leaves out those whose value is the same as the last one sent. The shadow
+  copy of the settings is dropped whenever the session is reopened, and can
+  be dropped by hand with forget() when someone may have used the front panel.
+- calls are serialized by a lock, so the acquisition thread and the driver
+  worker threads can share an instrument.
+"""
+
+import time
+from threading import Thread, Lock, RLock
+
+try:
+    import pyvisa as visa
+except ImportError:
+    import visa
+
+backends = ["@ni", "@py"]
+rm = None
+rm_lock = RLock()
+
+
+def resourceManager():
+    # The first backend that loads, created on first use
+    global rm
+    with rm_lock:
+        if rm is None:
+            for backend in backends:
+                try:
+                    rm = visa.ResourceManager(backend)
+                    break
+                except:
+                    print(f"Could not create a VISA Resource Manager with {backend}")
+        return rm
+
+
+def listResources(query="?*::INSTR"):
+    manager = resourceManager()
+    if manager is None:
+        return []
+    try:
+        return list(manager.list_resources(query))
+    except:
+        return []
+
+
+class Session:
+
+    # Longest semicolon-joined message sent in one transaction
+    max_length = 256
+
+    def __init__(self, resource, open_timeout=2000, reconnect_interval=2.0):
+        self.resource = resource
+        self.open_timeout = open_timeout
+        self.reconnect_interval = reconnect_interval
+        self.inst = None
+        self.ok = False
+        self.idn = ""
+        self.shadow = {}
+        self.lock = RLock()
+        self.reconnect_lock = Lock()
+        self.last_open = 0.0
+        self.errors = 0
+        self.reconnects = 0
+        self.skipped = 0
+
+    def open(self):
+        # Opens the resource and checks that it answers *IDN? within open_timeout
+        with self.lock:
+            self.close()
+            self.last_open = time.perf_counter()
+            self.shadow = {}
+            manager = resourceManager()
+            if manager is None:
+                return False
+            try:
+                self.inst = manager.open_resource(self.resource, open_timeout=self.open_timeout)
+                timeout = self.inst.timeout
+                self.inst.timeout = self.open_timeout
+                self.idn = self.inst.query("*IDN?").strip()
+                self.inst.timeout = timeout
+            except:
+                self.close()
+                return False
+            self.ok = True
+            return True
+
+    def close(self):
+        with self.lock:
+            self.ok = False
+            if self.inst is not None:
+                try:
+                    self.inst.close()
+                except:
+                    pass
+                self.inst = None
+
+    def reconnect(self):
+        self.reconnects += 1
+        if self.open():
+            print(f"Reconnected to {self.resource}")
+            return True
+        return False
+
+    def call(self, func, default=None):
+        # func(instrument), with one reconnect and retry on error
+        with self.lock:
+            if not self.ok:
+                if time.perf_counter() - self.last_open < self.reconnect_interval or not self.reconnect():
+                    return default
+            try:
+                return func(self.inst)
+            except Exception as e:
+                self.errors += 1
+                print(f"VISA error on {self.resource}: {e}")
+            if self.reconnect():
+                try:
+                    return func(self.inst)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"VISA error on {self.resource} after reconnecting: {e}")
+            self.close()
+            return default
+
+    def read(self, func):
+        # func(instrument), raising IOError on error instead of returning a default value
+        if self.ok:
+            with self.lock:
+                if self.ok:
+                    try:
+                        return func(self.inst)
+                    except Exception as e:
+                        self.errors += 1
+                        print(f"VISA error on {self.resource}: {e}")
+                        self.close()
+        self.reconnectLater()
+        raise IOError(f"Could not read from {self.resource}")
+
+    def reconnectLater(self):
+        # Reopens the resource on a background thread, at most every reconnect_interval seconds
+        if time.perf_counter() - self.last_open < self.reconnect_interval:
+            return
+        if not self.reconnect_lock.acquire(blocking=False):
+            return
+        def worker():
+            try:
+                self.reconnect()
+            finally:
+                self.reconnect_lock.release()
+        Thread(target=worker, daemon=True).start()
+
+    def write(self, cmd):
+        self.call(lambda inst: inst.write(cmd))
+
+    def query(self, cmd, default=None):
+        return self.call(lambda inst: inst.query(cmd), default)
+
+    def configure(self, cmds):
+        # Sends the setting commands whose value changed since they were last sent, joined
+        # into as few transactions as possible. Commands are keyed by their header, and
+        # must be complete (rooted) headers so that they can follow a semicolon.
+        with self.lock:
+            changed = {}
+            for cmd in cmds:
+                key = cmd.split(" ", 1)[0].lower()
+                if self.shadow.get(key) != cmd:
+                    changed[key] = cmd
+            self.skipped += len(cmds) - len(changed)
+            if len(changed) == 0:
+                return 0
+            for message in joinCommands(list(changed.values()), self.max_length):
+                if self.call(lambda inst: inst.write(message), False) is False:
+                    # Unknown state after an error; everything is sent again next time
+                    self.shadow = {}
+                    return -1
+            self.shadow.update(changed)
+            return len(changed)
+
+    def forget(self):
+        with self.lock:
+            self.shadow = {}
+
+
+def joinCommands(cmds, max_length=256):
+    # ["a 1", "b 2", ...] -> ["a 1;b 2", ...], each message at most max_length long
+    messages = []
+    current = ""
+    for cmd in cmds:
+        if current != "" and len(current) + 1 + len(cmd) > max_length:
+            messages.append(current)
+            current = ""
+        current = cmd if current == "" else current + ";" + cmd
+    if current != "":
+        messages.append(current)
+    return messages